@@ -2,16 +2,16 @@ from airflow import DAG
 from airflow.operators.python import PythonOperator
 from airflow.models.param import Param
 from airflow.utils.task_group import TaskGroup
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
-import sqlite3
+import time
 import boto3
 import requests
-import psycopg2
-from airflow.exceptions import AirflowFailException
-from psycopg2 import sql
+from airflow.exceptions import AirflowException, AirflowFailException
 import re
+import hashlib
 from collections import defaultdict
+from etl_postgres import get_connection, run_sql_script, add_task_metrics, write_task_run
 
 # Default args
 default_args = {
@@ -24,13 +24,7 @@ def create_staging_views(**context):
     if not suffix:
         raise AirflowFailException("Suffix (load_id) не найден в XCom")
 
-    conn = psycopg2.connect(
-        host=os.getenv("POSTGRES_HOST", "postgres"),
-        dbname=os.getenv("POSTGRES_DB", "etldb"),
-        user=os.getenv("POSTGRES_USER", "etluser"),
-        password=os.getenv("POSTGRES_PASSWORD", "etlpass"),
-        port=os.getenv("POSTGRES_PORT", 5432)
-    )
+    conn = get_connection()
     conn.autocommit = True
 
     columns_by_table = {
@@ -73,98 +67,196 @@ def create_staging_views(**context):
         ]
     }
 
-    try:
-        with conn.cursor() as cur:
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT tablename
+            FROM pg_tables
+            WHERE schemaname = 'public'
+              AND tablename LIKE %s
+        """, (f"%_staging_{suffix}",))
+
+        all_tables = [row[0] for row in cur.fetchall()]
+
+        # Неизменившиеся файлы etl-runner не перезагружает: берём их staging-таблицы из load_log
+        cur.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = 'load_log' AND column_name = 'staging_table'
+        """)
+        if cur.fetchone():
             cur.execute("""
-                SELECT tablename
-                FROM pg_tables
-                WHERE schemaname = 'public'
-                  AND tablename LIKE %s
-            """, (f"%_staging_{suffix}",))
-
-            all_tables = [row[0] for row in cur.fetchall()]
-            if not all_tables:
-                return
-
-            cur.execute("CREATE SCHEMA IF NOT EXISTS staging")
-
-            grouped = defaultdict(list)
-            for table in all_tables:
-                match = re.search(r"(products|prices|contracts)_staging", table)
-                if match:
-                    base = match.group(1)
-                    grouped[base].append(table)
-                else:
-                    raise AirflowFailException(f"Invalid table name: {table}")
-
-            for base, tables in grouped.items():
-                view_name = f"staging.{base}_staging_view"
-                columns = columns_by_table[base]
-
-                union_sql_parts = []
-                for table in tables:
-                    col_casts = ", ".join(
-                        f"{col}::{dtype} AS {col}" for col, dtype in columns
-                    ) + f", '{table}'::text AS source_table"
-                    union_sql_parts.append(f"SELECT {col_casts} FROM public.\"{table}\"")
-
-                full_union_sql = "\nUNION ALL\n".join(union_sql_parts)
-
-                final_sql = f"""
-                    CREATE OR REPLACE VIEW {view_name} AS
-                    {full_union_sql};
-                """
-                cur.execute(final_sql)
-
-    finally:
-        conn.close()
+                SELECT DISTINCT staging_table
+                FROM load_log
+                WHERE load_id = %s AND status = 'SKIPPED' AND staging_table IS NOT NULL
+            """, (suffix,))
+            skipped = [row[0] for row in cur.fetchall() if row[0] not in all_tables]
+            # dwh не пересоздаётся: таблицы загрузок, уже обработанных до конца, повторно не читаем
+            cur.execute("SELECT to_regclass('dwh.processed_loads')")
+            if skipped and cur.fetchone()[0]:
+                cur.execute("""
+                    SELECT load_id FROM dwh.processed_loads
+                    WHERE load_id = ANY(%s)
+                """, ([staging_load_id(table) for table in skipped],))
+                processed = {row[0] for row in cur.fetchall()}
+                skipped = [table for table in skipped if staging_load_id(table) not in processed]
+            all_tables += skipped
+
+        # Секционированный staging (STAGING_TABLE_MODE=partitioned): таблицы загрузки лежат секциями
+        # staging.<entity>_staging, значение секции — то же имя staging-таблицы
+        cur.execute("""
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = 'staging'
+              AND (c.relname LIKE %s OR c.relname = ANY(%s))
+        """, (f"%_staging_{suffix}", all_tables))
+        partitions = {row[0] for row in cur.fetchall()}
+        all_tables += sorted(partitions - set(all_tables))
+
+        cur.execute("CREATE SCHEMA IF NOT EXISTS staging")
+
+        grouped = defaultdict(list)
+        for table in all_tables:
+            match = re.search(r"(products|prices|contracts)_staging", table)
+            if match:
+                base = match.group(1)
+                grouped[base].append(table)
+            else:
+                raise AirflowFailException(f"Invalid table name: {table}")
+
+        # Представления пересоздаются для всех сущностей: без новых файлов — пустые, чтобы SQL-загрузка
+        # не перечитывала таблицы прошлого запуска
+        for base, columns in columns_by_table.items():
+            view_name = f"staging.{base}_staging_view"
+            tables = grouped.get(base, [])
+
+            union_sql_parts = []
+            # Секции уже типизированы: одно чтение родительской таблицы, лишние секции отсекаются по source_table
+            base_partitions = [table for table in tables if table in partitions]
+            if base_partitions:
+                column_list = ", ".join(col for col, _ in columns)
+                values = ", ".join(f"'{table}'" for table in base_partitions)
+                union_sql_parts.append(
+                    f"SELECT {column_list}, source_table FROM staging.{base}_staging WHERE source_table IN ({values})"
+                )
+
+            for table in tables:
+                if table in partitions:
+                    continue
+                col_casts = ", ".join(
+                    f"{col}::{dtype} AS {col}" for col, dtype in columns
+                ) + f", '{table}'::text AS source_table"
+                union_sql_parts.append(f"SELECT {col_casts} FROM public.\"{table}\"")
+
+            if not union_sql_parts:
+                col_nulls = ", ".join(f"NULL::{dtype} AS {col}" for col, dtype in columns)
+                union_sql_parts.append(f"SELECT {col_nulls}, NULL::text AS source_table WHERE FALSE")
+
+            full_union_sql = "\nUNION ALL\n".join(union_sql_parts)
+
+            final_sql = f"""
+                CREATE OR REPLACE VIEW {view_name} AS
+                {full_union_sql};
+            """
+            cur.execute(final_sql)
+
+def staging_load_id(table: str) -> str:
+    # <файл>_staging_<load_id> — load_id загрузки, в которой таблица была записана
+    return table.rsplit("_staging_", 1)[1]
 
 def generate_load_id(**context):
     now = datetime.utcnow()
     load_id = now.strftime("%Y%m%d_%H%M%S%f")[:-3]
     context['ti'].xcom_push(key='load_id', value=load_id)
 
-def call_etl_api(entity: str, **context):
+def month_range(start_month: str, end_month: str) -> list:
+    # "202010", "202101" -> ["202010", "202011", "202012", "202101"]
+    year, month = int(start_month[:4]), int(start_month[4:])
+    months = []
+    while f"{year:04d}{month:02d}" <= end_month:
+        months.append(f"{year:04d}{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+def plan_etl_jobs(**context):
+    # Задачи для etl-runner: по одной на сущность (LOAD_MODE=range) или на пару (сущность, месяц)
+    # (LOAD_MODE=monthly) — у каждой свои ретраи, упавший месяц не перезапускает весь диапазон
     params = context["params"]
+    entities = [entity.strip() for entity in params.get("ENTITY", "").split(",") if entity.strip()]
     end_month = params.get("END_MONTH")
     start_month = params.get("START_MONTH") or end_month
+    if params.get("LOAD_MODE") == "monthly":
+        return [
+            {"entity": entity, "start_month": month, "end_month": month}
+            for month in month_range(start_month, end_month)
+            for entity in entities
+        ]
+    return [{"entity": entity, "start_month": start_month, "end_month": end_month} for entity in entities]
+
+def call_etl_api(entity: str, start_month: str = None, end_month: str = None, **context):
+    params = context["params"]
+    end_month = end_month or params.get("END_MONTH")
+    start_month = start_month or params.get("START_MONTH") or end_month
     load_id = context['ti'].xcom_pull(key='load_id', task_ids='generate_load_id')
 
-    response = requests.post(
-        "http://etl-runner:8888/run",
-        json={"entity": entity, "start_month": start_month, "end_month": end_month, "load_id": load_id}
+    return run_etl_runner_job(
+        "/run", {"entity": entity, "start_month": start_month, "end_month": end_month, "load_id": load_id}
     )
+
+def run_etl_runner_job(path: str, payload: dict):
+    etl_runner_url = os.getenv("ETL_RUNNER_URL", "http://etl-runner:8888")
+    # ETL_HTTP_TIMEOUT — таймаут одного запроса к etl-runner, ETL_JOB_TIMEOUT — предел ожидания всей задачи:
+    # без них зависший etl-runner держал бы слот пула и задачу Airflow бесконечно
+    http_timeout = float(os.getenv("ETL_HTTP_TIMEOUT", "30"))
+    deadline = time.monotonic() + float(os.getenv("ETL_JOB_TIMEOUT", str(6 * 3600)))
+    response = requests.post(f"{etl_runner_url}{path}", json=payload, timeout=http_timeout)
     response.raise_for_status()
-    return response.json()
+    job_id = response.json()["job_id"]
+
+    # etl-runner выполняет загрузку в фоне — опрашиваем статус до завершения
+    poll_interval = float(os.getenv("ETL_POLL_INTERVAL", "5"))
+    while True:
+        if time.monotonic() > deadline:
+            # Без ретрая: задача в etl-runner может ещё идти, повторный запуск загрузил бы те же файлы параллельно
+            raise AirflowFailException(f"ETL {job_id} не завершился за ETL_JOB_TIMEOUT, "
+                                       f"статус в etl-runner: {etl_runner_url}/runs/{job_id}")
+        try:
+            status = requests.get(f"{etl_runner_url}/runs/{job_id}", timeout=http_timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            # Разовый сбой опроса не роняет задачу, пока не истёк общий предел
+            print(f"[ETL] ⚠ {job_id}: не удалось получить статус ({e}), повтор через {poll_interval} с")
+            time.sleep(poll_interval)
+            continue
+        status.raise_for_status()
+        job = status.json()
+        print(f"[ETL] {job_id}: {job['status']}, файлов {job['files_done']}/{job['files_total']}, строк {job['rows_loaded']}")
+        if job["status"] == "success":
+            add_task_metrics(rows=job.get("rows_loaded"), bytes_processed=job.get("bytes_loaded"))
+            return job
+        if job["status"] == "failed":
+            # Ошибка задачи etl-runner ретраится: у отображённой задачи (сущность, месяц) свои retries
+            raise AirflowException(f"ETL {job_id} завершился с ошибкой: {job['error']}")
+        time.sleep(poll_interval)
 
 def log_dag_event(context, status):
+    # Начало, окончание, строки и байты задачи — в dwh.etl_task_runs; вместе с load_log etl-runner
+    # они дают хронологию загрузки в dwh.etl_run_timeline
+    task_instance = context['task_instance']
     try:
-        db_path = os.getenv("SQLITE_DB_PATH", "/opt/airflow/sqlite/etl.db")
         load_id = context['ti'].xcom_pull(key='load_id', task_ids='generate_load_id') or context['run_id']
-        task_id = context['task_instance'].task_id
         error = str(context.get('exception')) if status == 'FAILED' else None
-        with sqlite3.connect(db_path) as conn:
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS load_log (
-                    load_id TEXT,
-                    entity TEXT,
-                    file TEXT,
-                    status TEXT,
-                    rows_loaded INTEGER,
-                    error TEXT
-                )""")
-            conn.execute("""
-                INSERT INTO load_log (load_id, entity, file, status, rows_loaded, error)
-                VALUES (?, ?, ?, ?, ?, ?)""",
-                (load_id, task_id, "N/A", status, 0, error))
-            conn.commit()
+        write_task_run(
+            load_id, context['run_id'], task_instance.task_id, getattr(task_instance, 'map_index', -1),
+            task_instance.try_number, status, task_instance.start_date, task_instance.end_date, error
+        )
     except Exception as e:
-        print(f"[LOGGING ERROR] Could not write log for {task_id}: {e}")
+        print(f"[LOGGING ERROR] Could not write log for {task_instance.task_id}: {e}")
 
 def check_minio_and_db():
-    db_path = os.getenv("SQLITE_DB_PATH", "/opt/airflow/sqlite/etl.db")
-    with sqlite3.connect(db_path, timeout=5) as conn:
-        conn.execute("SELECT 1;")
+    conn = get_connection()
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1;")
+    conn.rollback()
     s3 = boto3.client(
         's3',
         endpoint_url=os.getenv("MINIO_ENDPOINT"),
@@ -173,37 +265,103 @@ def check_minio_and_db():
     )
     s3.head_bucket(Bucket=os.getenv("MINIO_BUCKET", "srcdata"))
 
-def run_sql_file(path):
+def run_sql_file(path, settings=None, single_transaction=True, **context):
+    # Скрипт выполняется по операторам через общее соединение (etl_postgres), время и число строк
+    # каждого шага пишутся в dwh.etl_sql_steps
     with open(path, "r") as f:
         sql_code = f.read()
-    conn = psycopg2.connect(
-        host="postgres",
-        dbname="etldb",
-        user="etluser",
-        password="etlpass"
+    ti = context.get('ti')
+    run_sql_script(
+        sql_code, os.path.basename(path), settings=settings, single_transaction=single_transaction,
+        load_id=ti.xcom_pull(key='load_id', task_ids='generate_load_id') if ti else None,
+        dag_run_id=context.get('run_id'),
+        task_id=ti.task_id if ti else None
     )
-    conn.autocommit = True
-    with conn.cursor() as cur:
-        cur.execute(sql_code)
-    conn.close()
 
 def create_dwh_tables():
-    run_sql_file("/opt/airflow/sql/create_dwh.sql")
-
-def load_products():
-    run_sql_file("/opt/airflow/sql/load_products.sql")
-
-def load_prices():
-    run_sql_file("/opt/airflow/sql/load_prices.sql")
-
-def load_contracts():
-    run_sql_file("/opt/airflow/sql/load_contracts.sql")
-
-def load_price_periods():
-    run_sql_file("/opt/airflow/sql/load_price_periods.sql")
-
-def load_contracts_enriched():
-    run_sql_file("/opt/airflow/sql/load_contracts_enriched.sql")
+    # Нумерованные миграции sql/migrations/NNN_*.sql применяются по одному разу и по порядку,
+    # применённые записываются в dwh.schema_migrations вместе с md5 файла
+    migrations_dir = "/opt/airflow/sql/migrations"
+    conn = get_connection()
+    conn.autocommit = False
+    with conn, conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('dwh_schema_migrations'))")
+        cur.execute("CREATE SCHEMA IF NOT EXISTS dwh")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS dwh.schema_migrations (
+                version INT PRIMARY KEY,
+                name TEXT NOT NULL,
+                checksum TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT now()
+            )
+        """)
+        cur.execute("SELECT version, checksum FROM dwh.schema_migrations")
+        applied = dict(cur.fetchall())
+
+        for file_name in sorted(os.listdir(migrations_dir)):
+            match = re.match(r"(\d+)_.+\.sql$", file_name)
+            if not match:
+                continue
+            version = int(match.group(1))
+            with open(os.path.join(migrations_dir, file_name), "r") as f:
+                sql_code = f.read()
+            checksum = hashlib.md5(sql_code.encode("utf-8")).hexdigest()
+            if version in applied:
+                if applied[version] != checksum:
+                    raise AirflowFailException(f"Миграция {file_name} изменена после применения")
+                continue
+            cur.execute(sql_code)
+            cur.execute(
+                "INSERT INTO dwh.schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                (version, file_name, checksum)
+            )
+            print(f"[MIGRATION] ✅ Применена {file_name}")
+
+def mark_load_processed(**context):
+    # Staging-таблицы этой загрузки разнесены по dwh: следующие запуски не включают их в представления
+    load_id = context['ti'].xcom_pull(key='load_id', task_ids='generate_load_id')
+    conn = get_connection()
+    conn.autocommit = False
+    with conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO dwh.processed_loads (load_id) VALUES (%s)
+            ON CONFLICT (load_id) DO NOTHING
+        """, (load_id,))
+
+def load_products(**context):
+    run_sql_file("/opt/airflow/sql/load_products.sql", **context)
+
+def load_prices(**context):
+    run_sql_file("/opt/airflow/sql/load_prices.sql", **context)
+
+def load_contracts(**context):
+    run_sql_file("/opt/airflow/sql/load_contracts.sql", **context)
+
+def load_price_periods(**context):
+    run_sql_file("/opt/airflow/sql/load_price_periods.sql", **context)
+
+def load_contracts_enriched(**context):
+    # incremental — пересчёт только изменившихся контрактов, full — полная перестройка,
+    # python — полный пересчёт в etl-runner (etl.revenue) шардами по contract_id
+    mode = context["params"].get("ENRICHED_MODE", "incremental")
+    if mode == "python":
+        load_id = context['ti'].xcom_pull(key='load_id', task_ids='generate_load_id')
+        return run_etl_runner_job("/revenue", {
+            "load_id": load_id,
+            "shards": int(os.getenv("REVENUE_SHARDS", "4")),
+            "workers": int(os.getenv("REVENUE_WORKERS", "2"))
+        })
+    run_sql_file("/opt/airflow/sql/load_contracts_enriched.sql", settings={"etl.enriched_mode": mode}, **context)
+
+def check_contracts_enriched(**context):
+    # Сверка инкрементального результата с полным расчётом; включается параметром ENRICHED_CHECK
+    if not context["params"].get("ENRICHED_CHECK"):
+        print("[VALIDATION] Сверка dwh.contract_price_enriched отключена")
+        return
+    run_sql_file("/opt/airflow/sql/load_contracts_enriched.sql", settings={"etl.enriched_mode": "check"}, **context)
+
+def load_marts(**context):
+    run_sql_file("/opt/airflow/sql/load_marts.sql", **context)
 
 with DAG(
     dag_id='etl_minio_dag',
@@ -214,7 +372,10 @@ with DAG(
     params={
         "ENTITY": Param("products,prices,contracts", type="string"),
         "START_MONTH": Param("202101", type="string"),
-        "END_MONTH": Param("202103", type="string")
+        "END_MONTH": Param("202103", type="string"),
+        "LOAD_MODE": Param("range", type="string", enum=["range", "monthly"]),
+        "ENRICHED_MODE": Param("incremental", type="string", enum=["incremental", "full", "python"]),
+        "ENRICHED_CHECK": Param(False, type="boolean")
     }
 ) as dag:
 
@@ -238,28 +399,21 @@ with DAG(
     )
 
     with TaskGroup("load_entities") as load_group:
-        t_products = PythonOperator(
-            task_id='call_etl_api_products',
-            python_callable=call_etl_api,
-            op_args=["products"],
-            on_success_callback=lambda context: log_dag_event(context, "SUCCESS"),
-            on_failure_callback=lambda context: log_dag_event(context, "FAILED")
-        )
-        t_prices = PythonOperator(
-            task_id='call_etl_api_prices',
-            python_callable=call_etl_api,
-            op_args=["prices"],
-            on_success_callback=lambda context: log_dag_event(context, "SUCCESS"),
-            on_failure_callback=lambda context: log_dag_event(context, "FAILED")
+        t_plan_etl_jobs = PythonOperator(
+            task_id='plan_etl_jobs',
+            python_callable=plan_etl_jobs
         )
-        t_contracts = PythonOperator(
-            task_id='call_etl_api_contracts',
+        # Сущности и месяцы загружаются параллельно; пул ограничивает число одновременных задач etl-runner
+        t_call_etl_api = PythonOperator.partial(
+            task_id='call_etl_api',
             python_callable=call_etl_api,
-            op_args=["contracts"],
+            pool=os.getenv("ETL_RUNNER_POOL", "etl_runner"),
+            retries=int(os.getenv("ETL_TASK_RETRIES", "2")),
+            retry_delay=timedelta(minutes=1),
             on_success_callback=lambda context: log_dag_event(context, "SUCCESS"),
             on_failure_callback=lambda context: log_dag_event(context, "FAILED")
-        )
-        t_products >> t_prices >> t_contracts
+        ).expand(op_kwargs=t_plan_etl_jobs.output)
+        t_plan_etl_jobs >> t_call_etl_api
 
     t_create_staging_views = PythonOperator(
         task_id='create_staging_views',
@@ -289,6 +443,13 @@ with DAG(
         on_failure_callback=lambda context: log_dag_event(context, "FAILED")
     )
 
+    t_mark_load_processed = PythonOperator(
+        task_id='mark_load_processed',
+        python_callable=mark_load_processed,
+        on_success_callback=lambda context: log_dag_event(context, "SUCCESS"),
+        on_failure_callback=lambda context: log_dag_event(context, "FAILED")
+    )
+
     t_load_price_periods = PythonOperator(
         task_id='load_price_periods',
         python_callable=load_price_periods,
@@ -303,6 +464,20 @@ with DAG(
         on_failure_callback=lambda context: log_dag_event(context, "FAILED")
     )
 
+    t_check_contracts_enriched = PythonOperator(
+        task_id='check_contracts_enriched',
+        python_callable=check_contracts_enriched,
+        on_success_callback=lambda context: log_dag_event(context, "SUCCESS"),
+        on_failure_callback=lambda context: log_dag_event(context, "FAILED")
+    )
+
+    t_load_marts = PythonOperator(
+        task_id='load_marts',
+        python_callable=load_marts,
+        on_success_callback=lambda context: log_dag_event(context, "SUCCESS"),
+        on_failure_callback=lambda context: log_dag_event(context, "FAILED")
+    )
+
     (
         t_check_minio_and_db 
         >> t_generate_load_id 
@@ -310,6 +485,8 @@ with DAG(
         >> load_group 
         >> t_create_staging_views 
         >> [t_load_products, t_load_prices, t_load_contracts] 
+        >> t_mark_load_processed
         >> t_load_price_periods 
         >> t_load_contracts_enriched
+        >> [t_check_contracts_enriched, t_load_marts]
     )
\ No newline at end of file
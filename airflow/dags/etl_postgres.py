@@ -0,0 +1,138 @@
+import os
+import time
+from datetime import datetime, timezone
+from airflow.providers.postgres.hooks.postgres import PostgresHook
+
+# Целевая база берётся из Airflow Connection (по умолчанию etl_postgres, в docker-compose —
+# переменная AIRFLOW_CONN_ETL_POSTGRES). Соединение одно на процесс задачи: миграции, представления
+# и SQL-скрипты задачи идут через него, а не открывают каждый своё
+POSTGRES_CONN_ID = os.getenv("ETL_POSTGRES_CONN_ID", "etl_postgres")
+
+_connection = None
+
+# Строки и байты, обработанные текущей задачей: их добавляют SQL-скрипты и вызовы etl-runner,
+# а колбэк задачи записывает одной строкой в dwh.etl_task_runs
+_task_metrics = {"rows": 0, "bytes": 0}
+
+
+def get_connection():
+    global _connection
+    if _connection is None or _connection.closed:
+        _connection = PostgresHook(postgres_conn_id=POSTGRES_CONN_ID).get_conn()
+    return _connection
+
+
+def split_statements(sql_code: str) -> list:
+    # sqlparse (через DbApiHook): учитывает строки, $$-блоки и комментарии
+    return PostgresHook.split_sql_string(sql_code)
+
+
+def statement_label(statement: str) -> str:
+    return " ".join(statement.split())[:200]
+
+
+def run_sql_script(sql_code: str, script: str, settings: dict = None, single_transaction: bool = True,
+                   load_id: str = None, dag_run_id: str = None, task_id: str = None) -> list:
+    # Выполняет скрипт по одному оператору, замеряя время и число строк каждого.
+    # single_transaction — весь скрипт в одной транзакции (как прежний execute всего файла),
+    # иначе каждый оператор фиксируется сразу. settings — настройки сессии (set_config),
+    # которые читает SQL, например etl.enriched_mode
+    conn = get_connection()
+    conn.autocommit = not single_transaction
+    steps = []
+    try:
+        with conn.cursor() as cur:
+            for name, value in (settings or {}).items():
+                cur.execute("SELECT set_config(%s, %s, %s)", (name, value, single_transaction))
+            for step, statement in enumerate(split_statements(sql_code), start=1):
+                started = time.perf_counter()
+                try:
+                    cur.execute(statement)
+                except Exception as e:
+                    steps.append((step, statement_label(statement), None,
+                                  (time.perf_counter() - started) * 1000, "FAILED", str(e)))
+                    raise
+                duration_ms = (time.perf_counter() - started) * 1000
+                rows = cur.rowcount if cur.rowcount >= 0 else None
+                steps.append((step, statement_label(statement), rows, duration_ms, "SUCCESS", None))
+                print(f"[SQL] {script} #{step}: {rows if rows is not None else '-'} строк, "
+                      f"{duration_ms:.1f} мс — {statement_label(statement)[:80]}")
+        if single_transaction:
+            conn.commit()
+    except Exception:
+        if single_transaction:
+            conn.rollback()
+        raise
+    finally:
+        if not single_transaction:
+            # Настройки уровня сессии иначе достались бы следующему скрипту на этом соединении
+            with conn.cursor() as cur:
+                for name in (settings or {}):
+                    cur.execute("SELECT set_config(%s, '', false)", (name,))
+        write_sql_steps(script, steps, load_id, dag_run_id, task_id)
+
+    add_task_metrics(rows=sum(s[2] or 0 for s in steps))
+    slowest = sorted(steps, key=lambda s: s[3], reverse=True)[:3]
+    total_ms = sum(s[3] for s in steps)
+    print(f"[SQL] {script}: {len(steps)} операторов за {total_ms:.1f} мс, дольше всего: "
+          + ", ".join(f"#{s[0]} {s[3]:.1f} мс" for s in slowest))
+    return steps
+
+
+def write_sql_steps(script: str, steps: list, load_id: str, dag_run_id: str, task_id: str):
+    # dwh.etl_sql_steps (миграция 003): отдельная транзакция после фиксации или отката скрипта,
+    # чтобы упавший шаг тоже остался в журнале
+    if not steps:
+        return
+    conn = get_connection()
+    try:
+        conn.autocommit = False
+        with conn, conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('dwh.etl_sql_steps')")
+            if cur.fetchone()[0] is None:
+                return
+            cur.executemany("""
+                INSERT INTO dwh.etl_sql_steps
+                    (load_id, dag_run_id, task_id, script, step, statement, rows_affected, duration_ms, status, error)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, [(load_id, dag_run_id, task_id, script, step, statement, rows, round(duration_ms, 1), status, error)
+                  for step, statement, rows, duration_ms, status, error in steps])
+    except Exception as e:
+        print(f"[LOGGING ERROR] Не удалось записать шаги {script} в dwh.etl_sql_steps: {e}")
+
+
+def add_task_metrics(rows: int = 0, bytes_processed: int = 0):
+    _task_metrics["rows"] += rows or 0
+    _task_metrics["bytes"] += bytes_processed or 0
+
+
+def write_task_run(load_id: str, dag_run_id: str, task_id: str, map_index: int, try_number: int, status: str,
+                   started_at: datetime = None, ended_at: datetime = None, error: str = None):
+    # Одна вставка на задачу через общее соединение процесса. Короткие lock_timeout/statement_timeout
+    # (ETL_METRICS_TIMEOUT_MS): колбэк не должен ждать блокировок, метрика в худшем случае теряется
+    rows, bytes_processed = _task_metrics["rows"], _task_metrics["bytes"]
+    _task_metrics.update(rows=0, bytes=0)
+    ended_at = ended_at or datetime.now(timezone.utc)
+    duration_ms = round((ended_at - started_at).total_seconds() * 1000, 1) if started_at else None
+    timeout_ms = os.getenv("ETL_METRICS_TIMEOUT_MS", "2000")
+    try:
+        conn = get_connection()
+        # Упавшая задача могла оставить соединение в прерванной транзакции
+        conn.rollback()
+        conn.autocommit = False
+        with conn, conn.cursor() as cur:
+            cur.execute("SELECT set_config('lock_timeout', %s, true), set_config('statement_timeout', %s, true)",
+                        (timeout_ms, timeout_ms))
+            cur.execute("SELECT to_regclass('dwh.etl_task_runs')")
+            if cur.fetchone()[0] is None:
+                print(f"[LOGGING] dwh.etl_task_runs ещё не создана (миграция 004), метрики {task_id} не записаны")
+                return
+            cur.execute("""
+                INSERT INTO dwh.etl_task_runs
+                    (load_id, dag_run_id, task_id, map_index, try_number, status, started_at, ended_at, duration_ms,
+                     rows_processed, bytes_processed, error)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, (load_id, dag_run_id, task_id, map_index, try_number, status, started_at, ended_at, duration_ms,
+                  rows, bytes_processed, error))
+    except Exception as e:
+        print(f"[LOGGING ERROR] Не удалось записать метрики {task_id} в dwh.etl_task_runs: {e}")
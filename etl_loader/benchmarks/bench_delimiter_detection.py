@@ -0,0 +1,67 @@
+# Подбор разделителя в transform_data: полный разбор файла с ';' и ',' против чтения заголовка и одного разбора
+# Запуск из каталога etl_loader: python -m benchmarks.bench_delimiter_detection --repeat 5
+import argparse
+import glob
+import os
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from etl.transform import CANDIDATE_DELIMITERS, get_missing_columns, read_header_line, detect_header_delimiter
+
+
+def detect_full_parse(file_path: str, entity: str) -> pd.DataFrame:
+    # Прежний алгоритм: каждый кандидат — полное чтение файла
+    best_missing_count, best_df = float("inf"), None
+    for sep in CANDIDATE_DELIMITERS:
+        df = pd.read_csv(file_path, sep=sep)
+        df.columns = [col.strip().replace('\ufeff', '') for col in df.columns]
+        missing = get_missing_columns(df, entity)
+        if len(missing) < best_missing_count:
+            best_df, best_missing_count = df, len(missing)
+    return best_df
+
+
+def detect_header_sample(file_path: str, entity: str) -> pd.DataFrame:
+    sep = detect_header_delimiter(read_header_line(file_path), entity)
+    df = pd.read_csv(file_path, sep=sep)
+    df.columns = [col.strip().replace('\ufeff', '') for col in df.columns]
+    return df
+
+
+def measure(func, file_path: str, entity: str, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(file_path, entity)
+        timings.append(time.perf_counter() - started)
+    tracemalloc.start()
+    func(file_path, entity)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--src", type=str, default=os.path.join(ROOT, "minio_data", "srcdatafiles"))
+    parser.add_argument("--entity", type=str, default="contracts")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # Пустой каталог matching-файлов, чтобы transform не нашёл сохранённый разделитель
+    os.environ["MATCHING_DIR"] = tempfile.mkdtemp(prefix="bench_matchings_")
+
+    print(f"{'file':<32} {'full, s':>9} {'sniff, s':>9} {'full, MiB':>10} {'sniff, MiB':>11}")
+    for path in sorted(glob.glob(os.path.join(args.src, f"*_{args.entity}.csv"))):
+        full_time, full_peak = measure(detect_full_parse, path, args.entity, args.repeat)
+        sniff_time, sniff_peak = measure(detect_header_sample, path, args.entity, args.repeat)
+        print(f"{os.path.basename(path):<32} {full_time:>9.3f} {sniff_time:>9.3f} "
+              f"{full_peak / 2 ** 20:>10.1f} {sniff_peak / 2 ** 20:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# Построение контрольных дат load_contracts_enriched.sql: LATERAL-подзапрос на каждый контракт
+# против соединения с однократно материализованным слепком цен. Печатает EXPLAIN ANALYZE обоих вариантов.
+# Запуск из каталога etl_loader после прогона DAG (нужны заполненные dwh.contracts и dwh.price_periods):
+#   python -m benchmarks.bench_enriched_breakpoints --repeat 5
+import argparse
+import re
+import time
+from sqlalchemy import text
+
+from etl.resources import get_engine
+
+CONTRACT_INPUT_SQL = """
+CREATE TEMP TABLE contract_input ON COMMIT DROP AS
+SELECT DISTINCT
+  contract_id,
+  product_id AS productid,
+  status,
+  COALESCE(usagenet, usage) AS consumption,
+  valid_from AS startdate,
+  CASE
+    WHEN valid_until = DATE '9999-12-31'
+    THEN MAX(snapshot_date) OVER (PARTITION BY contract_id, product_id)
+    ELSE valid_until
+  END AS enddate,
+  createdat::date AS createdat
+FROM dwh.contracts
+WHERE status <> 'indelivery'
+"""
+
+# Вариант до изменения: слепок цен ищется подзапросом для каждой строки contract_input
+LATERAL_SQL = """
+SELECT DISTINCT
+  c.contract_id,
+  c.productid,
+  date_value
+FROM contract_input c,
+LATERAL (
+  SELECT date_value FROM (
+    SELECT c.startdate AS date_value
+    UNION
+    SELECT c.createdat AS date_value
+    UNION
+    SELECT c.enddate AS date_value
+    UNION
+    SELECT valid_from FROM dwh.price_periods
+      WHERE snapshot_date = (SELECT MAX(snapshot_date) FROM dwh.price_periods)
+        AND product_id = c.productid
+    UNION
+    SELECT valid_until FROM dwh.price_periods
+      WHERE snapshot_date = (SELECT MAX(snapshot_date) FROM dwh.price_periods)
+        AND product_id = c.productid
+  ) d
+  WHERE date_value IS NOT NULL
+) AS bp
+"""
+
+# Текущий вариант: материализация слепка входит в замер, как и в SQL-файле
+LATEST_PRICE_PERIODS_SQL = """
+CREATE TEMP TABLE latest_price_periods ON COMMIT DROP AS
+SELECT product_id, valid_from, valid_until, baseprice, workingprice
+FROM dwh.price_periods
+WHERE snapshot_date = (SELECT MAX(snapshot_date) FROM dwh.price_periods)
+"""
+
+SET_BASED_SQL = """
+WITH price_dates AS (
+  SELECT product_id, valid_from AS date_value FROM latest_price_periods
+  UNION
+  SELECT product_id, valid_until FROM latest_price_periods
+)
+SELECT DISTINCT
+  contract_id,
+  productid,
+  date_value
+FROM (
+  SELECT c.contract_id, c.productid, d.date_value
+  FROM contract_input c
+  CROSS JOIN LATERAL (VALUES (c.startdate), (c.createdat), (c.enddate)) AS d(date_value)
+  UNION ALL
+  SELECT c.contract_id, c.productid, pd.date_value
+  FROM (SELECT DISTINCT contract_id, productid FROM contract_input) c
+  JOIN price_dates pd ON pd.product_id = c.productid
+) bp
+WHERE date_value IS NOT NULL
+"""
+
+
+def explain(conn, sql: str):
+    plan = conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {sql}")).scalars().all()
+    match = re.search(r"Execution Time: ([\d.]+) ms", plan[-1])
+    return float(match.group(1)) if match else None, plan
+
+
+def run_variant(engine, name: str, repeat: int):
+    timings, plan, rows = [], None, None
+    for _ in range(repeat):
+        with engine.begin() as conn:
+            conn.execute(text(CONTRACT_INPUT_SQL))
+            conn.execute(text("ANALYZE contract_input"))
+            if name == "set_based":
+                started = time.perf_counter()
+                conn.execute(text(LATEST_PRICE_PERIODS_SQL))
+                conn.execute(text("ANALYZE latest_price_periods"))
+                setup_ms = (time.perf_counter() - started) * 1000
+                query_ms, plan = explain(conn, SET_BASED_SQL)
+                rows = conn.execute(text(f"SELECT COUNT(*) FROM ({SET_BASED_SQL}) s")).scalar()
+                timings.append(setup_ms + query_ms)
+            else:
+                query_ms, plan = explain(conn, LATERAL_SQL)
+                rows = conn.execute(text(f"SELECT COUNT(*) FROM ({LATERAL_SQL}) s")).scalar()
+                timings.append(query_ms)
+    return min(timings), rows, plan
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--plans", action="store_true", help="печатать полные планы")
+    args = parser.parse_args()
+
+    engine = get_engine()
+    with engine.connect() as conn:
+        contracts = conn.execute(text("SELECT COUNT(*) FROM dwh.contracts")).scalar()
+        periods = conn.execute(text("SELECT COUNT(*) FROM dwh.price_periods")).scalar()
+
+    results = {}
+    for name in ("lateral", "set_based"):
+        results[name] = run_variant(engine, name, args.repeat)
+        if args.plans:
+            print(f"\n=== {name} ===")
+            print("\n".join(results[name][2]))
+
+    print(f"\ndwh.contracts: {contracts} строк, dwh.price_periods: {periods} строк, повторов: {args.repeat}")
+    print(f"{'variant':<10} {'best, ms':>10} {'rows':>10}")
+    for name, (ms, rows, _) in results.items():
+        print(f"{name:<10} {ms:>10.1f} {rows:>10}")
+    if results["lateral"][1] != results["set_based"][1]:
+        print("⚠ Число контрольных дат различается")
+    print(f"set_based быстрее lateral в {results['lateral'][0] / results['set_based'][0]:.1f} раз")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# Сравнение режимов загрузки в staging: COPY FROM STDIN против DataFrame.to_sql
+# Запуск из каталога etl_loader (нужен доступный PostgreSQL из POSTGRES_* переменных):
+#   python -m benchmarks.bench_load_to_staging --repeat 3
+import argparse
+import glob
+import os
+import re
+import time
+from datetime import datetime
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+os.environ.setdefault("MATCHING_DIR", os.path.join(ROOT, "matchings"))
+
+from etl.transform import transform_data
+from etl.load import load_to_staging, LOAD_MODES
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--src", type=str, default=os.path.join(ROOT, "minio_data", "srcdatafiles"))
+    parser.add_argument("--entity", type=str, default="products,prices,contracts")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    entities = [e.strip() for e in args.entity.split(",")]
+    frames = []
+    for path in sorted(glob.glob(os.path.join(args.src, "*.csv"))):
+        match = re.match(r"^\d{14}_(\w+)\.csv$", os.path.basename(path))
+        if match and match.group(1) in entities:
+            frames.append((os.path.basename(path), match.group(1), transform_data(path, match.group(1))))
+
+    load_id = "bench_" + datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    results = {}
+    for mode in LOAD_MODES:
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            for key, entity, df in frames:
+                load_to_staging(df, entity, key, f"{load_id}_{mode}", mode=mode)
+            timings.append(time.perf_counter() - started)
+        results[mode] = min(timings)
+
+    rows = sum(len(df) for _, _, df in frames)
+    print(f"\nФайлов: {len(frames)}, строк: {rows}, повторов: {args.repeat}")
+    print(f"{'mode':<8} {'best, s':>10} {'rows/s':>12}")
+    for mode, seconds in results.items():
+        print(f"{mode:<8} {seconds:>10.3f} {rows / seconds:>12.0f}")
+    print(f"copy быстрее to_sql в {results['to_sql'] / results['copy']:.1f} раз")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+# Сквозной замер конвейера без docker-compose: синтетические выгрузки (benchmarks.synthetic_exports)
+# или готовый каталог с CSV кладутся в локальную замену S3 (moto, если не задан --s3-endpoint),
+# затем по месяцам выполняются run_etl и цепочка sql/load_*.sql на PostgreSQL из POSTGRES_* переменных.
+# По каждому этапу печатаются время, строки/с и пиковый RSS процесса бенчмарка (без PostgreSQL).
+# Схемы dwh, staging, mart, staging-таблицы, load_log и load_rejects пересоздаются (--reset),
+# поэтому нужна отдельная база:
+#   createdb etl_bench
+#   POSTGRES_DB=etl_bench python -m benchmarks.bench_pipeline --reset --contracts 1000000 --workers 4
+#   POSTGRES_DB=etl_bench python -m benchmarks.bench_pipeline --reset --src ../minio_data/srcdatafiles --matchings ../matchings
+# Помесячная загрузка должна давать тот же dwh, что и загрузка всего диапазона:
+#   python -m benchmarks.bench_pipeline --reset --load-mode range --json range.json
+#   python -m benchmarks.bench_pipeline --reset --load-mode monthly --compare-json range.json
+import argparse
+import glob
+import gzip
+import json
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import text
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from benchmarks.synthetic_exports import generate_exports
+from etl.extract import compile_key_pattern
+from etl.schemas import STAGING_COLUMN_TYPES
+from etl.utils import zstd_module
+from etl.resources import get_engine, get_s3_client, dispose_resources
+from etl_main import run_etl
+
+ENTITIES = ("products", "prices", "contracts")
+
+# Цепочка DAG после create_staging_views; строки этапа — строки staging соответствующей сущности
+SQL_CHAIN = [
+    ("load_products.sql", "products", None),
+    ("load_prices.sql", "prices", None),
+    ("load_contracts.sql", "contracts", None),
+    ("load_price_periods.sql", "prices", None),
+    ("load_contracts_enriched.sql", "contracts", "etl.enriched_mode"),
+    ("load_marts.sql", "contracts", None),
+]
+
+
+def reset_peak_rss():
+    # Linux: запись "5" в clear_refs сбрасывает VmHWM, и пик считается отдельно для каждого этапа
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Без /proc — пик за всё время процесса (ru_maxrss в КБ на Linux, в байтах на macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+class StageTimer:
+    def __init__(self):
+        self.results = []
+
+    def run(self, stage: str, month: str, func, rows=None):
+        # rows — число или функция, вызываемая после этапа (например, подсчёт по load_log)
+        reset_peak_rss()
+        started = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - started
+        rows = rows() if callable(rows) else rows
+        result = {"stage": stage, "month": month, "seconds": seconds, "rows": rows, "peak_rss_mb": peak_rss_mb()}
+        self.results.append(result)
+        rate = f"{rows / seconds:,.0f} строк/с" if rows and seconds > 0 else "-"
+        print(f"[BENCH] {month} {stage}: {seconds:.2f} с, {rows if rows is not None else '-'} строк, {rate}, "
+              f"RSS {result['peak_rss_mb']:.0f} МБ")
+        return result
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_s3(endpoint: str = None):
+    # Без --s3-endpoint поднимается moto в отдельном потоке (pip install "moto[server]")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    if endpoint:
+        os.environ["MINIO_ENDPOINT"] = endpoint
+        return None
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        raise SystemExit("[BENCH] Нужен moto[server] для локального S3 либо --s3-endpoint (например, локальный MinIO)")
+    port = free_port()
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    os.environ["MINIO_ENDPOINT"] = f"http://127.0.0.1:{port}"
+    os.environ.setdefault("MINIO_ACCESS_KEY", "bench")
+    os.environ.setdefault("MINIO_SECRET_KEY", "bench")
+    return server
+
+
+def upload_exports(bucket: str, files: list):
+    s3 = get_s3_client()
+    try:
+        s3.head_bucket(Bucket=bucket)
+    except Exception:
+        s3.create_bucket(Bucket=bucket)
+    for path in files:
+        s3.upload_file(path, bucket, os.path.basename(path))
+
+
+def reset_database():
+    with get_engine().begin() as conn:
+        conn.execute(text("DROP SCHEMA IF EXISTS dwh CASCADE"))
+        conn.execute(text("DROP SCHEMA IF EXISTS mart CASCADE"))
+        conn.execute(text("DROP SCHEMA IF EXISTS staging CASCADE"))
+        tables = conn.execute(text("""
+            SELECT tablename FROM pg_tables
+            WHERE schemaname = 'public' AND (tablename LIKE '%\\_staging\\_%' OR tablename IN ('load_log', 'load_rejects'))
+        """)).scalars().all()
+        for table in tables:
+            conn.execute(text(f'DROP TABLE IF EXISTS public."{table}" CASCADE'))
+
+
+def run_script(sql_code: str, settings: dict = None):
+    # Как run_sql_file в DAG: весь скрипт в одной транзакции, настройки — set_config(..., is_local)
+    conn = get_engine().raw_connection()
+    try:
+        with conn.cursor() as cur:
+            for name, value in (settings or {}).items():
+                cur.execute("SELECT set_config(%s, %s, true)", (name, value))
+            cur.execute(sql_code)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def apply_migrations(sql_dir: str):
+    for path in sorted(glob.glob(os.path.join(sql_dir, "migrations", "*.sql"))):
+        with open(path) as f:
+            run_script(f.read())
+
+
+def create_staging_views(load_id: str):
+    # Упрощённый create_staging_views из DAG: таблицы (или секции) файлов этой загрузки по load_log
+    with get_engine().begin() as conn:
+        tables = conn.execute(text("""
+            SELECT DISTINCT entity, staging_table FROM load_log
+            WHERE load_id = :load_id AND status IN ('SUCCESS', 'SKIPPED') AND staging_table IS NOT NULL
+        """), {"load_id": load_id}).all()
+        conn.execute(text("CREATE SCHEMA IF NOT EXISTS staging"))
+        grouped = defaultdict(list)
+        for entity, table in tables:
+            grouped[entity].append(table)
+        for entity, columns in STAGING_COLUMN_TYPES.items():
+            parts = []
+            for table in sorted(grouped.get(entity, [])):
+                if conn.execute(text("SELECT to_regclass(:name)"), {"name": f'public."{table}"'}).scalar():
+                    casts = ", ".join(f"{col}::{dtype} AS {col}" for col, dtype in columns)
+                    parts.append(f"SELECT {casts}, '{table}'::text AS source_table FROM public.\"{table}\"")
+                else:
+                    column_list = ", ".join(col for col, _ in columns)
+                    parts.append(f"SELECT {column_list}, source_table FROM staging.{entity}_staging "
+                                 f"WHERE source_table = '{table}'")
+            if not parts:
+                nulls = ", ".join(f"NULL::{dtype} AS {col}" for col, dtype in columns)
+                parts.append(f"SELECT {nulls}, NULL::text AS source_table WHERE FALSE")
+            conn.execute(text(f"CREATE OR REPLACE VIEW staging.{entity}_staging_view AS "
+                              + "\nUNION ALL\n".join(parts)))
+
+
+def staging_rows(load_id: str) -> dict:
+    with get_engine().connect() as conn:
+        rows = conn.execute(text("""
+            SELECT entity, SUM(rows_loaded) FROM load_log
+            WHERE load_id = :load_id AND status IN ('SUCCESS', 'SKIPPED')
+            GROUP BY entity
+        """), {"load_id": load_id}).all()
+    return {entity: int(total or 0) for entity, total in rows}
+
+
+def export_files(src_dir: str) -> dict:
+    # {YYYYMM: [пути]} по именам YYYYMMDDHHMMSS_<entity>.csv[.gz|.zst], как их отбирает etl-runner
+    pattern = compile_key_pattern(ENTITIES)
+    months = defaultdict(list)
+    for path in sorted(glob.glob(os.path.join(src_dir, "*.csv*"))):
+        match = pattern.match(os.path.basename(path))
+        if match:
+            months[match.group(1)].append(path)
+    return dict(sorted(months.items()))
+
+
+def compress_exports(months: dict, out_dir: str, compression: str) -> dict:
+    # Сжатые копии выгрузок (.csv.gz / .csv.zst) для замера загрузки сжатых объектов
+    os.makedirs(out_dir, exist_ok=True)
+    compressed = {}
+    raw_bytes = packed_bytes = 0
+    for month, paths in months.items():
+        for path in paths:
+            if compression == "gzip":
+                out_path = os.path.join(out_dir, os.path.basename(path) + ".gz")
+                with open(path, "rb") as src, gzip.open(out_path, "wb", compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            else:
+                out_path = os.path.join(out_dir, os.path.basename(path) + ".zst")
+                with open(path, "rb") as src, open(out_path, "wb") as dst:
+                    zstd_module().ZstdCompressor(level=3).copy_stream(src, dst)
+            raw_bytes += os.path.getsize(path)
+            packed_bytes += os.path.getsize(out_path)
+            compressed.setdefault(month, []).append(out_path)
+    print(f"[BENCH] {compression}: {raw_bytes / 1e6:.1f} МБ -> {packed_bytes / 1e6:.1f} МБ "
+          f"(в {raw_bytes / max(packed_bytes, 1):.1f} раза)")
+    return compressed
+
+
+def dwh_checksums() -> dict:
+    # Содержимое dwh.contracts и dwh.contract_price_enriched без суррогатных ключей и служебных колонок
+    # (inserted_at, source_table с load_id): помесячная загрузка и загрузка всего диапазона одних и тех же
+    # выгрузок должны давать одинаковый результат (--compare-json). products, prices и price_periods
+    # хранят историю по загрузкам и между режимами законно различаются
+    checksums = {}
+    with get_engine().connect() as conn:
+        for table, excluded in (("contracts", ("contract_sk", "source_table", "inserted_at")),
+                                ("contract_price_enriched", ("inserted_at",))):
+            columns = conn.execute(text("""
+                SELECT string_agg(column_name, ', ' ORDER BY ordinal_position) FROM information_schema.columns
+                WHERE table_schema = 'dwh' AND table_name = :table AND column_name <> ALL(:excluded)
+            """), {"table": table, "excluded": list(excluded)}).scalar()
+            rows, digest = conn.execute(text(f"""
+                SELECT COUNT(*), md5(COALESCE(string_agg(t::text, '|' ORDER BY t::text), ''))
+                FROM (SELECT {columns} FROM dwh.{table}) t
+            """)).one()
+            checksums[table] = {"rows": rows, "md5": digest}
+        revenue = conn.execute(text("SELECT SUM(revenue) FROM dwh.contract_price_enriched")).scalar()
+        checksums["contract_price_enriched"]["revenue"] = float(revenue or 0)
+    for table, values in checksums.items():
+        print(f"[BENCH] dwh.{table}: {values}")
+    return checksums
+
+
+def compare_checksums(checksums: dict, path: str) -> bool:
+    with open(path) as f:
+        expected = json.load(f).get("checksums") or {}
+    differences = {table: (expected.get(table), values) for table, values in checksums.items()
+                   if expected.get(table) != values}
+    if differences:
+        for table, (was, now) in differences.items():
+            print(f"[BENCH] ❌ dwh.{table} расходится с {path}: было {was}, стало {now}")
+        return False
+    print(f"[BENCH] ✅ dwh совпадает с {path}")
+    return True
+
+
+def print_summary(results: list, total_seconds: float):
+    stages = {}
+    for result in results:
+        stage = stages.setdefault(result["stage"], {"seconds": 0.0, "rows": 0, "peak_rss_mb": 0.0})
+        stage["seconds"] += result["seconds"]
+        stage["rows"] += result["rows"] or 0
+        stage["peak_rss_mb"] = max(stage["peak_rss_mb"], result["peak_rss_mb"])
+    print(f"\n{'stage':<30} {'seconds':>10} {'rows':>12} {'rows/s':>12} {'peak RSS, MB':>14}")
+    for name, stage in stages.items():
+        rate = f"{stage['rows'] / stage['seconds']:,.0f}" if stage["rows"] and stage["seconds"] > 0 else "-"
+        print(f"{name:<30} {stage['seconds']:>10.2f} {stage['rows'] or '-':>12} {rate:>12} "
+              f"{stage['peak_rss_mb']:>14.0f}")
+    print(f"{'total (run_etl + SQL)':<30} {total_seconds:>10.2f}")
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contracts", type=int, default=30000, help="контрактов в последнем слепке")
+    parser.add_argument("--months", type=int, default=4)
+    parser.add_argument("--start-month", type=str, default="202010")
+    parser.add_argument("--products", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--src", type=str, help="готовые выгрузки вместо генерации")
+    parser.add_argument("--matchings", type=str, help="matching-файлы к --src")
+    parser.add_argument("--work-dir", type=str, help="каталог для сгенерированных файлов (по умолчанию временный)")
+    parser.add_argument("--s3-endpoint", type=str, help="существующий S3/MinIO вместо moto")
+    parser.add_argument("--bucket", type=str, default="srcdata")
+    parser.add_argument("--load-mode", choices=["monthly", "range"], default="monthly",
+                        help="monthly — загрузка и SQL по каждому месяцу, как LOAD_MODE=monthly в DAG")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("ETL_WORKERS", "1")))
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--compress", choices=["gzip", "zstd"], help="загружать в S3 сжатые выгрузки")
+    parser.add_argument("--enriched-mode", choices=["incremental", "full"], default="incremental")
+    parser.add_argument("--skip-sql", action="store_true", help="только run_etl")
+    parser.add_argument("--reset", action="store_true",
+                        help="пересоздать dwh, staging, mart, staging-таблицы, load_log и load_rejects")
+    parser.add_argument("--json", type=str, help="сохранить результаты этапов в JSON для сравнения прогонов")
+    parser.add_argument("--compare-json", type=str,
+                        help="сверить dwh с контрольными суммами прошлого прогона (например, --load-mode range)")
+    args = parser.parse_args()
+
+    sql_dir = os.path.join(ROOT, "sql")
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="etl_bench_")
+    timer = StageTimer()
+    server = None
+    try:
+        with get_engine().connect() as conn:
+            has_dwh = conn.execute(text("SELECT to_regnamespace('dwh')")).scalar() is not None
+        if has_dwh and not args.reset:
+            raise SystemExit("[BENCH] В базе уже есть схема dwh: укажите отдельную базу (POSTGRES_DB) и --reset")
+        if args.reset:
+            reset_database()
+
+        if args.src:
+            src_dir = args.src
+            os.environ["MATCHING_DIR"] = args.matchings or os.path.join(ROOT, "matchings")
+        else:
+            src_dir = os.path.join(work_dir, "src")
+            os.environ["MATCHING_DIR"] = os.path.join(work_dir, "matchings")
+            timer.run("generate", "all", lambda: generate_exports(
+                src_dir, os.environ["MATCHING_DIR"], args.contracts, args.months, args.start_month, args.products,
+                args.seed
+            ))
+        months = export_files(src_dir)
+        if not months:
+            raise SystemExit(f"[BENCH] В {src_dir} нет выгрузок YYYYMMDDHHMMSS_<entity>.csv")
+        if args.compress:
+            months = compress_exports(months, os.path.join(work_dir, args.compress), args.compress)
+
+        server = start_s3(args.s3_endpoint)
+        os.environ["MINIO_BUCKET"] = args.bucket
+        os.environ.pop("ETL_LIST_MANIFEST", None)
+        all_files = [path for paths in months.values() for path in paths]
+        timer.run("upload", "all", lambda: upload_exports(args.bucket, all_files))
+
+        if not args.skip_sql:
+            timer.run("migrations", "all", lambda: apply_migrations(sql_dir))
+
+        if args.load_mode == "monthly":
+            batches = [(month, month) for month in months]
+        else:
+            batches = [(min(months), max(months))]
+        stamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+        pipeline_started = time.perf_counter()
+        for i, (start_month, end_month) in enumerate(batches):
+            label = start_month if start_month == end_month else f"{start_month}-{end_month}"
+            load_id = f"{stamp}{i:03d}"
+            timer.run("run_etl", label, lambda: run_etl(
+                ",".join(ENTITIES), start_month, end_month, load_id, stream=args.stream, workers=args.workers
+            ), rows=lambda: sum(staging_rows(load_id).values()))
+            if args.skip_sql:
+                continue
+            rows = staging_rows(load_id)
+            timer.run("create_staging_views", label, lambda: create_staging_views(load_id))
+            for script, entity, setting in SQL_CHAIN:
+                with open(os.path.join(sql_dir, script)) as f:
+                    sql_code = f.read()
+                settings = {setting: args.enriched_mode} if setting else None
+                timer.run(script, label, lambda: run_script(sql_code, settings), rows=rows.get(entity, 0))
+        total_seconds = time.perf_counter() - pipeline_started
+
+        stages = print_summary([r for r in timer.results if r["stage"] not in ("generate", "upload", "migrations")],
+                               total_seconds)
+        checksums = None if args.skip_sql else dwh_checksums()
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({
+                    "args": vars(args),
+                    "total_seconds": total_seconds,
+                    "stages": stages,
+                    "results": timer.results,
+                    "checksums": checksums
+                }, f, indent=2, ensure_ascii=False)
+            print(f"[BENCH] Результаты записаны в {args.json}")
+        if args.compare_json and checksums and not compare_checksums(checksums, args.compare_json):
+            raise SystemExit(1)
+    finally:
+        dispose_resources()
+        if server:
+            server.stop()
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
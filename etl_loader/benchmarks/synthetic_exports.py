@@ -0,0 +1,290 @@
+# Генератор синтетических выгрузок products/prices/contracts в формате источника: имена
+# YYYYMMDDHHMMSS_<entity>.csv, разделитель ';', текст и даты в кавычках, пустые значения как "",
+# заголовки с расхождениями, которые разрешают matching-файлы (productcomponent вместо pricecomponent,
+# fillingdatecancellation вместо filingdatecancellation, products без releasedversion), и сами matching-файлы.
+# Каждый месяц — полный слепок на первое число: появляются новые контракты, часть старых расторгается
+# или отменяется, у продуктов объявляются новые ценовые периоды. Одинаковые параметры дают одинаковые файлы.
+# Запуск из каталога etl_loader:
+#   python -m benchmarks.synthetic_exports --out /tmp/etl_bench --contracts 1000000 --months 4
+import argparse
+import csv
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from etl.utils import ensure_dir
+
+# Время выгрузки в имени файла: ключи одного месяца идут в том же порядке, что и в minio_data
+EXPORT_TIMES = {"products": "220037", "prices": "220039", "contracts": "220144"}
+
+# Заголовки выгрузок в порядке колонок источника
+EXPORT_COLUMNS = {
+    "products": ["id", "productcode", "productname", "energy", "consumptiontype", "deleted", "modificationdate"],
+    "prices": ["id", "productid", "pricecomponentid", "productcomponent", "price", "unit", "valid_from",
+               "valid_until", "modificationdate"],
+    "contracts": ["id", "type", "energy", "usage", "usagenet", "createdat", "startdate", "enddate",
+                  "fillingdatecancellation", "cancellationreason", "city", "status", "productid",
+                  "modificationdate"]
+}
+
+# Правила matching-файлов, как в каталоге matchings
+MATCHING_RULES = {
+    "products": {"releasedversion": {"suggested": None, "user_submitted": 0, "pass_as_null": 1}},
+    "prices": {"pricecomponent": {"suggested": "productcomponent", "user_submitted": 1, "pass_as_null": 0}},
+    "contracts": {"filingdatecancellation": {"suggested": "fillingdatecancellation", "user_submitted": 1,
+                                             "pass_as_null": 0}}
+}
+
+CITIES = ["Berlin", "Hamburg", "Munich", "Cologne", "Frankfurt", "Stuttgart", "Dortmund", "Düsseldorf",
+          "Wuppertal", "Leipzig", "Dresden", "Würzburg", "Gera", "Bremen"]
+CITY_WEIGHTS = np.array([14, 8, 6, 4.5, 3.2, 2.8, 2.8, 2.7, 2, 2, 2, 1, 1, 2])
+CANCELLATION_REASONS = ["fristgerecht durch Kunde", "Umzug", "fristgerecht durch LichtBlick", "Wiederruf"]
+
+CONTRACTS_FROM = np.datetime64("2018-01-01")
+PRICES_FROM = np.datetime64("2019-01-01")
+OPEN_END = "9999-12-31"
+
+
+def export_key(month: str, entity: str) -> str:
+    return f"{month}01{EXPORT_TIMES[entity]}_{entity}.csv"
+
+
+def month_start(month: str) -> np.datetime64:
+    return np.datetime64(f"{month[:4]}-{month[4:]}-01")
+
+
+def export_months(start_month: str, months: int) -> list:
+    first = np.datetime64(f"{start_month[:4]}-{start_month[4:]}", "M")
+    return [str(first + i).replace("-", "") for i in range(months)]
+
+
+def first_of_next_month(dates: np.ndarray, months_ahead=1) -> np.ndarray:
+    return (dates.astype("datetime64[M]") + months_ahead).astype("datetime64[D]")
+
+
+def date_text(dates: np.ndarray, present: np.ndarray = None) -> np.ndarray:
+    # Отсутствующие даты выгружаются пустой строкой в кавычках
+    text = dates.astype("datetime64[D]").astype(str).astype(object)
+    if present is not None:
+        text[~present] = ""
+    return text
+
+
+def write_export(df: pd.DataFrame, path: str, header: bool):
+    # QUOTE_NONNUMERIC: числа без кавычек, текст, даты и пустые значения — в кавычках, как в источнике
+    df.to_csv(path, sep=";", index=False, header=header, mode="w" if header else "a",
+              quoting=csv.QUOTE_NONNUMERIC, na_rep="")
+
+
+def write_matching(matching_dir: str, key: str, entity: str):
+    path = os.path.join(matching_dir, f"matching_{key.replace('.csv', '.json')}")
+    with open(path, "w") as f:
+        json.dump({"__delimiter__": ";", **MATCHING_RULES[entity]}, f, indent=2, ensure_ascii=False)
+
+
+def product_catalog(products: int) -> pd.DataFrame:
+    # Примерно 3/5 электричество (id с 1000), остальное газ (id с 2000), как в исходных выгрузках
+    electricity = max(1, round(products * 0.6))
+    gas = max(1, products - electricity)
+    rows = [(1000 + i, f"ÖkoStrom {i + 1}", "electricity", "household_electricity") for i in range(electricity)]
+    rows += [(2000 + i, f"ÖkoGas {i + 1}", "gas", "universal") for i in range(gas)]
+    return pd.DataFrame(rows, columns=["id", "productname", "energy", "consumptiontype"])
+
+
+def products_frame(catalog: pd.DataFrame, as_of: np.datetime64) -> pd.DataFrame:
+    df = catalog.copy()
+    df["productcode"] = "energy"
+    df["deleted"] = 0
+    df["modificationdate"] = str(as_of - 3)
+    return df[EXPORT_COLUMNS["products"]]
+
+
+def price_periods(catalog: pd.DataFrame, month_list: list, rng) -> pd.DataFrame:
+    # Периоды начинаются с первого числа месяца. У каждого продукта период с 2019-01-01 и, возможно,
+    # одна смена цен до первой выгрузки; перед каждой выгрузкой один из продуктов объявляет новый период
+    # на один-два месяца вперёд. Объявление (modificationdate) — за одну-три недели до выгрузки,
+    # с этого момента прошлый период получает valid_until
+    first_export = month_start(month_list[0]).astype("datetime64[M]")
+    history = int((first_export - PRICES_FROM.astype("datetime64[M]")).astype(int))
+    starts = {product_id: [PRICES_FROM] for product_id in catalog["id"]}
+    for product_id in catalog["id"]:
+        if history > 6 and rng.random() < 0.5:
+            starts[product_id].append((PRICES_FROM.astype("datetime64[M]")
+                                       + int(rng.integers(6, history))).astype("datetime64[D]"))
+    announced_at = {}
+    for month in month_list:
+        start = (month_start(month).astype("datetime64[M]") + int(rng.integers(1, 3))).astype("datetime64[D]")
+        candidates = [product_id for product_id in catalog["id"] if start > starts[product_id][-1]]
+        if candidates:
+            product_id = candidates[rng.integers(len(candidates))]
+            starts[product_id].append(start)
+            announced_at[(product_id, start)] = month_start(month) - int(rng.integers(7, 22))
+
+    periods = []
+    for product_id, energy in zip(catalog["id"], catalog["energy"]):
+        base, working = (8.5, 29.0) if energy == "electricity" else (13.5, 4.9)
+        for start in starts[product_id]:
+            base = round(base + rng.uniform(0, 0.8), 2)
+            working = round(working + rng.uniform(-0.3, 0.5), 2)
+            announced = announced_at.get((product_id, start), start - int(rng.integers(7, 15)))
+            for component_id, component, price, unit in ((1, "baseprice", base, "€/year"),
+                                                         (2, "workingprice", working, "ct/kwh")):
+                periods.append((product_id, component_id, component, price, unit, start, announced))
+    df = pd.DataFrame(periods, columns=["productid", "pricecomponentid", "productcomponent", "price", "unit",
+                                        "valid_from", "announced"])
+    df = df.sort_values(["announced", "productid", "pricecomponentid"], kind="stable").reset_index(drop=True)
+    df.insert(0, "id", np.arange(1, len(df) + 1))
+    return df
+
+
+def prices_frame(periods: pd.DataFrame, as_of: np.datetime64) -> pd.DataFrame:
+    df = periods[periods["announced"] < as_of].copy()
+    df = df.sort_values(["productid", "pricecomponentid", "valid_from"], kind="stable")
+    next_start = df.groupby(["productid", "pricecomponentid"])["valid_from"].shift(-1)
+    valid_until = pd.to_datetime(next_start) - pd.Timedelta(days=1)
+    df["valid_until"] = valid_until.dt.strftime("%Y-%m-%d").fillna(OPEN_END)
+    df["valid_from"] = pd.to_datetime(df["valid_from"]).dt.strftime("%Y-%m-%d")
+    # Дата изменения строки — объявление следующего периода, если он уже объявлен
+    next_announced = df.groupby(["productid", "pricecomponentid"])["announced"].shift(-1)
+    df["modificationdate"] = pd.to_datetime(next_announced.fillna(df["announced"])).dt.strftime("%Y-%m-%d")
+    return df.sort_values("id")[EXPORT_COLUMNS["prices"]]
+
+
+def contract_chunk(first_id: int, size: int, total: int, catalog: pd.DataFrame, seed: int,
+                   created_to: np.datetime64) -> dict:
+    # Атрибуты контрактов [first_id, first_id + size) не зависят от месяца выгрузки: генератор
+    # инициализируется номером куска, поэтому слепки разных месяцев согласованы без хранения всех контрактов
+    rng = np.random.default_rng([seed, first_id])
+    ids = np.arange(first_id, first_id + size)
+    span = int((created_to - CONTRACTS_FROM).astype(int))
+    # createdat растёт вместе с id: новые контракты дописываются в конец выгрузки
+    offsets = (ids - 1) / total * span + rng.integers(-10, 11, size)
+    createdat = CONTRACTS_FROM + np.clip(offsets, 0, span - 1).astype("timedelta64[D]")
+    startdate = first_of_next_month(createdat, 1 + np.minimum(rng.geometric(0.45, size) - 1, 12))
+
+    electricity = catalog[catalog["energy"] == "electricity"]["id"].to_numpy()
+    gas = catalog[catalog["energy"] == "gas"]["id"].to_numpy()
+    is_gas = rng.random(size) < 0.15
+    productid = np.where(is_gas, rng.choice(gas, size), rng.choice(electricity, size))
+    usage = np.where(is_gas, rng.normal(12000, 3000, size).clip(3000), rng.normal(2500, 300, size).clip(1200))
+    usage = np.round(usage, -2)
+    # Изредка дробное потребление, как в реальных выгрузках
+    fractional = rng.random(size) < 0.004
+    usage = np.where(fractional, usage * rng.uniform(0.9, 1.1, size), usage)
+    usagenet = np.round(usage * rng.uniform(0.93, 1.07, size))
+    usagenet_present = rng.random(size) >= 0.07
+
+    # Судьба контракта: ~14% расторгаются, ~3% отменяются; дата подачи — от начала поставки
+    fate = rng.random(size)
+    cancelled = fate < 0.03
+    terminated = (fate >= 0.03) & (fate < 0.17)
+    filing = startdate + rng.integers(-60, 900, size).astype("timedelta64[D]")
+    filing = np.maximum(filing, createdat + np.timedelta64(1, "D"))
+    enddate = first_of_next_month(filing, 1 + rng.integers(0, 3, size)) - np.timedelta64(1, "D")
+
+    return {
+        "id": ids,
+        "energy": np.where(is_gas, "gas", "electricity"),
+        "usage": usage,
+        "usagenet": usagenet,
+        "usagenet_present": usagenet_present,
+        "createdat": createdat,
+        "startdate": startdate,
+        "filing": filing,
+        "enddate": enddate,
+        "ends": cancelled | terminated,
+        "cancelled": cancelled,
+        "reason": rng.choice(CANCELLATION_REASONS, size),
+        "city": rng.choice(CITIES, size, p=CITY_WEIGHTS / CITY_WEIGHTS.sum()),
+        "productid": productid,
+        "touched": createdat + rng.integers(0, 15, size).astype("timedelta64[D]")
+    }
+
+
+def contracts_frame(chunk: dict, as_of: np.datetime64) -> pd.DataFrame:
+    visible = chunk["createdat"] < as_of
+    c = {name: values[visible] for name, values in chunk.items()}
+    filed = c["ends"] & (c["filing"] < as_of)
+    status = np.where(c["startdate"] > as_of, "active", "indelivery").astype(object)
+    status[filed & c["cancelled"]] = "cancelled"
+    status[filed & ~c["cancelled"]] = "terminated"
+
+    usage = pd.Series(c["usage"].astype(np.int64), dtype=object)
+    fractional = c["usage"] != np.floor(c["usage"])
+    usage[fractional] = c["usage"][fractional]
+    modification = np.minimum(np.where(filed, c["filing"], c["touched"]), as_of - np.timedelta64(1, "D"))
+
+    return pd.DataFrame({
+        "id": c["id"],
+        "type": "energy",
+        "energy": c["energy"],
+        "usage": usage,
+        "usagenet": pd.array(np.where(c["usagenet_present"], c["usagenet"], np.nan), dtype="Int64"),
+        "createdat": date_text(c["createdat"]),
+        "startdate": date_text(c["startdate"]),
+        "enddate": date_text(c["enddate"], filed),
+        "fillingdatecancellation": date_text(c["filing"], filed),
+        "cancellationreason": np.where(filed, c["reason"], "").astype(object),
+        "city": c["city"],
+        "status": status,
+        "productid": c["productid"],
+        "modificationdate": date_text(modification)
+    })
+
+
+def generate_exports(out_dir: str, matching_dir: str, contracts: int = 30000, months: int = 4,
+                     start_month: str = "202010", products: int = 5, seed: int = 42,
+                     chunk_size: int = 500000) -> list:
+    # Возвращает [{"key", "entity", "month", "rows", "size"}] в порядке ключей
+    ensure_dir(out_dir)
+    ensure_dir(matching_dir)
+    month_list = export_months(start_month, months)
+    last_export = month_start(month_list[-1])
+    rng = np.random.default_rng(seed)
+    catalog = product_catalog(products)
+    periods = price_periods(catalog, month_list, rng)
+
+    exports = []
+    for month in month_list:
+        as_of = month_start(month)
+        frames = {
+            "products": [products_frame(catalog, as_of)],
+            "prices": [prices_frame(periods, as_of)],
+            # Контракты пишутся кусками, чтобы 10M строк не держать в памяти
+            "contracts": (
+                contracts_frame(contract_chunk(first_id, min(chunk_size, contracts - first_id + 1), contracts,
+                                               catalog, seed, last_export), as_of)
+                for first_id in range(1, contracts + 1, chunk_size)
+            )
+        }
+        for entity, entity_frames in frames.items():
+            key = export_key(month, entity)
+            path = os.path.join(out_dir, key)
+            rows = 0
+            for i, df in enumerate(entity_frames):
+                write_export(df, path, header=i == 0)
+                rows += len(df)
+            write_matching(matching_dir, key, entity)
+            exports.append({"key": key, "entity": entity, "month": month, "rows": rows,
+                            "size": os.path.getsize(path)})
+            print(f"[BENCH] {key}: {rows} строк, {os.path.getsize(path) / 1024 / 1024:.1f} МБ")
+    return sorted(exports, key=lambda e: e["key"])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", type=str, required=True, help="каталог для src/ и matchings/")
+    parser.add_argument("--contracts", type=int, default=30000, help="контрактов в последнем слепке")
+    parser.add_argument("--months", type=int, default=4)
+    parser.add_argument("--start-month", type=str, default="202010")
+    parser.add_argument("--products", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    generate_exports(os.path.join(args.out, "src"), os.path.join(args.out, "matchings"), args.contracts,
+                     args.months, args.start_month, args.products, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,168 @@
-import boto3
 import os
+import fcntl
+import json
+import uuid
+from contextlib import contextmanager
 from typing import List
 import re
+from etl.utils import ensure_dir, iter_months, strip_compression_suffix, COMPRESSION_SUFFIXES
+from etl.resources import get_s3_client
+from etl.metrics import stage_span, debug, debug_enabled
 
-def get_s3_client():
-    return boto3.client(
-        "s3",
-        endpoint_url=os.getenv("MINIO_ENDPOINT"),
-        aws_access_key_id=os.getenv("MINIO_ACCESS_KEY"),
-        aws_secret_access_key=os.getenv("MINIO_SECRET_KEY")
-    )
+def compile_key_pattern(entities: List[str]):
+    # Один регэксп на все сущности запуска вместо re.match на каждую пару (ключ, сущность).
+    # Выгрузки могут быть сжаты: .csv.gz / .csv.zst (см. etl.utils.COMPRESSION_SUFFIXES)
+    names = "|".join(re.escape(ent) for ent in entities)
+    suffixes = "|".join(re.escape(suffix) for suffix in COMPRESSION_SUFFIXES)
+    return re.compile(r"^(\d{6})\d{8}_(" + names + r")\.csv(?:" + suffixes + r")?$")
 
-def list_matching_objects(bucket: str, entity: str, start: str, end: str) -> List[str]:
-    print(f"[DEBUG] list_matching_objects(bucket={bucket}, entity={entity}, start={start}, end={end})")
-    s3 = get_s3_client()
 
-    # Проверка подключения
+def load_list_manifest(path: str) -> dict:
+    if not path or not os.path.exists(path):
+        return {}
     try:
-        s3.head_bucket(Bucket=bucket)
-        print("[DEBUG] ✅ Доступ к S3 получен")
+        with open(path) as f:
+            return json.load(f)
     except Exception as e:
-        print(f"[DEBUG] ❌ Ошибка доступа к S3: {e}")
-        raise
-
-    response = s3.list_objects_v2(Bucket=bucket)
-    matching_files = []
-
-    entities = [e.strip() for e in entity.split(",")]
-
-    for obj in response.get("Contents", []):
-        key = obj["Key"]
-        for ent in entities:
-            pattern = r"^(\d{6})\d{8}_" + re.escape(ent) + r"\.csv$"
-            match = re.match(pattern, key)
-            if match:
-                yyyymm = match.group(1)
-                if start <= yyyymm <= end:
-                    print(f"[DEBUG] ✅ Файл подходит: {key}")
-                    matching_files.append(key)
-                else:
-                    print(f"[DEBUG] ⏩ Пропуск {key} — {yyyymm} не в диапазоне")
-    return matching_files
-
-
-def download_file(bucket: str, key: str, dest_path: str):
+        print(f"[DEBUG] ⚠ Не удалось прочитать manifest листинга {path}: {e}")
+        return {}
+
+
+def save_list_manifest(path: str, manifest: dict):
+    ensure_dir(os.path.dirname(path) or ".")
+    # Уникальное имя временного файла: параллельные задания не подменяют и не удаляют чужой .tmp
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def locked_list_manifest(path: str):
+    # Один файл manifest обновляют параллельные задания (пул etl-runner, развёрнутые задачи DAG):
+    # чтение, изменение и запись идут под блокировкой файла, иначе задания затирают месяцы друг друга
+    ensure_dir(os.path.dirname(path) or ".")
+    with open(f"{path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            manifest = load_list_manifest(path)
+            yield manifest
+            save_list_manifest(path, manifest)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def list_month_objects(s3, bucket: str, month: str) -> List[dict]:
+    # Серверная фильтрация по префиксу YYYYMM + пагинация (list_objects_v2 отдаёт максимум 1000 ключей)
+    objects = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=month):
+        for obj in page.get("Contents", []):
+            objects.append({
+                "key": obj["Key"],
+                "etag": obj.get("ETag", "").strip('"'),
+                "size": obj.get("Size"),
+                "last_modified": obj["LastModified"].isoformat() if obj.get("LastModified") else None
+            })
+    return objects
+
+
+def diff_month_manifest(previous: dict, objects: dict) -> dict:
+    # Что изменилось в месяце с прошлого листинга: новые, перезаписанные (другой ETag или размер) и удалённые ключи
+    return {
+        "new": sorted(key for key in objects if key not in previous),
+        "changed": sorted(key for key, obj in objects.items() if key in previous and (
+            obj.get("etag"), obj.get("size")) != (previous[key].get("etag"), previous[key].get("size"))),
+        "deleted": sorted(key for key in previous if key not in objects)
+    }
+
+
+def pick_export_version(name: str, candidates: List[dict]) -> dict:
+    # X.csv, X.csv.gz и X.csv.zst — одна выгрузка: staging-таблица, секция и matching-файл у них общие,
+    # поэтому загружается только одна версия — записанная последней (при равенстве — по ключу)
+    if len(candidates) == 1:
+        return candidates[0]
+    chosen = max(candidates, key=lambda obj: (obj.get("last_modified") or "", obj["key"]))
+    print(f"[DEBUG] ⚠ Выгрузка {name} лежит в нескольких вариантах {[obj['key'] for obj in candidates]}, "
+          f"загружается {chosen['key']}")
+    return chosen
+
+
+def list_matching_object_infos(bucket: str, entity: str, start: str, end: str) -> List[dict]:
+    debug(f"[DEBUG] list_matching_objects(bucket={bucket}, entity={entity}, start={start}, end={end})")
+    with stage_span("list", entity=entity, start=start, end=end) as span:
+        s3 = get_s3_client()
+
+        # Проверка подключения
+        try:
+            s3.head_bucket(Bucket=bucket)
+            print("[DEBUG] ✅ Доступ к S3 получен")
+        except Exception as e:
+            print(f"[DEBUG] ❌ Ошибка доступа к S3: {e}")
+            raise
+
+        entities = [e.strip() for e in entity.split(",")]
+        pattern = compile_key_pattern(entities)
+        matching_files = []
+        listed_months = {}
+
+        # Каждый месяц листингуется целиком по префиксу: перезаписанный объект сохраняет ключ, а удалённый
+        # исчезает, поэтому ETag и размер для пропуска неизменившихся файлов (load_log) берутся только из
+        # свежего листинга, а не из manifest
+        for month in iter_months(start, end):
+            objects = {obj["key"]: {k: v for k, v in obj.items() if k != "key"}
+                       for obj in list_month_objects(s3, bucket, month)}
+            listed_months[month] = objects
+            exports = {}
+            for key in sorted(objects):
+                match = pattern.match(key)
+                if match:
+                    debug(f"[DEBUG] ✅ Файл подходит: {key}")
+                    exports.setdefault(strip_compression_suffix(key), []).append(
+                        {"key": key, "entity": match.group(2), **objects[key]})
+            for name, candidates in exports.items():
+                matching_files.append(pick_export_version(name, candidates))
+
+        # Необязательный manifest (ETL_LIST_MANIFEST) — журнал листингов по месяцам с ETag:
+        # по нему видно, какие ключи появились, перезаписаны или удалены с прошлого запуска
+        manifest_path = os.getenv("ETL_LIST_MANIFEST")
+        if manifest_path:
+            with locked_list_manifest(manifest_path) as manifest:
+                bucket_manifest = manifest.setdefault(bucket, {})
+                for month, objects in listed_months.items():
+                    previous = bucket_manifest.get(month, {}).get("objects", {})
+                    changes = diff_month_manifest(previous, objects)
+                    if previous and any(changes.values()):
+                        print(f"[DEBUG] Месяц {month} изменился с прошлого листинга: "
+                              + ", ".join(f"{kind} {len(keys)}" for kind, keys in changes.items() if keys)
+                              + (f" {changes}" if debug_enabled() else ""))
+                    bucket_manifest[month] = {"objects": objects}
+
+        span["rows"] = len(matching_files)
+        span["bytes"] = sum(obj.get("size") or 0 for obj in matching_files)
+        return matching_files
+
+
+def list_matching_objects(bucket: str, entity: str, start: str, end: str) -> List[str]:
+    return [obj["key"] for obj in list_matching_object_infos(bucket, entity, start, end)]
+
+
+def download_file(bucket: str, key: str, dest_path: str, entity: str = None):
+    with stage_span("download", entity=entity, key=key) as span:
+        s3 = get_s3_client()
+        s3.download_file(bucket, key, dest_path)
+        span["bytes"] = os.path.getsize(dest_path)
+
+
+def open_object_stream(bucket: str, key: str):
+    # Тело объекта без записи во временный файл (botocore StreamingBody)
     s3 = get_s3_client()
-    s3.download_file(bucket, key, dest_path)
\ No newline at end of file
+    return s3.get_object(Bucket=bucket, Key=key)["Body"]
+
+
+def iter_chunks(body, chunk_size: int = None):
+    chunk_size = chunk_size or int(os.getenv("ETL_STREAM_CHUNK_SIZE", str(1024 * 1024)))
+    while True:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
@@ -0,0 +1,121 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+
+class ETLJob:
+    """Состояние одного запуска run_etl внутри etl-runner (для /runs/{id})."""
+
+    def __init__(self, entity: str, start_month: str, end_month: str, load_id: str):
+        self.job_id = uuid.uuid4().hex
+        self.entity = entity
+        self.start_month = start_month
+        self.end_month = end_month
+        self.load_id = load_id
+        self.status = "queued"
+        self.files_total = 0
+        self.files_done = 0
+        self.files_failed = 0
+        self.files_skipped = 0
+        self.rows_loaded = 0
+        self.bytes_loaded = 0
+        self.failed_files = {}
+        self.error = None
+        self.created_at = datetime.utcnow()
+        self.started_at = None
+        self.finished_at = None
+        self._started = None
+        self._finished = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.status = "running"
+            self.started_at = datetime.utcnow()
+            self._started = time.perf_counter()
+
+    def set_files_total(self, files_total: int):
+        with self._lock:
+            self.files_total = files_total
+
+    def file_done(self, key: str, rows: int, size: int = None):
+        with self._lock:
+            self.files_done += 1
+            self.rows_loaded += rows or 0
+            self.bytes_loaded += size or 0
+
+    def file_skipped(self, key: str):
+        with self._lock:
+            self.files_skipped += 1
+
+    def file_failed(self, key: str, error: str):
+        with self._lock:
+            self.files_failed += 1
+            self.failed_files[key] = error
+
+    def finish(self, error: str = None):
+        with self._lock:
+            self.status = "failed" if error else "success"
+            self.error = error
+            self.finished_at = datetime.utcnow()
+            self._finished = time.perf_counter()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("success", "failed")
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            if self._started is None:
+                duration = None
+            else:
+                duration = round((self._finished or time.perf_counter()) - self._started, 3)
+            return {
+                "job_id": self.job_id,
+                "entity": self.entity,
+                "start_month": self.start_month,
+                "end_month": self.end_month,
+                "load_id": self.load_id,
+                "status": self.status,
+                "files_total": self.files_total,
+                "files_done": self.files_done,
+                "files_failed": self.files_failed,
+                "files_skipped": self.files_skipped,
+                "rows_loaded": self.rows_loaded,
+                "bytes_loaded": self.bytes_loaded,
+                "failed_files": dict(self.failed_files),
+                "error": self.error,
+                "created_at": self.created_at.isoformat(),
+                "started_at": self.started_at.isoformat() if self.started_at else None,
+                "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+                "duration_s": duration
+            }
+
+
+class JobRegistry:
+    """Хранит последние max_jobs запусков; самые старые завершённые вытесняются."""
+
+    def __init__(self, max_jobs: int = 200):
+        self._jobs = OrderedDict()
+        self._max_jobs = max_jobs
+        self._lock = threading.Lock()
+
+    def add(self, job: ETLJob) -> ETLJob:
+        with self._lock:
+            self._jobs[job.job_id] = job
+            for job_id in list(self._jobs):
+                if len(self._jobs) <= self._max_jobs:
+                    break
+                if self._jobs[job_id].finished:
+                    del self._jobs[job_id]
+        return job
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
@@ -1,44 +1,373 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 import pandas as pd
+import io
 import os
+import threading
+from datetime import datetime, timezone
+from etl.schemas import STAGING_COLUMN_TYPES, INTEGER_TYPES
+from etl.resources import get_engine
+from etl.metrics import stage_span, debug
 
-def load_to_staging(df: pd.DataFrame, entity: str, file: str, load_id: str):
-    host = os.getenv("POSTGRES_HOST", "localhost")
-    port = os.getenv("POSTGRES_PORT", "5432")
-    db = os.getenv("POSTGRES_DB", "etldb")
-    user = os.getenv("POSTGRES_USER", "etluser")
-    password = os.getenv("POSTGRES_PASSWORD", "etlpass")
+# Режим загрузки в staging: "copy" (COPY FROM STDIN) или "to_sql" (построчные INSERT через pandas)
+LOAD_MODES = ("copy", "to_sql")
 
-    url = f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{db}"
-    engine = create_engine(url)
+# Раскладка staging: "per_file" — отдельная таблица public."<file>_staging_<load_id>" на каждый файл,
+# "partitioned" — одна типизированная таблица staging.<entity>_staging, LIST-секционированная по source_table
+TABLE_MODES = ("per_file", "partitioned")
 
-    filename = os.path.splitext(os.path.basename(file))[0]
-    table_name = f"{filename}_staging_{load_id}"
+_load_log_ready = False
+_load_rejects_ready = False
+_load_log_lock = threading.Lock()
+_partitioned_ready = set()
+_partitioned_lock = threading.Lock()
 
-    print(f"[DEBUG] Подключение к PostgreSQL: {url}")
-    print(f"[DEBUG] Загружаем {len(df)} строк в таблицу {table_name} из файла {file}")
+
+def staging_table_name(file: str, load_id: str) -> str:
+    filename = os.path.basename(file)
+    filename = filename[:filename.index(".")] if "." in filename else filename
+    return f"{filename}_staging_{load_id}"
+
+
+def staging_table_mode() -> str:
+    mode = os.getenv("STAGING_TABLE_MODE", "per_file")
+    if mode not in TABLE_MODES:
+        raise ValueError(f"[LOAD] Неизвестная раскладка staging: {mode}, ожидается одна из {TABLE_MODES}")
+    return mode
+
+
+def load_to_staging(df: pd.DataFrame, entity: str, file: str, load_id: str, mode: str = None, source: dict = None,
+                    started_at: datetime = None, rejects: pd.DataFrame = None):
+    # source — сведения об исходном объекте для журнала загрузок: etag, size, content_hash;
+    # started_at — начало обработки файла (скачивание и трансформация), от него считается duration_ms;
+    # rejects — строки, отклонённые etl.validation, пишутся в load_rejects в той же транзакции
+    mode = mode or os.getenv("STAGING_LOAD_MODE", "copy")
+    if mode not in LOAD_MODES:
+        raise ValueError(f"[LOAD] Неизвестный режим загрузки: {mode}, ожидается один из {LOAD_MODES}")
+
+    partitioned = staging_table_mode() == "partitioned"
+    if partitioned and mode != "copy":
+        raise ValueError("[LOAD] Секционированный staging заполняется только через COPY (STAGING_LOAD_MODE=copy)")
+
+    engine = get_engine()
+    table_name = staging_table_name(file, load_id)
+    if partitioned:
+        ensure_partitioned_table(entity)
+
+    debug(f"[DEBUG] Загружаем {len(df)} строк в таблицу {table_name} из файла {file} (режим {mode})")
+
+    with stage_span("load", entity=entity, key=file, mode=mode) as span, engine.begin() as conn:
+        span["rows"] = len(df)
+        if mode == "copy":
+            qualified = create_staging_table(conn, entity, table_name, partitioned)
+            buffer = frame_to_csv_buffer(df, STAGING_COLUMN_TYPES[entity])
+            span["bytes"] = buffer.seek(0, io.SEEK_END)
+            buffer.seek(0)
+            copy_rows(conn, entity, qualified, buffer)
+            if partitioned:
+                attach_partition(conn, entity, table_name)
+        else:
+            df.to_sql(table_name, con=conn, if_exists="replace", index=False)
+
+        if rejects is not None and len(rejects):
+            write_rejects(conn, load_id, entity, file, rejects)
+        write_load_log(conn, load_id, entity, file, "SUCCESS", len(df), source=source, staging_table=table_name,
+                       started_at=started_at, rows_rejected=len(rejects) if rejects is not None else 0)
+
+
+def load_stream_to_staging(stream, entity: str, file: str, load_id: str, source: dict = None,
+                           started_at: datetime = None) -> int:
+    # stream — файлоподобный объект с CSV в порядке колонок STAGING_COLUMN_TYPES (см. transform.stream_transform);
+    # отклонённые при чтении строки (stream.rejects) пишутся в load_rejects в той же транзакции
+    partitioned = staging_table_mode() == "partitioned"
+    engine = get_engine()
+    table_name = staging_table_name(file, load_id)
+    if partitioned:
+        ensure_partitioned_table(entity)
+
+    debug(f"[DEBUG] Потоковая загрузка в таблицу {table_name} из файла {file}")
 
     with engine.begin() as conn:
-        df.to_sql(table_name, con=conn, if_exists="replace", index=False)
-
-        conn.execute(text("""
-            CREATE TABLE IF NOT EXISTS load_log (
-                load_id TEXT,
-                entity TEXT,
-                file TEXT,
-                status TEXT,
-                rows_loaded INTEGER,
-                error TEXT
-            )
+        qualified = create_staging_table(conn, entity, table_name, partitioned)
+        copy_rows(conn, entity, qualified, stream)
+        if partitioned:
+            attach_partition(conn, entity, table_name)
+        debug(f"[DEBUG] Загружено {stream.rows} строк в таблицу {table_name}")
+        # content_hash известен только после того, как поток прочитан до конца
+        source = dict(source or {})
+        if getattr(stream, "content_hash", None):
+            source["content_hash"] = stream.content_hash
+        rejects = getattr(stream, "rejects", None)
+        if rejects is not None:
+            write_rejects(conn, load_id, entity, file, rejects)
+        write_load_log(conn, load_id, entity, file, "SUCCESS", stream.rows, source=source, staging_table=table_name,
+                       started_at=started_at, rows_rejected=len(rejects) if rejects is not None else 0)
+    return stream.rows
+
+
+def log_failed_file(load_id: str, entity: str, file: str, error: str, source: dict = None):
+    # Отдельная транзакция: транзакция загрузки файла к этому моменту уже откатилась
+    try:
+        with get_engine().begin() as conn:
+            write_load_log(conn, load_id, entity, file, "FAILED", 0, error, source=source)
+    except Exception as e:
+        print(f"[LOAD] ⚠ Не удалось записать ошибку файла {file} в load_log: {e}")
+
+
+def create_staging_table(conn, entity: str, table_name: str, partitioned: bool = False) -> str:
+    # Типизированная таблица создаётся заранее, данные затем идут одним COPY в той же транзакции.
+    # Возвращает полное имя таблицы, в которую нужно писать COPY
+    if not partitioned:
+        column_ddl = ", ".join(f"{col} {dtype}" for col, dtype in STAGING_COLUMN_TYPES[entity])
+        conn.execute(text(f'DROP TABLE IF EXISTS public."{table_name}"'))
+        conn.execute(text(f'CREATE TABLE public."{table_name}" ({column_ddl})'))
+        return f'public."{table_name}"'
+
+    # Секция наполняется как обычная таблица и подключается к родителю в конце транзакции (attach_partition):
+    # так блокировка родительской таблицы держится только на время ATTACH, а не на всё время COPY.
+    # CHECK-ограничение совпадает с границей секции, поэтому ATTACH не сканирует данные.
+    # Родительскую таблицу заранее создаёт ensure_partitioned_table
+    parent = f"staging.{entity}_staging"
+    conn.execute(text(f'DROP TABLE IF EXISTS staging."{table_name}"'))
+    conn.execute(text(f"""
+        CREATE TABLE staging."{table_name}" (
+            LIKE {parent},
+            CONSTRAINT "{table_name[:40]}_source_chk" CHECK (source_table = '{table_name}')
+        )
+    """))
+    conn.execute(text(f"""ALTER TABLE staging."{table_name}" ALTER COLUMN source_table SET DEFAULT '{table_name}'"""))
+    return f'staging."{table_name}"'
+
+
+def ensure_partitioned_table(entity: str) -> str:
+    # Родительская таблица создаётся отдельной транзакцией под advisory-блокировкой:
+    # параллельные CREATE ... IF NOT EXISTS из разных потоков и процессов иначе конфликтуют в каталоге
+    parent = f"staging.{entity}_staging"
+    if entity in _partitioned_ready:
+        return parent
+    column_ddl = ", ".join(f"{col} {dtype}" for col, dtype in STAGING_COLUMN_TYPES[entity])
+    with _partitioned_lock, get_engine().begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('staging_partitioned_ddl'))"))
+        conn.execute(text("CREATE SCHEMA IF NOT EXISTS staging"))
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {parent} ({column_ddl}, source_table TEXT NOT NULL)
+            PARTITION BY LIST (source_table)
         """))
-        conn.execute(text("""
-            INSERT INTO load_log (load_id, entity, file, status, rows_loaded, error)
-            VALUES (:load_id, :entity, :file, :status, :rows_loaded, :error)
-        """), {
-            "load_id": load_id,
-            "entity": entity,
-            "file": file,
-            "status": "SUCCESS",
-            "rows_loaded": len(df),
-            "error": None
-        })
+    _partitioned_ready.add(entity)
+    return parent
+
+
+def attach_partition(conn, entity: str, table_name: str):
+    conn.execute(text(f"""
+        ALTER TABLE staging.{entity}_staging
+        ATTACH PARTITION staging."{table_name}" FOR VALUES IN ('{table_name}')
+    """))
+
+
+def drop_expired_partitions(entity: str, retention_days: int) -> list:
+    # Секции старше retention_days отсоединяются и удаляются. Последняя успешная загрузка каждого файла
+    # сохраняется всегда: на неё ссылаются SKIPPED-записи load_log при повторных запусках
+    parent = f"staging.{entity}_staging"
+    with get_engine().begin() as conn:
+        ensure_load_log()
+        if conn.execute(text("SELECT to_regclass(:parent)"), {"parent": parent}).scalar() is None:
+            return []
+        expired = conn.execute(text("""
+            WITH partitions AS (
+                SELECT c.relname AS staging_table
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = CAST(:parent AS regclass)
+            ),
+            latest AS (
+                SELECT DISTINCT ON (file) staging_table
+                FROM load_log
+                WHERE status = 'SUCCESS' AND entity = :entity AND staging_table IS NOT NULL
+                ORDER BY file, loaded_at DESC
+            ),
+            recent AS (
+                SELECT DISTINCT staging_table
+                FROM load_log
+                WHERE staging_table IS NOT NULL
+                  AND loaded_at >= now() - make_interval(days => :days)
+            )
+            SELECT p.staging_table
+            FROM partitions p
+            WHERE p.staging_table NOT IN (SELECT staging_table FROM latest)
+              AND p.staging_table NOT IN (SELECT staging_table FROM recent)
+            ORDER BY p.staging_table
+        """), {"parent": parent, "entity": entity, "days": retention_days}).scalars().all()
+
+        for table_name in expired:
+            conn.execute(text(f'ALTER TABLE {parent} DETACH PARTITION staging."{table_name}"'))
+            conn.execute(text(f'DROP TABLE staging."{table_name}"'))
+            print(f"[LOAD] 🗑 Удалена устаревшая секция staging.{table_name}")
+    return expired
+
+
+def copy_rows(conn, entity: str, qualified_table: str, source):
+    column_names = ", ".join(col for col, _ in STAGING_COLUMN_TYPES[entity])
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {qualified_table} ({column_names}) FROM STDIN WITH (FORMAT csv)", source)
+    finally:
+        cursor.close()
+
+
+def staging_frame(df: pd.DataFrame, columns) -> pd.DataFrame:
+    # Колонки в порядке staging; float-колонки с NaN (usage, usagenet) приводим к nullable Int64,
+    # иначе COPY получит "2100.0"
+    out = df[[col for col, _ in columns]].copy()
+    for col, dtype in columns:
+        if dtype in INTEGER_TYPES and pd.api.types.is_float_dtype(out[col]):
+            out[col] = out[col].round().astype("Int64")
+    return out
+
+
+def frame_to_csv_buffer(df: pd.DataFrame, columns) -> io.StringIO:
+    buffer = io.StringIO()
+    staging_frame(df, columns).to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    return buffer
+
+
+def ensure_load_log():
+    # load_log — журнал загрузок и одновременно реестр уже загруженных объектов (ключ + ETag/size/хеш)
+    global _load_log_ready
+    if _load_log_ready:
+        return
+    with _load_log_lock:
+        if _load_log_ready:
+            return
+        # DDL — в отдельной зафиксированной транзакции: после флага готовности другие потоки сразу
+        # пишут в таблицу, и она не должна оставаться в ещё не зафиксированной транзакции вызывающего
+        with get_engine().begin() as ddl:
+            ddl.execute(text("""
+                CREATE TABLE IF NOT EXISTS load_log (
+                    load_id TEXT,
+                    entity TEXT,
+                    file TEXT,
+                    status TEXT,
+                    rows_loaded INTEGER,
+                    error TEXT
+                )
+            """))
+            ddl.execute(text("""
+                ALTER TABLE load_log
+                    ADD COLUMN IF NOT EXISTS etag TEXT,
+                    ADD COLUMN IF NOT EXISTS size BIGINT,
+                    ADD COLUMN IF NOT EXISTS content_hash TEXT,
+                    ADD COLUMN IF NOT EXISTS staging_table TEXT,
+                    ADD COLUMN IF NOT EXISTS loaded_at TIMESTAMP DEFAULT now(),
+                    ADD COLUMN IF NOT EXISTS started_at TIMESTAMPTZ,
+                    ADD COLUMN IF NOT EXISTS duration_ms NUMERIC(12,1),
+                    ADD COLUMN IF NOT EXISTS rows_rejected INTEGER
+            """))
+            ddl.execute(text("CREATE INDEX IF NOT EXISTS load_log_file_idx ON load_log (file, status)"))
+            # Хронология запуска (dwh.etl_run_timeline) выбирается по load_id
+            ddl.execute(text("CREATE INDEX IF NOT EXISTS load_log_load_id_idx ON load_log (load_id)"))
+        _load_log_ready = True
+
+
+def write_load_log(conn, load_id: str, entity: str, file: str, status: str, rows_loaded: int, error: str = None,
+                   source: dict = None, staging_table: str = None, started_at: datetime = None,
+                   rows_rejected: int = None):
+    ensure_load_log()
+    source = source or {}
+    duration_ms = None
+    if started_at:
+        duration_ms = round((datetime.now(timezone.utc) - started_at).total_seconds() * 1000, 1)
+    conn.execute(text("""
+        INSERT INTO load_log (load_id, entity, file, status, rows_loaded, error, etag, size, content_hash, staging_table,
+                              started_at, duration_ms, rows_rejected)
+        VALUES (:load_id, :entity, :file, :status, :rows_loaded, :error, :etag, :size, :content_hash, :staging_table,
+                :started_at, :duration_ms, :rows_rejected)
+    """), {
+        "load_id": load_id,
+        "entity": entity,
+        "file": file,
+        "status": status,
+        "rows_loaded": rows_loaded,
+        "error": error,
+        "etag": source.get("etag"),
+        "size": source.get("size"),
+        "content_hash": source.get("content_hash"),
+        "staging_table": staging_table,
+        "started_at": started_at,
+        "duration_ms": duration_ms,
+        "rows_rejected": rows_rejected
+    })
+
+
+def ensure_load_rejects():
+    # load_rejects — строки, не прошедшие etl.validation: номер строки в файле, причины и значения (JSONB)
+    global _load_rejects_ready
+    if _load_rejects_ready:
+        return
+    with _load_log_lock:
+        if _load_rejects_ready:
+            return
+        with get_engine().begin() as ddl:
+            ddl.execute(text("""
+                CREATE TABLE IF NOT EXISTS load_rejects (
+                    load_id TEXT,
+                    entity TEXT,
+                    file TEXT,
+                    row_number INTEGER,
+                    reasons TEXT,
+                    data JSONB,
+                    rejected_at TIMESTAMP DEFAULT now()
+                )
+            """))
+            ddl.execute(text("CREATE INDEX IF NOT EXISTS load_rejects_load_id_idx ON load_rejects (load_id, file)"))
+        _load_rejects_ready = True
+
+
+def write_rejects(conn, load_id: str, entity: str, file: str, rejects: pd.DataFrame):
+    ensure_load_rejects()
+    conn.execute(text("""
+        INSERT INTO load_rejects (load_id, entity, file, row_number, reasons, data)
+        VALUES (:load_id, :entity, :file, :row_number, :reasons, CAST(:data AS JSONB))
+    """), [
+        {"load_id": load_id, "entity": entity, "file": file, "row_number": int(row_number), "reasons": reasons,
+         "data": data}
+        for row_number, reasons, data in rejects[["row_number", "reasons", "data"]].itertuples(index=False)
+    ])
+    print(f"[LOAD] ⚠ {file}: {len(rejects)} отклонённых строк записано в load_rejects")
+
+
+def find_loaded_objects(files) -> dict:
+    # Последняя успешная загрузка каждого ключа, staging-таблица (или секция) которой ещё существует
+    if not files:
+        return {}
+    with get_engine().begin() as conn:
+        ensure_load_log()
+        rows = conn.execute(text("""
+            SELECT DISTINCT ON (file) file, etag, size, content_hash, staging_table, rows_loaded
+            FROM load_log
+            WHERE status = 'SUCCESS'
+              AND file = ANY(:files)
+              AND staging_table IS NOT NULL
+              AND COALESCE(to_regclass(format('public.%I', staging_table)),
+                           to_regclass(format('staging.%I', staging_table))) IS NOT NULL
+            ORDER BY file, loaded_at DESC
+        """), {"files": list(files)}).mappings().all()
+    return {row["file"]: dict(row) for row in rows}
+
+
+def is_unchanged(previous: dict, source: dict) -> bool:
+    # Объект не менялся, если совпал хеш содержимого либо пара ETag + размер
+    if not previous:
+        return False
+    if source.get("content_hash") and previous.get("content_hash"):
+        return source["content_hash"] == previous["content_hash"]
+    return bool(source.get("etag")) and source.get("etag") == previous.get("etag") \
+        and source.get("size") == previous.get("size")
+
+
+def log_skipped_file(load_id: str, entity: str, file: str, previous: dict, source: dict = None,
+                     started_at: datetime = None):
+    # Повторно используем staging-таблицу прошлой загрузки: create_staging_views подхватит её по load_log
+    with get_engine().begin() as conn:
+        write_load_log(conn, load_id, entity, file, "SKIPPED", previous.get("rows_loaded") or 0,
+                       source={**previous, **{k: v for k, v in (source or {}).items() if v is not None}},
+                       staging_table=previous["staging_table"], started_at=started_at)
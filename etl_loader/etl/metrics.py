@@ -0,0 +1,137 @@
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# Замеры этапов etl-runner: stage_span оборачивает листинг, скачивание, разбор и загрузку каждого файла,
+# пишет строку [SPAN] с длительностью, строками, байтами и памятью (ETL_SPAN_LOG=0 — не писать)
+# и копит счётчики и гистограммы по (stage, entity), которые /metrics отдаёт в текстовом формате Prometheus
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+_lock = threading.Lock()
+_stages = {}
+
+
+def debug_enabled() -> bool:
+    # ETL_VERBOSE=0 отключает построчный [DEBUG]-вывод по каждому ключу и колонке на горячих путях
+    return os.getenv("ETL_VERBOSE", "1") == "1"
+
+
+def debug(message: str):
+    if debug_enabled():
+        print(message)
+
+
+def read_proc_status_kb(field: str):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def rss_bytes() -> int:
+    kb = read_proc_status_kb("VmRSS")
+    return kb * 1024 if kb is not None else peak_rss_bytes()
+
+
+def peak_rss_bytes() -> int:
+    # Пик RSS процесса; ru_maxrss в Linux — в килобайтах
+    kb = read_proc_status_kb("VmHWM")
+    return (kb if kb is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) * 1024
+
+
+@contextmanager
+def stage_span(stage: str, entity: str = None, key: str = None, **fields):
+    # Вызывающий код дописывает в span["rows"] и span["bytes"] обработанные строки и байты.
+    # Память — RSS процесса в конце этапа и его пик: файлы обрабатываются параллельно в одном процессе,
+    # поэтому точной памяти одного файла нет, пик показывает, до скольких дошёл процесс к концу этапа
+    span = {"stage": stage, "entity": entity, "key": key, "rows": None, "bytes": None, **fields}
+    started = time.perf_counter()
+    status = "SUCCESS"
+    try:
+        yield span
+    except Exception:
+        status = "FAILED"
+        raise
+    finally:
+        span["status"] = status
+        span["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        span["rss_mb"] = round(rss_bytes() / 1024 / 1024, 1)
+        span["peak_rss_mb"] = round(peak_rss_bytes() / 1024 / 1024, 1)
+        record_span(span)
+        if os.getenv("ETL_SPAN_LOG", "1") == "1":
+            print(f"[SPAN] {json.dumps(span, ensure_ascii=False, default=str)}")
+
+
+def record_span(span: dict):
+    seconds = span["duration_ms"] / 1000
+    with _lock:
+        stage = _stages.setdefault((span["stage"], span["entity"] or ""), {
+            "count": 0, "failed": 0, "seconds": 0.0, "rows": 0, "bytes": 0, "buckets": [0] * len(DURATION_BUCKETS)
+        })
+        stage["count"] += 1
+        stage["failed"] += int(span["status"] == "FAILED")
+        stage["seconds"] += seconds
+        stage["rows"] += span["rows"] or 0
+        stage["bytes"] += span["bytes"] or 0
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if seconds <= bound:
+                stage["buckets"][i] += 1
+                break
+
+
+def label_value(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def labels(**values) -> str:
+    return "{" + ",".join(f'{name}="{label_value(value)}"' for name, value in values.items()) + "}"
+
+
+def render_metrics(extra_gauges: dict = None) -> str:
+    # Текстовый формат Prometheus 0.0.4. extra_gauges — {имя: (описание, {labels-кортеж: значение})}
+    with _lock:
+        stages = {name: dict(stage, buckets=list(stage["buckets"])) for name, stage in sorted(_stages.items())}
+
+    lines = [
+        "# HELP etl_stage_duration_seconds Длительность этапа обработки файла",
+        "# TYPE etl_stage_duration_seconds histogram"
+    ]
+    for (stage, entity), values in stages.items():
+        cumulative = 0
+        for bound, count in zip(DURATION_BUCKETS, values["buckets"]):
+            cumulative += count
+            lines.append(f"etl_stage_duration_seconds_bucket{labels(stage=stage, entity=entity, le=bound)} "
+                         f"{cumulative}")
+        lines.append(f"etl_stage_duration_seconds_bucket{labels(stage=stage, entity=entity, le='+Inf')} "
+                     f"{values['count']}")
+        lines.append(f"etl_stage_duration_seconds_sum{labels(stage=stage, entity=entity)} {values['seconds']:.6f}")
+        lines.append(f"etl_stage_duration_seconds_count{labels(stage=stage, entity=entity)} {values['count']}")
+
+    for metric, field, help_text in (
+        ("etl_stage_rows_total", "rows", "Строки, обработанные этапом"),
+        ("etl_stage_bytes_total", "bytes", "Байты, обработанные этапом"),
+        ("etl_stage_failures_total", "failed", "Этапы, завершившиеся ошибкой")
+    ):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} counter")
+        for (stage, entity), values in stages.items():
+            lines.append(f"{metric}{labels(stage=stage, entity=entity)} {values[field]}")
+
+    gauges = {
+        "etl_process_resident_memory_bytes": ("Текущий RSS процесса etl-runner", {(): rss_bytes()}),
+        "etl_process_peak_resident_memory_bytes": ("Пиковый RSS процесса etl-runner", {(): peak_rss_bytes()}),
+        **(extra_gauges or {})
+    }
+    for metric, (help_text, samples) in gauges.items():
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} gauge")
+        for label_items, value in samples.items():
+            lines.append(f"{metric}{labels(**dict(label_items)) if label_items else ''} {value}")
+    return "\n".join(lines) + "\n"
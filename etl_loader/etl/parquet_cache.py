@@ -0,0 +1,166 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from etl.schemas import STAGING_COLUMN_TYPES, VALIDATION_RULES
+from etl.resources import get_s3_client
+from etl.load import staging_frame
+
+# Parquet-кэш разобранных выгрузок: проверенный (etl.validation) типизированный DataFrame в порядке
+# колонок staging вместе с отклонёнными строками, который перезапуск или бэкфилл того же объекта берёт
+# вместо скачивания, повторного разбора CSV и проверки.
+# Ключ записи — ключ объекта, его ETag, содержимое matching-файла и правила проверки: новая версия объекта,
+# изменённые правила переименования или VALIDATION_RULES дают другую запись, старая уходит при вытеснении.
+# ETL_PARQUET_CACHE — каталог (/var/cache/etl) или префикс s3://bucket/prefix; не задан — кэш выключен.
+# ETL_PARQUET_CACHE_MAX_MB — предел размера кэша: сверх него удаляются давно не читавшиеся записи
+_evict_lock = threading.Lock()
+
+CONTENT_HASH_KEY = b"etl.content_hash"
+REJECTS_KEY = b"etl.rejects"
+
+
+def cache_location():
+    return os.getenv("ETL_PARQUET_CACHE", "").strip() or None
+
+
+def cache_max_bytes() -> int:
+    return int(float(os.getenv("ETL_PARQUET_CACHE_MAX_MB", "2048")) * 1024 * 1024)
+
+
+def split_s3_location(location: str):
+    bucket, _, prefix = location[len("s3://"):].partition("/")
+    return bucket, prefix.strip("/")
+
+
+def cache_entry_name(entity: str, key: str, etag: str, matching_file: str) -> str:
+    hasher = hashlib.sha256()
+    rules = json.dumps([STAGING_COLUMN_TYPES[entity], VALIDATION_RULES.get(entity, {})], sort_keys=True, default=str)
+    for part in (key, etag, rules):
+        hasher.update(part.encode("utf-8"))
+        hasher.update(b"\0")
+    # Нет matching-файла — он будет создан при разборе, и следующий запуск посчитает ключ уже с ним
+    if matching_file and os.path.exists(matching_file):
+        with open(matching_file, "rb") as f:
+            hasher.update(f.read())
+    filename = os.path.basename(key)
+    filename = filename[:filename.index(".")] if "." in filename else filename
+    return f"{entity}/{filename}_{hasher.hexdigest()[:24]}.parquet"
+
+
+def read_cached_frame(entity: str, key: str, etag: str, matching_file: str):
+    # Возвращает (проверенный DataFrame, content_hash, отклонённые строки | None) или None, если записи нет
+    location = cache_location()
+    if not location or not etag:
+        return None
+    name = cache_entry_name(entity, key, etag, matching_file)
+    try:
+        if location.startswith("s3://"):
+            bucket, prefix = split_s3_location(location)
+            try:
+                body = get_s3_client().get_object(Bucket=bucket, Key=f"{prefix}/{name}".lstrip("/"))["Body"]
+            except get_s3_client().exceptions.NoSuchKey:
+                return None
+            with body:
+                table = pq.read_table(io.BytesIO(body.read()))
+        else:
+            path = os.path.join(location, name)
+            if not os.path.exists(path):
+                return None
+            table = pq.read_table(path)
+            # mtime — время последнего чтения: по нему вытесняются давно не использованные записи
+            os.utime(path)
+    except Exception as e:
+        # Битая или недочитанная запись не должна ронять загрузку — файл просто разбирается заново
+        print(f"[CACHE] ⚠ Не удалось прочитать {name} из кэша, файл будет разобран заново: {e}")
+        return None
+
+    metadata = table.schema.metadata or {}
+    content_hash = metadata.get(CONTENT_HASH_KEY)
+    rejects = pd.DataFrame(json.loads(metadata[REJECTS_KEY])) if REJECTS_KEY in metadata else None
+    print(f"[CACHE] ✅ {key}: {table.num_rows} строк из кэша {name}")
+    # int64 — в nullable Int64: иначе колонка с пропусками вернулась бы через float64 и большие id округлились бы
+    frame = table.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+    return frame, content_hash.decode() if content_hash else None, rejects
+
+
+def write_cached_frame(df: pd.DataFrame, entity: str, key: str, etag: str, matching_file: str,
+                       content_hash: str = None, rejects: pd.DataFrame = None):
+    # df — строки, прошедшие validate_frame; rejects (row_number, reasons, data) хранятся в метаданных
+    # записи, чтобы чтение из кэша писало в load_rejects те же строки без повторной проверки
+    location = cache_location()
+    if not location or not etag:
+        return None
+    name = cache_entry_name(entity, key, etag, matching_file)
+    try:
+        table = pa.Table.from_pandas(staging_frame(df, STAGING_COLUMN_TYPES[entity]), preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        if content_hash:
+            metadata[CONTENT_HASH_KEY] = content_hash.encode()
+        if rejects is not None and len(rejects):
+            metadata[REJECTS_KEY] = rejects.to_json(orient="records").encode()
+        table = table.replace_schema_metadata(metadata)
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer, compression=os.getenv("ETL_PARQUET_CACHE_COMPRESSION", "zstd"))
+        data = buffer.getvalue()
+        if len(data) > cache_max_bytes():
+            print(f"[CACHE] ⚠ {key}: запись ({len(data)} байт) больше ETL_PARQUET_CACHE_MAX_MB, в кэш не пишем")
+            return None
+
+        if location.startswith("s3://"):
+            bucket, prefix = split_s3_location(location)
+            get_s3_client().put_object(Bucket=bucket, Key=f"{prefix}/{name}".lstrip("/"), Body=data)
+        else:
+            path = os.path.join(location, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Через временный файл: параллельный поток не должен прочитать недописанную запись
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        print(f"[CACHE] 💾 {key}: {table.num_rows} строк записано в кэш {name} ({len(data)} байт)")
+        evict_cache()
+        return name
+    except Exception as e:
+        # Кэш — ускорение, а не часть загрузки: ошибка записи только логируется
+        print(f"[CACHE] ⚠ Не удалось записать {name} в кэш: {e}")
+        return None
+
+
+def evict_cache():
+    # Удаляет самые старые записи, пока кэш больше ETL_PARQUET_CACHE_MAX_MB. Локально порядок —
+    # по mtime (обновляется при чтении, т.е. LRU), в S3 — по LastModified (время записи)
+    location = cache_location()
+    max_bytes = cache_max_bytes()
+    with _evict_lock:
+        if location.startswith("s3://"):
+            bucket, prefix = split_s3_location(location)
+            entries = []
+            paginator = get_s3_client().get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}/" if prefix else ""):
+                for item in page.get("Contents", []):
+                    if item["Key"].endswith(".parquet"):
+                        entries.append((item["LastModified"], item["Size"], item["Key"]))
+        else:
+            entries = []
+            for root, _, files in os.walk(location):
+                for filename in files:
+                    if filename.endswith(".parquet"):
+                        path = os.path.join(root, filename)
+                        stat = os.stat(path)
+                        entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= max_bytes:
+                break
+            if location.startswith("s3://"):
+                get_s3_client().delete_object(Bucket=bucket, Key=entry)
+            elif os.path.exists(entry):
+                os.remove(entry)
+            total -= size
+            print(f"[CACHE] 🗑 Вытеснена запись {entry}")
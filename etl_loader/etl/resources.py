@@ -0,0 +1,80 @@
+import os
+import threading
+import boto3
+from botocore.config import Config
+from sqlalchemy import create_engine
+
+# Общие на процесс ресурсы: один S3-клиент с пулом HTTP-соединений и один SQLAlchemy engine с пулом.
+# Оба объекта потокобезопасны, создаются лениво при первом обращении и закрываются dispose_resources().
+_lock = threading.Lock()
+_s3_client = None
+_engine = None
+
+
+def get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        with _lock:
+            if _s3_client is None:
+                config = Config(
+                    max_pool_connections=int(os.getenv("MINIO_MAX_POOL_CONNECTIONS", "20")),
+                    connect_timeout=float(os.getenv("MINIO_CONNECT_TIMEOUT", "10")),
+                    read_timeout=float(os.getenv("MINIO_READ_TIMEOUT", "60")),
+                    retries={"max_attempts": int(os.getenv("MINIO_MAX_ATTEMPTS", "3")), "mode": "standard"}
+                )
+                # Отдельная сессия: boto3.client() на общей default-сессии не потокобезопасен
+                _s3_client = boto3.session.Session().client(
+                    "s3",
+                    endpoint_url=os.getenv("MINIO_ENDPOINT"),
+                    aws_access_key_id=os.getenv("MINIO_ACCESS_KEY"),
+                    aws_secret_access_key=os.getenv("MINIO_SECRET_KEY"),
+                    config=config
+                )
+    return _s3_client
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _lock:
+            if _engine is None:
+                host = os.getenv("POSTGRES_HOST", "localhost")
+                port = os.getenv("POSTGRES_PORT", "5432")
+                db = os.getenv("POSTGRES_DB", "etldb")
+                user = os.getenv("POSTGRES_USER", "etluser")
+                password = os.getenv("POSTGRES_PASSWORD", "etlpass")
+
+                url = f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{db}"
+                print(f"[DEBUG] Подключение к PostgreSQL: {url}")
+                _engine = create_engine(
+                    url,
+                    pool_size=int(os.getenv("POSTGRES_POOL_SIZE", "5")),
+                    max_overflow=int(os.getenv("POSTGRES_MAX_OVERFLOW", "5")),
+                    pool_recycle=int(os.getenv("POSTGRES_POOL_RECYCLE", "1800")),
+                    pool_pre_ping=os.getenv("POSTGRES_POOL_PRE_PING", "1") == "1"
+                )
+    return _engine
+
+
+def dispose_resources():
+    global _s3_client, _engine
+    with _lock:
+        if _engine is not None:
+            _engine.dispose()
+            _engine = None
+        if _s3_client is not None:
+            _s3_client.close()
+            _s3_client = None
+
+
+def _reset_after_fork():
+    # Дочерний процесс не должен использовать сокеты родителя
+    global _lock, _s3_client, _engine
+    _lock = threading.Lock()
+    if _engine is not None:
+        _engine.dispose(close=False)
+    _s3_client, _engine = None, None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
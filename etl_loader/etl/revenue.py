@@ -0,0 +1,526 @@
+import argparse
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from etl.resources import get_engine
+
+# Векторный расчёт dwh.contract_price_enriched — то же, что шаги 1–7 sql/load_contracts_enriched.sql,
+# но без PostgreSQL: контракты обрабатываются кусками по chunk_size, а набор контрактов можно поделить
+# на шарды по contract_id % shards и считать их в отдельных процессах.
+ENRICHED_COLUMNS = [
+    "contract_id", "productid", "period_start", "period_end", "status", "consumption", "startdate", "enddate",
+    "createdat", "baseprice", "workingprice", "days_in_period", "days_since_start", "contract_year",
+    "total_contract_years", "final_end", "terminated_mid_year", "total_days_in_year", "period_share", "base_cost",
+    "variable_cost", "weighted_consumption", "consumption_share", "revenue", "baseprice_total_due"
+]
+DATE_COLUMNS = ["period_start", "period_end", "startdate", "enddate", "createdat", "final_end"]
+OPEN_END = np.datetime64("9999-12-31", "D")
+CHUNK_SIZE = 5000
+
+
+def to_days(values) -> np.ndarray:
+    # Даты → число дней от эпохи (float64, NULL → NaN): вся арифметика периодов идёт на целых днях
+    # Через datetime64[D], а не pandas Timestamp: 9999-12-31 не помещается в наносекунды
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        days = values.to_numpy().astype("datetime64[D]")
+    else:
+        objects = values.to_numpy(dtype=object)
+        objects[pd.isna(objects)] = None
+        days = np.array(objects, dtype="datetime64[D]")
+    result = days.astype("int64").astype("float64")
+    result[np.isnat(days)] = np.nan
+    return result
+
+
+def to_dates(days) -> np.ndarray:
+    days = np.asarray(days, dtype="float64")
+    result = np.full(len(days), np.datetime64("NaT"), dtype="datetime64[D]")
+    mask = ~np.isnan(days)
+    result[mask] = days[mask].astype("int64").astype("datetime64[D]")
+    return result.astype("datetime64[s]")
+
+
+def round_half_up(values, decimals: int) -> np.ndarray:
+    # ROUND(numeric, n) в PostgreSQL округляет половину от нуля, np.round — к чётному
+    scale = 10.0 ** decimals
+    values = np.asarray(values, dtype="float64")
+    return np.sign(values) * np.floor(np.abs(values) * scale + 0.5 + 1e-7) / scale
+
+
+def ratio_half_up(numerator, denominator, decimals: int) -> np.ndarray:
+    # Точное ROUND(a / b, n) для целых a, b >= 0 (дни, потребление): без ошибок двоичной дроби
+    numerator = np.asarray(numerator, dtype="float64")
+    denominator = np.asarray(denominator, dtype="float64")
+    result = np.full(len(numerator), np.nan)
+    mask = ~np.isnan(numerator) & ~np.isnan(denominator) & (denominator != 0)
+    a = numerator[mask].astype("int64") * 10 ** decimals
+    b = denominator[mask].astype("int64")
+    result[mask] = ((2 * a + b) // (2 * b)) / 10.0 ** decimals
+    return result
+
+
+def price_share_half_up(price, numerator, denominator, decimals: int) -> np.ndarray:
+    # ROUND(price * (a / b), n) так же, как numeric в PostgreSQL: частное a / b сначала округляется
+    # до 20 знаков (a < b) или 16 знаков (a >= b, при b < 10000), и только потом умножается на цену.
+    # На точных «половинах» (4.1996875) это даёт другой результат, чем float или точная дробь.
+    # Цена берётся с 10 знаками (numeric(38,10)), значения неотрицательные; арифметика на int Python
+    price = np.asarray(price, dtype="float64")
+    numerator = np.asarray(numerator, dtype="float64")
+    denominator = np.asarray(denominator, dtype="float64")
+    result = np.full(len(price), np.nan)
+    mask = ~np.isnan(price) & ~np.isnan(numerator) & ~np.isnan(denominator) & (denominator != 0)
+    if not mask.any():
+        return result
+    a = numerator[mask].astype("int64").astype(object)
+    b = denominator[mask].astype("int64").astype(object)
+    quotient_scale = np.where(numerator[mask] < denominator[mask], 20, 16)
+    quotient_pow = np.array([10 ** int(scale) for scale in quotient_scale], dtype=object)
+    quotient = (2 * a * quotient_pow + b) // (2 * b)
+    cents = np.round(price[mask] * 1e10).astype("int64").astype(object)
+    divisor = quotient_pow * 10 ** (10 - decimals)
+    rounded = (2 * cents * quotient + divisor) // (2 * divisor)
+    result[mask] = rounded.astype("float64") / 10.0 ** decimals
+    return result
+
+
+def add_years(start_days, years) -> np.ndarray:
+    # date + (n || ' years')::interval: 29 февраля переходит в 28-е, как в PostgreSQL
+    start = np.asarray(start_days, dtype="float64")
+    years = np.asarray(years, dtype="float64")
+    result = np.full(len(start), np.nan)
+    mask = ~np.isnan(start) & ~np.isnan(years)
+    dates = start[mask].astype("int64").astype("datetime64[D]")
+    month_start = dates.astype("datetime64[M]")
+    day = (dates - month_start.astype("datetime64[D]")).astype("int64")
+    target_month = month_start + (years[mask].astype("int64") * 12).astype("timedelta64[M]")
+    month_days = ((target_month + 1).astype("datetime64[D]") - target_month.astype("datetime64[D]")).astype("int64")
+    target = target_month.astype("datetime64[D]") + np.minimum(day, month_days - 1)
+    result[mask] = target.astype("int64")
+    return result
+
+
+def build_contract_input(contracts: pd.DataFrame) -> pd.DataFrame:
+    # Шаг 1: версии контрактов без indelivery; открытая версия заканчивается последним слепком контракта
+    contracts = contracts[contracts["status"] != "indelivery"]
+    valid_until = to_days(contracts["valid_until"])
+    snapshot = to_days(contracts["snapshot_date"])
+    last_snapshot = pd.Series(snapshot, index=contracts.index).groupby(
+        [contracts["contract_id"], contracts["product_id"]]
+    ).transform("max").to_numpy()
+    usagenet = pd.to_numeric(contracts["usagenet"], errors="coerce").to_numpy(dtype="float64")
+    usage = pd.to_numeric(contracts["usage"], errors="coerce").to_numpy(dtype="float64")
+
+    result = pd.DataFrame({
+        "contract_id": contracts["contract_id"].to_numpy(dtype="int64"),
+        "productid": contracts["product_id"].to_numpy(dtype="int64"),
+        "status": contracts["status"].to_numpy(dtype=object),
+        "consumption": np.where(np.isnan(usagenet), usage, usagenet),
+        "startdate": to_days(contracts["valid_from"]),
+        "enddate": np.where(valid_until == OPEN_END.astype("int64"), last_snapshot, valid_until),
+        "createdat": to_days(contracts["createdat"])
+    })
+    return result.drop_duplicates(ignore_index=True)
+
+
+def latest_price_periods(price_periods: pd.DataFrame) -> pd.DataFrame:
+    snapshot = to_days(price_periods["snapshot_date"])
+    latest = price_periods[snapshot == np.nanmax(snapshot)] if len(snapshot) else price_periods
+    return pd.DataFrame({
+        "product_id": latest["product_id"].to_numpy(dtype="int64"),
+        "valid_from": to_days(latest["valid_from"]),
+        "valid_until": to_days(latest["valid_until"]),
+        "baseprice": pd.to_numeric(latest["baseprice"], errors="coerce").to_numpy(dtype="float64"),
+        "workingprice": pd.to_numeric(latest["workingprice"], errors="coerce").to_numpy(dtype="float64")
+    })
+
+
+def enrich_chunk(contract_input: pd.DataFrame, prices: pd.DataFrame, today: int) -> pd.DataFrame:
+    # Шаги 2–7 для куска контрактов; contract_input содержит все версии каждого контракта куска
+    # 2. Контрольные даты: даты контракта и границы периодов цен его продукта
+    own_dates = pd.DataFrame({
+        "contract_id": np.tile(contract_input["contract_id"].to_numpy(), 3),
+        "productid": np.tile(contract_input["productid"].to_numpy(), 3),
+        "date_value": np.concatenate([contract_input["startdate"], contract_input["createdat"],
+                                      contract_input["enddate"]])
+    })
+    price_dates = pd.DataFrame({
+        "productid": np.concatenate([prices["product_id"], prices["product_id"]]),
+        "date_value": np.concatenate([prices["valid_from"], prices["valid_until"]])
+    })
+    pairs = contract_input[["contract_id", "productid"]].drop_duplicates()
+    breakpoints = pd.concat([own_dates, pairs.merge(price_dates, on="productid")], ignore_index=True)
+    breakpoints = breakpoints.dropna(subset=["date_value"]).drop_duplicates()
+
+    # 3–4. Периоды между соседними датами контракта; нулевые и последний открытый отбрасываются.
+    # При равных датах у разных продуктов одного контракта порядок задаёт productid
+    breakpoints = breakpoints.sort_values(["contract_id", "date_value", "productid"], kind="mergesort")
+    contract_ids = breakpoints["contract_id"].to_numpy()
+    starts = breakpoints["date_value"].to_numpy()
+    ends = np.full(len(starts), np.nan)
+    same_contract = contract_ids[1:] == contract_ids[:-1]
+    ends[:-1][same_contract] = starts[1:][same_contract]
+    keep = ~np.isnan(ends) & (starts != ends)
+    periods = pd.DataFrame({
+        "contract_id": contract_ids[keep],
+        "productid": breakpoints["productid"].to_numpy()[keep],
+        "period_start": starts[keep],
+        "period_end": ends[keep]
+    })
+
+    # 6. Параметры последней версии контракта (DISTINCT ON (contract_id) ... createdat DESC, startdate DESC)
+    latest_version = contract_input.sort_values(
+        ["contract_id", "createdat", "startdate"], ascending=[True, False, False], kind="mergesort"
+    ).drop_duplicates("contract_id")
+    periods = periods.merge(latest_version.drop(columns="productid"), on="contract_id")
+    periods = periods[
+        (periods["period_start"] >= periods["startdate"])
+        & (periods["enddate"].isna() | (periods["period_start"] < periods["enddate"]))
+        & (periods["period_start"] < today)
+    ].reset_index(drop=True)
+
+    # 5–6. Цены периода: LEFT JOIN по продукту и period_start BETWEEN valid_from AND valid_until
+    dedup = prices.groupby(["product_id", "valid_from", "valid_until"], as_index=False)[
+        ["baseprice", "workingprice"]].max()
+    candidates = periods[["productid", "period_start"]].reset_index().merge(
+        dedup, left_on="productid", right_on="product_id")
+    matched = candidates[(candidates["period_start"] >= candidates["valid_from"])
+                         & (candidates["period_start"] <= candidates["valid_until"])]
+    priced = periods.loc[matched["index"]].assign(
+        baseprice=matched["baseprice"].to_numpy(), workingprice=matched["workingprice"].to_numpy())
+    unpriced = periods.drop(index=matched["index"].unique()).assign(baseprice=np.nan, workingprice=np.nan)
+    rows = pd.concat([priced, unpriced]).sort_values(["contract_id", "period_start"], kind="mergesort")
+    rows = rows.reset_index(drop=True)
+
+    # 7. Финальный расчёт
+    days_in_period = (rows["period_end"] - rows["period_start"]).to_numpy()
+    days_since_start = (rows["period_start"] - rows["startdate"]).to_numpy()
+    contract_year = np.floor(days_since_start / 365.0)
+    final_end = rows["enddate"].fillna(today).to_numpy()
+    total_contract_years = np.ceil((final_end - rows["startdate"].to_numpy()) / 365.0)
+    terminated_mid_year = final_end < add_years(rows["startdate"].to_numpy(), total_contract_years)
+
+    year_keys = [rows["contract_id"], pd.Series(contract_year)]
+    total_days_in_year = pd.Series(days_in_period).groupby(year_keys).transform("sum").to_numpy()
+    year_baseprice = rows["baseprice"].groupby(year_keys).transform("max").to_numpy()
+
+    consumption = rows["consumption"].to_numpy()
+    workingprice = rows["workingprice"].fillna(0).to_numpy()
+    baseprice = rows["baseprice"].to_numpy()
+    usage_in_period = consumption * days_in_period / 365.0
+
+    base_cost = price_share_half_up(year_baseprice, days_in_period, total_days_in_year, 6)
+    variable_cost = round_half_up((workingprice / 100.0) * usage_in_period, 6)
+
+    result = pd.DataFrame({
+        "contract_id": rows["contract_id"].to_numpy(),
+        "productid": rows["productid"].to_numpy(),
+        "period_start": rows["period_start"].to_numpy(),
+        "period_end": rows["period_end"].to_numpy(),
+        "status": rows["status"].to_numpy(),
+        "consumption": consumption,
+        "startdate": rows["startdate"].to_numpy(),
+        "enddate": rows["enddate"].to_numpy(),
+        "createdat": rows["createdat"].to_numpy(),
+        "baseprice": baseprice,
+        "workingprice": rows["workingprice"].to_numpy(),
+        "days_in_period": days_in_period,
+        "days_since_start": days_since_start,
+        "contract_year": contract_year,
+        "total_contract_years": total_contract_years,
+        "final_end": final_end,
+        "terminated_mid_year": terminated_mid_year,
+        "total_days_in_year": total_days_in_year,
+        "period_share": ratio_half_up(days_in_period, total_days_in_year, 6),
+        "base_cost": base_cost,
+        "variable_cost": variable_cost,
+        "weighted_consumption": ratio_half_up(consumption * days_in_period, np.full(len(rows), 365.0), 6),
+        "consumption_share": round_half_up(np.where(consumption != 0, usage_in_period / np.where(
+            consumption != 0, consumption, 1), np.nan), 6),
+        "revenue": round_half_up(base_cost + variable_cost, 6),
+        "baseprice_total_due": round_half_up(total_contract_years * baseprice, 2)
+    })
+    for col in DATE_COLUMNS:
+        result[col] = to_dates(result[col])
+    for col in ("contract_id", "productid", "contract_year", "total_contract_years"):
+        result[col] = result[col].astype("int64")
+    return result
+
+
+def compute_enriched(contracts, price_periods: pd.DataFrame, today: date = None, chunk_size: int = None):
+    # Генератор DataFrame по кускам из chunk_size контрактов: в памяти одновременно только один кусок результата.
+    # contracts — DataFrame или поток кусков из iter_contract_chunks (все версии контракта — в одном куске)
+    chunk_size = chunk_size or revenue_chunk_size()
+    today_days = float(np.datetime64(today or date.today(), "D").astype("int64"))
+    prices = latest_price_periods(price_periods)
+    if isinstance(contracts, pd.DataFrame):
+        contracts = [contracts]
+
+    for frame in contracts:
+        contract_input = build_contract_input(frame)
+        contract_ids = np.sort(contract_input["contract_id"].unique())
+        contract_input = contract_input.sort_values("contract_id", kind="mergesort")
+        bounds = np.searchsorted(contract_input["contract_id"].to_numpy(), contract_ids[::chunk_size])
+        bounds = list(bounds) + [len(contract_input)]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            chunk = enrich_chunk(contract_input.iloc[start:end], prices, today_days)
+            if len(chunk):
+                yield chunk
+
+
+def revenue_chunk_size() -> int:
+    return int(os.getenv("REVENUE_CHUNK_SIZE", str(CHUNK_SIZE)))
+
+
+def iter_contract_chunks(shard: int = 0, shards: int = 1, chunk_size: int = None):
+    # Версии контрактов шарда читаются серверным курсором (stream_results) по возрастанию contract_id
+    # кусками по chunk_size строк: в памяти — не больше одного куска, а не весь шард. Версии последнего
+    # контракта куска переносятся в следующий, чтобы окно по contract_id в расчёте не разрывалось
+    chunk_size = chunk_size or revenue_chunk_size()
+    params = {"shard": shard, "shards": shards}
+    carry, versions = None, 0
+    with get_engine().connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        for frame in pd.read_sql(text("""
+            SELECT contract_id, product_id, status, usage, usagenet, createdat, valid_from, valid_until, snapshot_date
+            FROM dwh.contracts
+            WHERE status <> 'indelivery'
+              AND (:shards = 1 OR mod(contract_id, :shards) = :shard)
+            ORDER BY contract_id
+        """), conn, params=params, chunksize=chunk_size):
+            versions += len(frame)
+            if carry is not None:
+                frame = pd.concat([carry, frame], ignore_index=True)
+            tail = frame["contract_id"] == frame["contract_id"].iloc[-1]
+            carry = frame[tail]
+            if not tail.all():
+                yield frame[~tail]
+    if carry is not None:
+        yield carry
+    print(f"[DEBUG] Шард {shard}/{shards}: прочитано {versions} версий контрактов")
+
+
+def read_revenue_inputs(shard: int = 0, shards: int = 1, chunk_size: int = None):
+    # Все периоды цен последнего слепка (их немного) и поток кусков версий контрактов шарда
+    # (окно по contract_id не пересекает шарды)
+    with get_engine().connect() as conn:
+        price_periods = pd.read_sql(text("""
+            SELECT snapshot_date, product_id, valid_from, valid_until, baseprice, workingprice
+            FROM dwh.price_periods
+            WHERE snapshot_date = (SELECT MAX(snapshot_date) FROM dwh.price_periods)
+        """), conn)
+    print(f"[DEBUG] Шард {shard}/{shards}: {len(price_periods)} периодов цен")
+    return iter_contract_chunks(shard, shards, chunk_size), price_periods
+
+
+def enriched_to_csv_buffer(df: pd.DataFrame) -> io.StringIO:
+    out = df[ENRICHED_COLUMNS].copy()
+    for col in DATE_COLUMNS:
+        out[col] = out[col].dt.strftime("%Y-%m-%d")
+    buffer = io.StringIO()
+    out.to_csv(buffer, index=False, header=False, float_format="%.10f")
+    buffer.seek(0)
+    return buffer
+
+
+def run_shard(shard: int, shards: int, chunk_size: int = None, today: date = None) -> int:
+    # Пересчитывает строки dwh.contract_price_enriched одного шарда в одной транзакции
+    contracts, price_periods = read_revenue_inputs(shard, shards, chunk_size)
+    rows = 0
+    with get_engine().begin() as conn:
+        conn.execute(text("""
+            DELETE FROM dwh.contract_price_enriched
+            WHERE :shards = 1 OR mod(contract_id, :shards) = :shard
+        """), {"shard": shard, "shards": shards})
+        cursor = conn.connection.cursor()
+        try:
+            for chunk in compute_enriched(contracts, price_periods, today, chunk_size):
+                cursor.copy_expert(
+                    f"COPY dwh.contract_price_enriched ({', '.join(ENRICHED_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                    enriched_to_csv_buffer(chunk)
+                )
+                rows += len(chunk)
+        finally:
+            cursor.close()
+    print(f"[LOAD] ✅ Шард {shard}/{shards}: записано {rows} строк в dwh.contract_price_enriched")
+    return rows
+
+
+def run_revenue(shards: int = 1, workers: int = 1, chunk_size: int = None, job=None) -> int:
+    # Шарды считаются в отдельных процессах: numpy/pandas-часть упирается в GIL только частично,
+    # а процессы дают и CPU, и собственные соединения. spawn, а не fork: run_revenue вызывается
+    # и из многопоточного etl-runner, где fork может унаследовать захваченные блокировки
+    shards = max(1, shards)
+    with get_engine().connect() as conn:
+        if conn.execute(text("SELECT to_regclass('dwh.contract_price_enriched')")).scalar() is None:
+            raise RuntimeError("dwh.contract_price_enriched не создана: сначала выполните sql/load_contracts_enriched.sql")
+    # Состояние берётся до чтения контрактов: версии, пришедшие во время расчёта, подхватит следующий запуск
+    state = read_incremental_state()
+    if job:
+        job.set_files_total(shards)
+    total = 0
+    if workers <= 1 or shards == 1:
+        results = (run_shard(shard, shards, chunk_size) for shard in range(shards))
+        for shard, rows in enumerate(results):
+            total += rows
+            if job:
+                job.file_done(f"shard_{shard}", rows)
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, shards),
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(run_shard, shard, shards, chunk_size) for shard in range(shards)]
+            for shard, future in enumerate(futures):
+                rows = future.result()
+                total += rows
+                if job:
+                    job.file_done(f"shard_{shard}", rows)
+    save_incremental_state(*state)
+    return total
+
+
+def read_incremental_state():
+    # High-water mark по dwh.contracts.inserted_at и отпечатки периодов цен последнего слепка —
+    # теми же выражениями, что шаги 0 и 10 sql/load_contracts_enriched.sql
+    with get_engine().connect() as conn:
+        high_water_mark = conn.execute(text("SELECT MAX(inserted_at) FROM dwh.contracts")).scalar()
+        price_hashes = conn.execute(text("""
+            SELECT
+              product_id,
+              md5(string_agg(CONCAT_WS('::', valid_from, valid_until, baseprice, workingprice), '|'
+                             ORDER BY valid_from, valid_until, baseprice, workingprice)) AS price_hash
+            FROM dwh.price_periods
+            WHERE snapshot_date = (SELECT MAX(snapshot_date) FROM dwh.price_periods)
+            GROUP BY product_id
+        """)).mappings().all()
+    return high_water_mark, [dict(row) for row in price_hashes]
+
+
+def save_incremental_state(high_water_mark, price_hashes: list):
+    # Полный пересчёт всех шардов — то же, что ENRICHED_MODE=full в SQL: фиксируем его состояние,
+    # чтобы следующий incremental считал изменения от этого расчёта, а не от прошлого SQL-запуска.
+    # Отдельный шард (--shard) состояние не меняет: остальные шарды посчитаны по старому
+    with get_engine().begin() as conn:
+        conn.execute(text("""
+            INSERT INTO dwh.etl_watermarks (name, high_water_mark, run_date, updated_at)
+            SELECT 'contract_price_enriched',
+                   COALESCE(CAST(:high_water_mark AS TIMESTAMP), w.high_water_mark, TIMESTAMP '1970-01-01'),
+                   CURRENT_DATE, now()
+            FROM (SELECT 1) one
+            LEFT JOIN dwh.etl_watermarks w ON w.name = 'contract_price_enriched'
+            ON CONFLICT (name) DO UPDATE
+            SET high_water_mark = EXCLUDED.high_water_mark,
+                run_date = EXCLUDED.run_date,
+                updated_at = EXCLUDED.updated_at
+        """), {"high_water_mark": high_water_mark})
+        conn.execute(text("DELETE FROM dwh.contract_price_enriched_price_hashes"))
+        if price_hashes:
+            conn.execute(text("""
+                INSERT INTO dwh.contract_price_enriched_price_hashes (product_id, price_hash)
+                VALUES (:product_id, :price_hash)
+            """), price_hashes)
+    print(f"[LOAD] ✅ Состояние инкрементального расчёта обновлено: high-water mark {high_water_mark}, "
+          f"отпечатков цен {len(price_hashes)}")
+
+
+def verify(shard: int = 0, shards: int = 1, chunk_size: int = None, reference_dir: str = None) -> bool:
+    # Сверка с dwh.contract_price_enriched (построчно) и с выгрузками в корне проекта (агрегаты)
+    contracts, price_periods = read_revenue_inputs(shard, shards, chunk_size)
+    computed = pd.concat(list(compute_enriched(contracts, price_periods, chunk_size=chunk_size)), ignore_index=True)
+    with get_engine().connect() as conn:
+        stored = pd.read_sql(text(f"""
+            SELECT {', '.join(ENRICHED_COLUMNS)}
+            FROM dwh.contract_price_enriched
+            WHERE :shards = 1 OR mod(contract_id, :shards) = :shard
+        """), conn, params={"shard": shard, "shards": shards})
+
+    keys = ["contract_id", "productid", "period_start"]
+    for col in DATE_COLUMNS:
+        stored[col] = pd.to_datetime(stored[col]).astype("datetime64[s]")
+    merged = computed.merge(stored, on=keys, how="outer", suffixes=("", "_db"), indicator=True)
+    missing = int((merged["_merge"] != "both").sum())
+    both = merged[merged["_merge"] == "both"]
+    mismatched = {}
+    for col in ENRICHED_COLUMNS:
+        if col in keys:
+            continue
+        left, right = both[col], both[f"{col}_db"]
+        if col in DATE_COLUMNS or col in ("status", "terminated_mid_year"):
+            diff = ~((left == right) | (left.isna() & right.isna()))
+        else:
+            left, right = left.astype("float64"), pd.to_numeric(right, errors="coerce").astype("float64")
+            diff = ~((np.abs(left - right) <= 1e-6) | (left.isna() & right.isna()))
+        if diff.any():
+            mismatched[col] = int(diff.sum())
+
+    print(f"[VALIDATION] Строк: рассчитано {len(computed)}, в dwh.contract_price_enriched {len(stored)}, "
+          f"без пары {missing}")
+    if mismatched:
+        print(f"[VALIDATION] ❌ Расхождения по колонкам: {mismatched}")
+    else:
+        print("[VALIDATION] ✅ Совпадает с dwh.contract_price_enriched")
+
+    ok = missing == 0 and not mismatched
+    if reference_dir and shards == 1:
+        ok = compare_reference(computed, reference_dir) and ok
+    return ok
+
+
+def compare_reference(computed: pd.DataFrame, reference_dir: str) -> bool:
+    # Выгрузки ответов на вопросы кейса (см. README): выручка совпадает с точностью до 0.01,
+    # потребление — точно, и ни одной строки без пары ни в расчёте, ни в выгрузке
+    by_product = computed.groupby(["createdat", "productid"], as_index=False)[["revenue", "consumption"]].sum()
+    reference = pd.read_csv(os.path.join(reference_dir, "cons_rev_attached_creatdat_prodid.csv"),
+                            parse_dates=["createdat"])
+    merged = reference.merge(by_product, on=["createdat", "productid"], how="outer", indicator=True)
+    both = merged[merged["_merge"] == "both"]
+    unmatched = int((merged["_merge"] != "both").sum())
+    revenue_bad = int((np.abs(both["sum_revenue"] - both["revenue"]) > 0.01).sum())
+    consumption_bad = int((both["sum_consumption"] != both["consumption"]).sum())
+    print(f"[VALIDATION] cons_rev_attached_creatdat_prodid.csv: {len(reference)} строк, "
+          f"расхождений по выручке (±0.01) {revenue_bad}, по потреблению {consumption_bad}, без пары {unmatched}")
+    ok = unmatched == 0 and revenue_bad == 0 and consumption_bad == 0
+
+    # Выгрузка покрывает только 01.10.2020–01.01.2021: сверяются её дни, и каждый должен быть в расчёте
+    by_date = computed.groupby("createdat", as_index=False)["revenue"].sum()
+    reference = pd.read_csv(os.path.join(reference_dir, "change_of_revenue_between_01102020_and_01012021.csv"),
+                            sep=";", decimal=",", usecols=[0, 1])
+    reference["createdat"] = pd.to_datetime(reference["createdat"], format="%d.%m.%Y")
+    merged = reference.merge(by_date, on="createdat", how="left")
+    unmatched = int(merged["revenue"].isna().sum())
+    revenue_diff = np.abs(merged["sum_revenue"] - merged["revenue"])
+    revenue_bad = int((revenue_diff > 0.01).sum())
+    print(f"[VALIDATION] change_of_revenue_between_01102020_and_01012021.csv: {len(reference)} дней, "
+          f"расхождений по выручке (±0.01) {revenue_bad}, нет в расчёте {unmatched}, "
+          f"макс. отклонение {revenue_diff.max():.2f}")
+    ok = ok and unmatched == 0 and revenue_bad == 0
+
+    print("[VALIDATION] ✅ Совпадает с выгрузками" if ok else "[VALIDATION] ❌ Не совпадает с выгрузками")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--shard", type=int, default=None, help="посчитать только один шард")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--verify", action="store_true", help="сверить расчёт без записи в базу")
+    parser.add_argument("--reference-dir", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.verify:
+        ok = verify(args.shard or 0, args.shards, args.chunk_size, args.reference_dir)
+        raise SystemExit(0 if ok else 1)
+    if args.shard is not None:
+        run_shard(args.shard, args.shards, args.chunk_size)
+    else:
+        run_revenue(args.shards, args.workers, args.chunk_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,3 +14,102 @@ EXPECTED_COLUMNS = {
         "status", "productid", "modificationdate"
     }
 }
+
+INTEGER_TYPES = ("smallint", "int", "integer", "bigint")
+
+# Типы колонок staging-таблиц (совпадают с columns_by_table в DAG)
+STAGING_COLUMN_TYPES = {
+    "products": [
+        ("id", "bigint"),
+        ("deleted", "smallint"),
+        ("releasedversion", "text"),
+        ("productcode", "text"),
+        ("productname", "text"),
+        ("energy", "text"),
+        ("consumptiontype", "text"),
+        ("modificationdate", "timestamp")
+    ],
+    "prices": [
+        ("id", "bigint"),
+        ("productid", "int"),
+        ("pricecomponentid", "int"),
+        ("pricecomponent", "text"),
+        ("price", "numeric(38,10)"),
+        ("unit", "text"),
+        ("valid_from", "timestamp"),
+        ("valid_until", "timestamp"),
+        ("modificationdate", "timestamp")
+    ],
+    "contracts": [
+        ("id", "bigint"),
+        ("type", "text"),
+        ("energy", "text"),
+        ("usage", "int"),
+        ("usagenet", "int"),
+        ("createdat", "timestamp"),
+        ("startdate", "timestamp"),
+        ("enddate", "timestamp"),
+        ("filingdatecancellation", "timestamp"),
+        ("cancellationreason", "text"),
+        ("city", "text"),
+        ("status", "text"),
+        ("productid", "int"),
+        ("modificationdate", "timestamp")
+    ]
+}
+
+# Допустимые значения целых типов PostgreSQL: за пределами COPY в staging упал бы на всём файле
+INTEGER_BOUNDS = {
+    "smallint": (-2 ** 15, 2 ** 15 - 1),
+    "int": (-2 ** 31, 2 ** 31 - 1),
+    "integer": (-2 ** 31, 2 ** 31 - 1),
+    "bigint": (-2 ** 63, 2 ** 63 - 1)
+}
+
+# Правила проверки строк при трансформации (etl.validation), в дополнение к типам из STAGING_COLUMN_TYPES:
+# not_null — обязательные поля; ranges — границы (min, max), None — без границы, целые сравниваются
+# после округления, как при ::int; date_order — пары дат, в которых первая не позже второй.
+# Строки, нарушившие хотя бы одно правило, пишутся в load_rejects и в staging не попадают
+VALIDATION_RULES = {
+    "products": {
+        "not_null": ["id", "modificationdate"],
+        "ranges": {"deleted": (0, 1)}
+    },
+    "prices": {
+        "not_null": ["id", "productid", "modificationdate"],
+        "date_order": [("valid_from", "valid_until")]
+    },
+    "contracts": {
+        "not_null": ["id", "productid", "modificationdate"],
+        "ranges": {"usage": (None, 15000), "usagenet": (None, 15000)},
+        "date_order": [("startdate", "enddate")]
+    }
+}
+
+# Низкокардинальные текстовые поля читаются как category
+CATEGORY_COLUMNS = {
+    "type", "energy", "status", "city", "consumptiontype", "unit", "pricecomponent", "cancellationreason"
+}
+
+
+def _csv_dtype(col: str, pg_type: str) -> str:
+    # bigint (id) — nullable Int64: в float64 точны только целые до 2^53, и большие id округлялись бы.
+    # Остальные целые читаются как float64: в выгрузках есть пропуски и дробные usage/usagenet
+    if pg_type == "bigint":
+        return "Int64"
+    if pg_type in INTEGER_TYPES or pg_type.startswith("numeric"):
+        return "float64"
+    if col in CATEGORY_COLUMNS:
+        return "category"
+    return "str"
+
+
+# Спецификация pd.read_csv по сущностям, выводится из STAGING_COLUMN_TYPES
+CSV_DTYPES = {
+    entity: {col: _csv_dtype(col, pg_type) for col, pg_type in columns if pg_type != "timestamp"}
+    for entity, columns in STAGING_COLUMN_TYPES.items()
+}
+CSV_PARSE_DATES = {
+    entity: [col for col, pg_type in columns if pg_type == "timestamp"]
+    for entity, columns in STAGING_COLUMN_TYPES.items()
+}
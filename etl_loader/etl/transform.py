@@ -1,69 +1,165 @@
 import os
+import io
+import csv
 import json
+import codecs
 import difflib
 import pandas as pd
-from etl.schemas import EXPECTED_COLUMNS
+from etl.utils import hashed_chunks, decompressed_chunks, compression_of, strip_compression_suffix, open_source_file
+from etl.metrics import stage_span, debug, debug_enabled
+from etl.schemas import EXPECTED_COLUMNS, STAGING_COLUMN_TYPES, INTEGER_TYPES, CSV_DTYPES, CSV_PARSE_DATES
+from etl.validation import validate_frame, check_reject_share
+
+CANDIDATE_DELIMITERS = [";", ","]
+SNIFF_BYTES = 64 * 1024
+DATE_FORMAT = "%Y-%m-%d"
+
+
+def get_matching_file(file_path: str) -> str:
+    matching_dir = os.getenv("MATCHING_DIR", "/app/matchings")
+    # Сжатая и несжатая выгрузка одного файла используют один matching-файл
+    filename = strip_compression_suffix(os.path.basename(file_path))
+    return os.path.join(matching_dir, f"matching_{filename.replace('.csv', '.json')}")
+
 
 def transform_data(file_path: str, entity: str) -> pd.DataFrame:
     print(f"[TRANSFORM] Чтение файла: {file_path}")
-    matching_dir = os.getenv("MATCHING_DIR", "/app/matchings")
-    os.makedirs(matching_dir, exist_ok=True)
-    matching_file = os.path.join(matching_dir, f"matching_{os.path.basename(file_path).replace('.csv', '.json')}")
+    with stage_span("transform", entity=entity, key=file_path, bytes=os.path.getsize(file_path)) as span:
+        matching_dir = os.getenv("MATCHING_DIR", "/app/matchings")
+        os.makedirs(matching_dir, exist_ok=True)
+        matching_file = get_matching_file(file_path)
+
+        # ✅ Используем сохранённый delimiter, если есть
+        if os.path.exists(matching_file):
+            try:
+                with open(matching_file) as f:
+                    match_data = json.load(f)
+                    delimiter = match_data.get("__delimiter__")
+                    if delimiter:
+                        print(f"[TRANSFORM] 📎 Используем сохранённый разделитель: '{delimiter}'")
+                        df = read_entity_csv(file_path, entity, delimiter)
+                        df.columns = [col.strip().replace('\ufeff', '') for col in df.columns]
+                        debug(f"[DEBUG] 📋 Колонки после чтения: {list(df.columns)}")
+                        if check_column_match(df, entity, file_path, delimiter):
+                            print(f"[TRANSFORM] ✅ Успешно прочитано с сохранённым разделителем '{delimiter}'")
+                            span["rows"] = len(df)
+                            return df
+                        else:
+                            raise ValueError("[TRANSFORM] ⚠️ Структура не соответствует, несмотря на сохранённый разделитель.")
+            except Exception as e:
+                print(f"[TRANSFORM] ⚠ Ошибка при чтении matching-файла: {e}")
+
+            print(f"[TRANSFORM] 🛑 Matching-файл уже существует — пропускаем подбор лучшего разделителя.")
+            raise ValueError(f"[TRANSFORM] Не удалось прочитать файл {file_path} с корректной структурой.")
+
+        # 🧠 Подбор разделителя по заголовку (первые SNIFF_BYTES байт) и одно полное чтение файла
+        header_line = read_header_line(file_path)
+        best_sep = detect_header_delimiter(header_line, entity)
 
-    # ✅ Используем сохранённый delimiter, если есть
-    if os.path.exists(matching_file):
         try:
-            with open(matching_file) as f:
-                match_data = json.load(f)
-                delimiter = match_data.get("__delimiter__")
-                if delimiter:
-                    print(f"[TRANSFORM] 📎 Используем сохранённый разделитель: '{delimiter}'")
-                    df = pd.read_csv(file_path, sep=delimiter)
-                    df.columns = [col.strip().replace('\ufeff', '') for col in df.columns]
-                    print(f"[DEBUG] 📋 Колонки после чтения: {list(df.columns)}")
-                    if check_column_match(df, entity, file_path, delimiter):
-                        print(f"[TRANSFORM] ✅ Успешно прочитано с сохранённым разделителем '{delimiter}'")
-                        return df
-                    else:
-                        raise ValueError("[TRANSFORM] ⚠️ Структура не соответствует, несмотря на сохранённый разделитель.")
+            best_df = read_entity_csv(file_path, entity, best_sep, header_line)
+            best_df.columns = [col.strip().replace('\ufeff', '') for col in best_df.columns]
         except Exception as e:
-            print(f"[TRANSFORM] ⚠ Ошибка при чтении matching-файла: {e}")
+            print(f"[TRANSFORM] ⚠ Ошибка чтения с разделителем '{best_sep}': {e}")
+            best_df = None
+
+        if best_df is not None:
+            write_matching_file(matching_file, best_sep, get_missing_columns(best_df, entity), best_df.columns)
+
+            if check_column_match(best_df, entity, file_path, best_sep):
+                print(f"[TRANSFORM] ✅ Успешно прочитано с выбранным разделителем '{best_sep}'")
+                span["rows"] = len(best_df)
+                return best_df
 
-        print(f"[TRANSFORM] 🛑 Matching-файл уже существует — пропускаем подбор лучшего разделителя.")
         raise ValueError(f"[TRANSFORM] Не удалось прочитать файл {file_path} с корректной структурой.")
 
-    # 🧠 Подбор лучшего разделителя и создание нового matching-файла
-    best_result, best_missing_count, best_df, best_sep = None, float("inf"), None, None
 
-    for sep in [";", ","]:
+def csv_engine() -> str:
+    # CSV_ENGINE=pyarrow включает многопоточный парсер pyarrow (если пакет установлен)
+    engine = os.getenv("CSV_ENGINE", "c")
+    if engine == "pyarrow":
         try:
-            df = pd.read_csv(file_path, sep=sep)
-            df.columns = [col.strip().replace('\ufeff', '') for col in df.columns]
-            missing = get_missing_columns(df, entity)
-            print(f"[TRANSFORM] Попытка с разделителем '{sep}', пропущено полей: {len(missing)}")
-            if len(missing) < best_missing_count:
-                best_result, best_df, best_sep, best_missing_count = missing, df, sep, len(missing)
+            import pyarrow  # noqa: F401
+        except ImportError:
+            print("[TRANSFORM] ⚠ pyarrow не установлен, используется парсер c")
+            return "c"
+    return engine
+
+
+def read_entity_csv(file_path: str, entity: str, sep: str, header_line: str = None) -> pd.DataFrame:
+    # Явные типы из etl.schemas вместо вывода типов: category для справочных полей, даты сразу в datetime
+    columns = split_header(header_line if header_line is not None else read_header_line(file_path), sep)
+    matching_file = get_matching_file(file_path)
+    renames = {}
+    if os.path.exists(matching_file) and EXPECTED_COLUMNS.get(entity, set()) - set(columns):
+        renames, _ = read_matching_rules(matching_file, columns, verbose=False)
+
+    present = set(columns)
+    dtype = {}
+    for col, dt in CSV_DTYPES.get(entity, {}).items():
+        if renames.get(col, col) in present:
+            dtype[renames.get(col, col)] = dt
+    parse_dates = [renames.get(col, col) for col in CSV_PARSE_DATES.get(entity, []) if renames.get(col, col) in present]
+
+    # bigint (Int64 в CSV_DTYPES) читается строками и приводится к Int64 через int(): через float64
+    # оба парсера теряют точность id больше 2^53, например, если в колонке есть пропуск или "12.0"
+    bigint = [col for col, dt in dtype.items() if dt == "Int64"]
+    engine = csv_engine()
+    if engine == "pyarrow":
+        # pyarrow разбирает даты сам; секундная точность вмещает 9999-12-31.
+        # Типы колонок он выводит сам, dtype применяется уже после разбора: bigint принимаем, только если
+        # он точно приводится к Int64, иначе файл перечитывается парсером c
+        try:
+            df = pd.read_csv(file_path, sep=sep, engine="pyarrow",
+                             dtype={**{col: dt for col, dt in dtype.items() if col not in bigint},
+                                    **{col: "datetime64[s]" for col in parse_dates}})
+            for col in bigint:
+                if pd.api.types.is_float_dtype(df[col]) and (df[col].abs() >= 2 ** 53).any():
+                    raise ValueError(f"{col}: значения больше 2^53 прочитаны через float64")
+                df[col] = df[col].astype("Int64")
+            return df
         except Exception as e:
-            print(f"[TRANSFORM] ⚠ Ошибка чтения с разделителем '{sep}': {e}")
+            print(f"[TRANSFORM] ⚠ pyarrow не смог прочитать {file_path} ({e}), повтор с парсером c")
+    dtype = {col: "str" if col in bigint else dt for col, dt in dtype.items()}
+    # Значения вне диапазона datetime64[ns] (9999-12-31) оставляют колонку строковой
+    try:
+        df = pd.read_csv(file_path, sep=sep, dtype=dtype, parse_dates=parse_dates, date_format=DATE_FORMAT)
+    except ValueError as e:
+        # Нечисловое значение в числовой колонке: такие колонки читаются строками,
+        # а строки с ошибкой отклоняет etl.validation.validate_frame
+        print(f"[TRANSFORM] ⚠ Ошибка типов в {file_path} ({e}), числовые колонки читаются строками")
+        dtype = {col: "str" if dt == "float64" else dt for col, dt in dtype.items()}
+        df = pd.read_csv(file_path, sep=sep, dtype=dtype, parse_dates=parse_dates, date_format=DATE_FORMAT)
+    for col in bigint:
+        try:
+            df[col] = df[col].astype("Int64")
+        except (TypeError, ValueError, OverflowError):
+            # "12.0", текст или значение вне bigint: колонка остаётся строковой, её разбирает
+            # и построчно отклоняет etl.validation.parse_bigint
+            pass
+    return df
+
 
-    if best_df is not None:
-        match_data = {"__delimiter__": best_sep}
-        for miss in best_result:
-            close = difflib.get_close_matches(miss, set(best_df.columns), n=1, cutoff=0.6)
-            match_data[miss] = {
-                "suggested": close[0] if close else None,
-                "user_submitted": 0,
-                "pass_as_null": 0
-            }
-        with open(matching_file, "w") as f:
-            json.dump(match_data, f, indent=2, ensure_ascii=False)
-        print(f"[TRANSFORM] 💡 Записан лучший разделитель '{best_sep}' в matching-файл")
+def read_header_line(file_path: str, sample_size: int = SNIFF_BYTES) -> str:
+    # Читаем только начало файла: для выбора разделителя достаточно строки заголовка
+    # (у сжатой выгрузки — начало распакованного потока)
+    with open_source_file(file_path) as f:
+        sample = f.read(sample_size)
+    return sample.decode("utf-8-sig", errors="replace").split("\n", 1)[0]
 
-        if check_column_match(best_df, entity, file_path, best_sep):
-            print(f"[TRANSFORM] ✅ Успешно прочитано с выбранным разделителем '{best_sep}'")
-            return best_df
 
-    raise ValueError(f"[TRANSFORM] Не удалось прочитать файл {file_path} с корректной структурой.")
+def write_matching_file(matching_file: str, sep: str, missing, columns):
+    match_data = {"__delimiter__": sep}
+    for miss in missing:
+        close = difflib.get_close_matches(miss, set(columns), n=1, cutoff=0.6)
+        match_data[miss] = {
+            "suggested": close[0] if close else None,
+            "user_submitted": 0,
+            "pass_as_null": 0
+        }
+    with open(matching_file, "w") as f:
+        json.dump(match_data, f, indent=2, ensure_ascii=False)
+    print(f"[TRANSFORM] 💡 Записан лучший разделитель '{sep}' в matching-файл")
 
 
 def get_missing_columns(df: pd.DataFrame, entity: str):
@@ -71,6 +167,25 @@ def get_missing_columns(df: pd.DataFrame, entity: str):
     return expected - set(df.columns)
 
 
+def read_matching_rules(matching_file: str, columns, verbose: bool = True):
+    # Подтверждённые переименования (целевое поле -> колонка файла) и поля, заполняемые no_data
+    confirmed, fill_as_null = {}, set()
+    with open(matching_file) as f:
+        match_data = json.load(f)
+        if verbose and debug_enabled():
+            print(f"[VALIDATION] 📄 Содержимое matching-файла:")
+            print(json.dumps(match_data, indent=2, ensure_ascii=False))
+
+        for target, rule in match_data.items():
+            if target.startswith("__"):
+                continue
+            if rule.get("user_submitted") == 1 and rule.get("suggested") in columns:
+                confirmed[target] = rule["suggested"]
+            elif rule.get("pass_as_null") == 1:
+                fill_as_null.add(target)
+    return confirmed, fill_as_null
+
+
 def check_column_match(df: pd.DataFrame, entity: str, file_path: str, sep: str) -> bool:
     expected = EXPECTED_COLUMNS.get(entity, set())
     actual = set(df.columns)
@@ -78,29 +193,15 @@ def check_column_match(df: pd.DataFrame, entity: str, file_path: str, sep: str)
     if not missing:
         return True
 
-    matching_dir = os.getenv("MATCHING_DIR", "/app/matchings")
-    matching_file = os.path.join(matching_dir, f"matching_{os.path.basename(file_path).replace('.csv', '.json')}")
-
-    confirmed, fill_as_null = {}, set()
+    matching_file = get_matching_file(file_path)
 
     try:
-        with open(matching_file) as f:
-            match_data = json.load(f)
-            print(f"[VALIDATION] 📄 Содержимое matching-файла:")
-            print(json.dumps(match_data, indent=2, ensure_ascii=False))
-
-            for target, rule in match_data.items():
-                if target.startswith("__"):
-                    continue
-                if rule.get("user_submitted") == 1 and rule.get("suggested") in df.columns:
-                    confirmed[target] = rule["suggested"]
-                elif rule.get("pass_as_null") == 1:
-                    fill_as_null.add(target)
+        confirmed, fill_as_null = read_matching_rules(matching_file, df.columns)
 
         if confirmed:
             print(f"[VALIDATION] ✅ Подтверждённые сопоставления: {confirmed}")
             df.rename(columns={v: k for k, v in confirmed.items()}, inplace=True)
-            print(f"[DEBUG] 🧾 Колонки после переименования: {list(df.columns)}")
+            debug(f"[DEBUG] 🧾 Колонки после переименования: {list(df.columns)}")
 
         for col in fill_as_null:
             if col not in df.columns:
@@ -114,3 +215,196 @@ def check_column_match(df: pd.DataFrame, entity: str, file_path: str, sep: str)
         print(f"[VALIDATION] ⚠ Ошибка при чтении matching-файла: {e}")
 
     return False
+
+
+# ---------------------------------------------------------------------------
+# Потоковый режим: объект читается кусками, заголовок проверяется по matching-файлу,
+# строки перекладываются в порядок колонок staging-таблицы и отдаются в COPY FROM STDIN.
+# ---------------------------------------------------------------------------
+
+def iter_text_lines(chunks):
+    # Декодирование кусков байт в строки (с сохранением перевода строки для csv.reader)
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    tail = ""
+    for chunk in chunks:
+        tail += decoder.decode(chunk)
+        parts = tail.split("\n")
+        tail = parts.pop()
+        for part in parts:
+            yield part + "\n"
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def split_header(header_line: str, sep: str):
+    row = next(csv.reader([header_line], delimiter=sep), [])
+    return [col.strip().replace('\ufeff', '') for col in row]
+
+
+def score_delimiter(header_line: str, sep: str, entity: str):
+    # Меньше — лучше: поля без точного совпадения и без подсказки difflib, затем все пропущенные,
+    # затем (при равенстве) вариант с большим числом колонок
+    columns = split_header(header_line, sep)
+    missing = EXPECTED_COLUMNS.get(entity, set()) - set(columns)
+    unresolved = [m for m in missing if not difflib.get_close_matches(m, columns, n=1, cutoff=0.6)]
+    return (len(unresolved), len(missing), -len(columns))
+
+
+def detect_header_delimiter(header_line: str, entity: str) -> str:
+    best_sep, best_score = None, None
+    for sep in CANDIDATE_DELIMITERS:
+        score = score_delimiter(header_line, sep, entity)
+        print(f"[TRANSFORM] Попытка с разделителем '{sep}', пропущено полей: {score[1]}, без подсказки: {score[0]}")
+        if best_score is None or score < best_score:
+            best_sep, best_score = sep, score
+    return best_sep
+
+
+def integer_text(value: str) -> str:
+    # В выгрузках встречаются дробные usage/usagenet ("2677.5"); округляем как PostgreSQL при ::int.
+    # Нулевую дробную часть просто отбрасываем: через float большие bigint-id потеряли бы точность
+    if "." in value:
+        whole, _, fraction = value.partition(".")
+        if not fraction.strip("0"):
+            return whole
+        return str(round(float(value)))
+    return value
+
+
+class StagingCsvStream:
+    """Файлоподобный объект для cursor.copy_expert: CSV в порядке колонок staging-таблицы."""
+
+    def __init__(self, lines, sep: str, sources, hasher=None, entity: str = None):
+        # sources: список (индекс колонки в файле | None, значение-заполнитель, конвертер | None) по колонкам staging.
+        # entity — строки проверяются etl.validation пакетами по ETL_STREAM_BATCH_ROWS: отклонённые не идут
+        # в COPY и копятся в rejects (для load_rejects), чтобы одна битая строка не роняла весь файл
+        self._rows = (row for row in csv.reader(lines, delimiter=sep) if row)
+        self._sources = sources
+        self._entity = entity
+        self._batch_rows = int(os.getenv("ETL_STREAM_BATCH_ROWS", "10000"))
+        self._out = io.StringIO()
+        self._writer = csv.writer(self._out, lineterminator="\n")
+        self._buffer = ""
+        self._hasher = hasher
+        self._read_rows = 0
+        self._rejects = []
+        self._finished = False
+        self.rows = 0
+
+    @property
+    def content_hash(self):
+        # sha256 исходных байт; полный только после того, как поток прочитан до конца
+        return self._hasher.hexdigest() if self._hasher else None
+
+    @property
+    def rejects(self):
+        return pd.concat(self._rejects, ignore_index=True) if self._rejects else None
+
+    def _fill(self, size: int):
+        while self._out.tell() < size:
+            batch = []
+            for row in self._rows:
+                batch.append([row[idx] if idx is not None and idx < len(row) else fill
+                              for idx, fill, _ in self._sources])
+                if len(batch) >= self._batch_rows:
+                    break
+            if not batch:
+                self._finish()
+                break
+            offset, self._read_rows = self._read_rows, self._read_rows + len(batch)
+            if self._entity:
+                batch = self._validate(batch, offset)
+            for values in batch:
+                self._writer.writerow([convert(value) if convert and value else value
+                                       for value, (_, _, convert) in zip(values, self._sources)])
+            self.rows += len(batch)
+        self._buffer += self._out.getvalue()
+        self._out.seek(0)
+        self._out.truncate()
+
+    def _validate(self, batch, offset: int):
+        # Индекс — номер строки данных в файле, как у read_csv: validate_frame считает по нему row_number
+        columns = [col for col, _ in STAGING_COLUMN_TYPES[self._entity]]
+        frame = pd.DataFrame(batch, columns=columns, index=pd.RangeIndex(offset, offset + len(batch)))
+        frame = frame.mask(frame == "")
+        clean, rejects = validate_frame(frame, self._entity, whole_file=False)
+        if rejects is None:
+            return batch
+        self._rejects.append(rejects)
+        return [batch[i - offset] for i in clean.index]
+
+    def _finish(self):
+        # Доля отклонённых — по всему файлу, когда он прочитан; COPY вызывает read и после конца потока
+        if self._finished:
+            return
+        self._finished = True
+        rejects = self.rejects
+        if rejects is not None:
+            check_reject_share(rejects, self._read_rows, self._entity)
+
+    def read(self, size: int = -1) -> str:
+        if size is None or size < 0:
+            size = 1 << 62
+        if len(self._buffer) < size:
+            self._fill(size - len(self._buffer))
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size: int = -1) -> str:
+        return self.read(size)
+
+
+def stream_transform(chunks, file_path: str, entity: str, hasher=None) -> StagingCsvStream:
+    print(f"[TRANSFORM] Потоковое чтение файла: {file_path}")
+    if hasher is not None:
+        chunks = hashed_chunks(chunks, hasher)
+    # content_hash считается по байтам объекта как он лежит в S3, распаковка — после хеширования
+    chunks = decompressed_chunks(chunks, compression_of(file_path))
+    matching_dir = os.getenv("MATCHING_DIR", "/app/matchings")
+    os.makedirs(matching_dir, exist_ok=True)
+    matching_file = get_matching_file(file_path)
+    expected = EXPECTED_COLUMNS.get(entity, set())
+
+    lines = iter_text_lines(chunks)
+    header_line = next(lines, "")
+
+    if os.path.exists(matching_file):
+        with open(matching_file) as f:
+            delimiter = json.load(f).get("__delimiter__")
+        if not delimiter:
+            raise ValueError(f"[TRANSFORM] В matching-файле {matching_file} нет разделителя.")
+        print(f"[TRANSFORM] 📎 Используем сохранённый разделитель: '{delimiter}'")
+        columns = split_header(header_line, delimiter)
+    else:
+        delimiter = detect_header_delimiter(header_line, entity)
+        columns = split_header(header_line, delimiter)
+        write_matching_file(matching_file, delimiter, expected - set(columns), columns)
+    debug(f"[DEBUG] 📋 Колонки в заголовке: {columns}")
+
+    index = {col: i for i, col in enumerate(columns)}
+    confirmed, fill_as_null = {}, set()
+    if expected - set(columns):
+        confirmed, fill_as_null = read_matching_rules(matching_file, columns)
+        if confirmed:
+            print(f"[VALIDATION] ✅ Подтверждённые сопоставления: {confirmed}")
+
+    sources = []
+    still_missing = set()
+    for col, dtype in STAGING_COLUMN_TYPES[entity]:
+        convert = integer_text if dtype in INTEGER_TYPES else None
+        if col in index:
+            sources.append((index[col], None, convert))
+        elif col in confirmed:
+            sources.append((index[confirmed[col]], None, convert))
+        elif col in fill_as_null:
+            sources.append((None, "no_data", None))
+        else:
+            still_missing.add(col)
+
+    if still_missing:
+        print(f"[VALIDATION] ❌ Не все поля покрыты: {still_missing}")
+        raise ValueError(f"[TRANSFORM] Не удалось прочитать файл {file_path} с корректной структурой.")
+
+    print(f"[TRANSFORM] ✅ Заголовок проверен, разделитель '{delimiter}'")
+    return StagingCsvStream(lines, delimiter, sources, hasher, entity=entity)
@@ -1,5 +1,95 @@
 import os
+import gzip
+import zlib
+import hashlib
+
+# Сжатые выгрузки: расширение после .csv -> тип сжатия (те же имена, что у compression= в pandas)
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
 
 def ensure_dir(path: str):
     if not os.path.exists(path):
-        os.makedirs(path)
\ No newline at end of file
+        os.makedirs(path)
+
+
+def iter_months(start: str, end: str):
+    # Месяцы YYYYMM от start до end включительно
+    if not (len(start) == 6 and start.isdigit() and len(end) == 6 and end.isdigit()):
+        raise ValueError(f"Ожидаются месяцы в формате YYYYMM, получено: {start}..{end}")
+    year, month = int(start[:4]), int(start[4:])
+    while f"{year:04d}{month:02d}" <= end:
+        yield f"{year:04d}{month:02d}"
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def hashed_chunks(chunks, hasher):
+    # Хеш содержимого считается попутно, пока куски уходят дальше по конвейеру
+    for chunk in chunks:
+        hasher.update(chunk)
+        yield chunk
+
+
+def compression_of(path: str):
+    for suffix, compression in COMPRESSION_SUFFIXES.items():
+        if path.endswith(suffix):
+            return compression
+    return None
+
+
+def strip_compression_suffix(name: str) -> str:
+    # 20201001220144_contracts.csv.gz -> 20201001220144_contracts.csv
+    for suffix in COMPRESSION_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def zstd_module():
+    # zstandard нужен только для .zst-выгрузок
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Для выгрузок .csv.zst нужен пакет zstandard (pip install zstandard)")
+    return zstandard
+
+
+def open_source_file(path: str):
+    # Бинарный файл с распаковкой на лету: сжатая выгрузка не разворачивается на диск
+    compression = compression_of(path)
+    if compression == "gzip":
+        return gzip.open(path, "rb")
+    if compression == "zstd":
+        return zstd_module().open(path, "rb")
+    return open(path, "rb")
+
+
+def new_decompressor(compression: str):
+    if compression == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return zstd_module().ZstdDecompressor().decompressobj()
+
+
+def decompressed_chunks(chunks, compression: str = None):
+    # Потоковая распаковка кусков объекта. Несколько gzip-членов или zstd-кадров подряд
+    # (например, склеенные cat a.gz b.gz) распаковываются друг за другом
+    if compression is None:
+        yield from chunks
+        return
+    decompressor = new_decompressor(compression)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            chunk = decompressor.unused_data if decompressor.eof else b""
+            if chunk:
+                decompressor = new_decompressor(compression)
+    if not decompressor.eof:
+        raise ValueError(f"Сжатые данные ({compression}) оборваны до конца потока")
@@ -0,0 +1,116 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from etl.schemas import STAGING_COLUMN_TYPES, INTEGER_TYPES, INTEGER_BOUNDS, VALIDATION_RULES
+from etl.load import staging_frame
+
+ISO_DATE_PATTERN = r"\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?"
+# Последний год, который помещается в datetime64[ns]; более поздние даты (9999-12-31) — «бессрочно»
+MAX_NS_YEAR = pd.Timestamp.max.year
+
+
+def validate_frame(df: pd.DataFrame, entity: str, whole_file: bool = True):
+    # Проверка всех строк сразу (маски pandas/NumPy, без построчного цикла): типы из STAGING_COLUMN_TYPES
+    # и правила VALIDATION_RULES. Возвращает (чистые строки, отклонённые строки с причинами).
+    # whole_file=False — df только пакет строк потоковой загрузки: долю отклонённых по всему файлу
+    # проверяет transform.StagingCsvStream, номер строки в файле берётся из индекса df
+    rules = VALIDATION_RULES.get(entity, {})
+    original, df = df, df.copy()
+    checks = []
+    numbers, dates = {}, {}
+
+    for col, pg_type in STAGING_COLUMN_TYPES[entity]:
+        if col not in df.columns:
+            continue
+        values = df[col]
+        if pg_type == "bigint" and not pd.api.types.is_numeric_dtype(values):
+            df[col] = numbers[col] = parse_bigint(values, col, checks)
+        elif pg_type in INTEGER_TYPES or pg_type.startswith("numeric"):
+            if not pd.api.types.is_numeric_dtype(values):
+                # Колонка прочитана строками (см. transform.read_entity_csv): приводим и отклоняем нечисловые
+                coerced = pd.to_numeric(values, errors="coerce")
+                checks.append((coerced.isna() & values.notna(), f"{col}: не число"))
+                df[col] = values = coerced.astype("float64")
+            if pg_type in INTEGER_TYPES:
+                values = values.round()
+                low, high = INTEGER_BOUNDS[pg_type]
+                checks.append(((values < low) | (values > high), f"{col}: вне диапазона {pg_type}"))
+            numbers[col] = values
+        elif pg_type == "timestamp":
+            dates[col] = parse_dates(values, col, checks)
+
+    for col in rules.get("not_null", []):
+        checks.append((original[col].isna(), f"{col}: пусто"))
+    for col, (low, high) in rules.get("ranges", {}).items():
+        values = numbers[col]
+        if low is not None:
+            checks.append((values < low, f"{col} < {low}"))
+        if high is not None:
+            checks.append((values > high, f"{col} > {high}"))
+    for first, second in rules.get("date_order", []):
+        checks.append((dates[first] > dates[second], f"{first} > {second}"))
+
+    bad = np.zeros(len(df), dtype=bool)
+    for mask, _ in checks:
+        bad |= mask.to_numpy(dtype=bool, na_value=False)
+    if not bad.any():
+        return df, None
+
+    # В load_rejects — исходные значения строки, в том числе не приведённые к числу
+    rejected = staging_frame(original[bad], [(col, t) for col, t in STAGING_COLUMN_TYPES[entity] if col in df.columns])
+    reasons = pd.Series("", index=rejected.index)
+    for mask, reason in checks:
+        hit = mask.to_numpy(dtype=bool, na_value=False)[bad]
+        if hit.any():
+            reasons += np.where(hit, reason + "; ", "")
+    rejects = pd.DataFrame({
+        # Номер строки в файле: индекс read_csv с нуля плюс строка заголовка
+        "row_number": rejected.index + 2,
+        "reasons": reasons.str.rstrip("; ").to_numpy(),
+        "data": [json.dumps(row, ensure_ascii=False, default=str)
+                 for row in json.loads(rejected.to_json(orient="records", date_format="iso", date_unit="s"))]
+    })
+    if whole_file:
+        check_reject_share(rejects, len(df), entity)
+    return df[~bad], rejects
+
+
+def check_reject_share(rejects: pd.DataFrame, total: int, entity: str):
+    print(f"[VALIDATION] ⚠ {entity}: отклонено {len(rejects)} из {total} строк, например: "
+          f"строка {rejects['row_number'].iloc[0]} — {rejects['reasons'].iloc[0]}")
+
+    # Отклонена большая часть файла — скорее всего, сломана структура (разделитель, сопоставления),
+    # а не отдельные строки: такой файл не загружаем
+    max_share = float(os.getenv("ETL_MAX_REJECT_SHARE", "0.5"))
+    if len(rejects) > max_share * total:
+        raise ValueError(f"[VALIDATION] Отклонено {len(rejects)} из {total} строк (больше ETL_MAX_REJECT_SHARE="
+                         f"{max_share}), причины: {rejects['reasons'].value_counts().head(3).to_dict()}")
+
+
+def parse_bigint(values: pd.Series, col: str, checks: list) -> pd.Series:
+    # bigint, прочитанный строками: через float64 большие id потеряли бы точность, поэтому
+    # значение разбирается как целое Python и проверяется по границам bigint без округления
+    text = values.astype("string").str.strip()
+    integral = text.str.fullmatch(r"[+-]?\d+(\.0*)?").fillna(False)
+    checks.append((text.notna() & ~integral, f"{col}: не целое число"))
+    digits = text.where(integral).str.replace(r"\.0*$", "", regex=True)
+    low, high = INTEGER_BOUNDS["bigint"]
+    parsed = digits.dropna().map(int)
+    out_of_range = pd.Series(False, index=values.index)
+    out_of_range[parsed.index] = parsed.map(lambda value: not low <= value <= high).astype(bool)
+    checks.append((out_of_range, f"{col}: вне диапазона bigint"))
+    return digits.where(~out_of_range).astype("Int64")
+
+
+def parse_dates(values: pd.Series, col: str, checks: list) -> pd.Series:
+    # datetime-колонку берём как есть; строковая остаётся строковой для COPY (там могут быть даты
+    # за пределами datetime64[ns]), здесь только проверяется и приводится для сравнения дат
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    text = values.astype("string").str.strip()
+    parsed = pd.to_datetime(text, format="ISO8601", errors="coerce")
+    far = (parsed.isna() & text.str.fullmatch(ISO_DATE_PATTERN).fillna(False)
+           & (pd.to_numeric(text.str[:4], errors="coerce") > MAX_NS_YEAR))
+    checks.append((parsed.isna() & text.notna() & ~far, f"{col}: не дата"))
+    return parsed.mask(far, pd.Timestamp.max)
@@ -1,47 +1,174 @@
 import argparse
+import hashlib
 import logging
 import os
-from datetime import datetime
-from etl.extract import list_matching_objects, download_file
-from etl.transform import transform_data
-from etl.load import load_to_staging
-from etl.utils import ensure_dir
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from etl.extract import list_matching_object_infos, download_file, open_object_stream, iter_chunks
+from etl.transform import transform_data, stream_transform, get_matching_file
+from etl.load import (
+    load_to_staging, load_stream_to_staging, log_failed_file, find_loaded_objects, is_unchanged, log_skipped_file,
+    staging_table_mode, drop_expired_partitions
+)
+from etl.parquet_cache import read_cached_frame, write_cached_frame
+from etl.validation import validate_frame, check_reject_share
+from etl.metrics import stage_span, debug_enabled
+from etl.utils import ensure_dir, file_sha256
+from etl.resources import dispose_resources
 
 # Логирование
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
-def run_etl(entity: str, start_month: str, end_month: str, load_id: str):
-    logger.info(f"🚀 Запуск ETL: entity={entity}, с {start_month} по {end_month}, load_id={load_id}")
+def run_etl(entity: str, start_month: str, end_month: str, load_id: str, stream: bool = False, workers: int = 1,
+            job=None, force: bool = False):
+    # job — необязательный etl.jobs.ETLJob, через который etl-runner отдаёт прогресс в /runs/{id}
+    # force — загрузить все файлы заново, даже если такой же объект уже есть в load_log
+    workers = max(1, workers)
+    logger.info(f"🚀 Запуск ETL: entity={entity}, с {start_month} по {end_month}, load_id={load_id}, "
+                f"stream={stream}, workers={workers}, force={force}")
     bucket = os.getenv("MINIO_BUCKET", "srcdata")
     temp_dir = "/tmp/etl_files"
     ensure_dir(temp_dir)
 
     try:
-        files = list_matching_objects(bucket, entity, start_month, end_month)
-        logger.info(f"🔍 Найдено {len(files)} файлов: {files}")
-        for key in files:
-            local_path = os.path.join(temp_dir, os.path.basename(key))
-            download_file(bucket, key, local_path)
-            df = transform_data(local_path, entity)
-            load_to_staging(df, entity, key, load_id)
-            logger.info(f"✔ Файл {key} обработан и загружен.")
+        objects = list_matching_object_infos(bucket, entity, start_month, end_month)
+        files = [obj["key"] for obj in objects]
+        logger.info(f"🔍 Найдено {len(files)} файлов" + (f": {files}" if debug_enabled() else ""))
+        if job:
+            job.set_files_total(len(files))
+
+        # Неизменившиеся объекты (тот же ETag и размер) пропускаем ещё до скачивания
+        previous = {} if force else find_loaded_objects(files)
+        pending = []
+        for obj in objects:
+            source = {"etag": obj.get("etag"), "size": obj.get("size")}
+            if is_unchanged(previous.get(obj["key"]), source):
+                log_skipped_file(load_id, obj["entity"], obj["key"], previous[obj["key"]], source)
+                logger.info(f"⏩ Файл {obj['key']} не изменился, используется {previous[obj['key']]['staging_table']}")
+                if job:
+                    job.file_skipped(obj["key"])
+            else:
+                pending.append(obj)
+
+        # Каждый файл обрабатывается целиком (download → transform → load) в ограниченном пуле потоков;
+        # ошибка одного файла пишется в load_log и не прерывает остальные
+        failed = {}
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="etl") as pool:
+            # Сущность берётся из имени файла: entity может быть списком через запятую
+            futures = {
+                pool.submit(process_file, bucket, obj, load_id, temp_dir, stream, previous.get(obj["key"])): obj
+                for obj in pending
+            }
+            for future in as_completed(futures):
+                key, file_entity = futures[future]["key"], futures[future]["entity"]
+                try:
+                    status, rows = future.result()
+                    logger.info(f"✔ Файл {key} обработан ({status}).")
+                    if job and status == "SKIPPED":
+                        job.file_skipped(key)
+                    elif job:
+                        job.file_done(key, rows, futures[future].get("size"))
+                except Exception as e:
+                    logger.error(f"❌ Ошибка обработки файла {key}: {e}")
+                    failed[key] = str(e)
+                    log_failed_file(load_id, file_entity, key, str(e),
+                                    source={"etag": futures[future].get("etag"), "size": futures[future].get("size")})
+                    if job:
+                        job.file_failed(key, str(e))
+
+        if failed:
+            raise RuntimeError(f"Не удалось обработать {len(failed)} из {len(files)} файлов: {sorted(failed)}")
+
+        apply_staging_retention({obj["entity"] for obj in objects})
     except Exception as e:
         logger.error(f"❌ Ошибка ETL: {e}")
         raise
 
 
+def apply_staging_retention(entities):
+    # STAGING_RETENTION_DAYS — сколько дней хранить секции секционированного staging (не задано — хранить все)
+    retention_days = os.getenv("STAGING_RETENTION_DAYS")
+    if not retention_days or staging_table_mode() != "partitioned":
+        return
+    for entity in sorted(entities):
+        try:
+            dropped = drop_expired_partitions(entity, int(retention_days))
+            if dropped:
+                logger.info(f"🗑 {entity}: удалено {len(dropped)} секций старше {retention_days} дн.")
+        except Exception as e:
+            # Очистка не должна ронять уже выполненную загрузку
+            logger.warning(f"⚠ Не удалось применить retention для {entity}: {e}")
+
+
+def process_file(bucket: str, obj: dict, load_id: str, temp_dir: str, stream: bool, previous: dict = None):
+    key, entity = obj["key"], obj["entity"]
+    source = {"etag": obj.get("etag"), "size": obj.get("size")}
+    started_at = datetime.now(timezone.utc)
+    # Тот же объект (ключ + ETag) с теми же правилами matching и проверки уже разбирался — берём из Parquet-кэша
+    # проверенные строки и отклонённые; долю отклонённых сверяем заново: ETL_MAX_REJECT_SHARE мог измениться
+    cached = read_cached_frame(entity, key, obj.get("etag"), get_matching_file(key))
+    if cached is not None:
+        df, source["content_hash"], rejects = cached
+        if rejects is not None:
+            check_reject_share(rejects, len(df) + len(rejects), entity)
+        load_to_staging(df, entity, key, load_id, source=source, started_at=started_at, rejects=rejects)
+        return "SUCCESS", len(df)
+
+    # Потоковый режим в кэш не пишет: он не собирает файл в DataFrame, а запись Parquet с content_hash
+    # в метаданных возможна только после того, как поток прочитан до конца
+
+    if stream:
+        return "SUCCESS", process_stream(bucket, key, entity, load_id, source, started_at)
+
+    local_path = os.path.join(temp_dir, os.path.basename(key))
+    download_file(bucket, key, local_path, entity=entity)
+    # ETag изменился, но содержимое то же (например, объект перезалили) — загрузку всё равно пропускаем
+    source["content_hash"] = file_sha256(local_path)
+    if is_unchanged(previous, source):
+        log_skipped_file(load_id, entity, key, previous, source, started_at=started_at)
+        return "SKIPPED", previous.get("rows_loaded") or 0
+
+    df = transform_data(local_path, entity)
+    df, rejects = validate_frame(df, entity)
+    # Ключ кэша считается после разбора: transform_data мог создать matching-файл
+    write_cached_frame(df, entity, key, obj.get("etag"), get_matching_file(key), source["content_hash"], rejects)
+    load_to_staging(df, entity, key, load_id, source=source, started_at=started_at, rejects=rejects)
+    return "SUCCESS", len(df)
+
+
+def process_stream(bucket: str, key: str, entity: str, load_id: str, source: dict = None,
+                   started_at: datetime = None) -> int:
+    # Объект читается кусками из get_object и сразу уходит в COPY — без /tmp и без DataFrame
+    # Скачивание, разбор и COPY идут одним конвейером, поэтому замеряются одним этапом stream
+    with stage_span("stream", entity=entity, key=key, bytes=(source or {}).get("size")) as span:
+        body = open_object_stream(bucket, key)
+        try:
+            stream = stream_transform(iter_chunks(body), key, entity, hasher=hashlib.sha256())
+            span["rows"] = load_stream_to_staging(stream, entity, key, load_id, source=source, started_at=started_at)
+            return span["rows"]
+        finally:
+            body.close()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--entity", type=str, required=True)
     parser.add_argument("--start", type=str, required=False)
     parser.add_argument("--end", type=str, required=True)
     parser.add_argument("--load_id", type=str, required=True, help="Уникальный идентификатор загрузки (например, 20240501_123456789)")
+    parser.add_argument("--stream", action="store_true", help="Потоковая загрузка из S3 в PostgreSQL без временных файлов")
+    parser.add_argument("--force", action="store_true", help="Загрузить файлы заново, даже если они уже есть в load_log")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("ETL_WORKERS", "1")), help="Число файлов, обрабатываемых одновременно")
     args = parser.parse_args()
 
     if not args.start:
         args.start = args.end
 
-    run_etl(args.entity, args.start, args.end, args.load_id)
+    try:
+        run_etl(args.entity, args.start, args.end, args.load_id, stream=args.stream, workers=args.workers,
+                force=args.force)
+    finally:
+        dispose_resources()
 
@@ -1,39 +1,108 @@
-from fastapi import FastAPI, HTTPException
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Response
 from pydantic import BaseModel
-import subprocess
+import os
+from etl.resources import dispose_resources
+from etl.jobs import ETLJob, JobRegistry
+from etl.metrics import render_metrics
+from etl_main import run_etl as run_etl_job
+from etl.revenue import run_revenue
 
-app = FastAPI()
+# ETL выполняется в этом же процессе в фоновом пуле: без старта интерпретатора на каждый запрос
+# и с общими тёплыми соединениями к S3 и PostgreSQL для всех задач Airflow
+executor = ThreadPoolExecutor(max_workers=int(os.getenv("ETL_RUNNER_MAX_JOBS", "3")), thread_name_prefix="etl-job")
+jobs = JobRegistry(max_jobs=int(os.getenv("ETL_RUNNER_KEEP_JOBS", "200")))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Дожидаемся уже запущенных задач, закрываем общий S3-клиент и пул соединений PostgreSQL
+    executor.shutdown(wait=True, cancel_futures=True)
+    dispose_resources()
+
+
+app = FastAPI(lifespan=lifespan)
 
 class ETLRequest(BaseModel):
     entity: str
     start_month: str
     end_month: str
     load_id: str  # <-- добавляем
+    stream: bool = False  # потоковая загрузка без временных файлов
+    workers: int = 1  # число файлов, обрабатываемых одновременно
+    force: bool = False  # загрузить заново даже неизменившиеся файлы
 
-@app.post("/run")
-def run_etl(request: ETLRequest):
+
+def execute_job(job: ETLJob, request: ETLRequest):
+    job.start()
     try:
-        result = subprocess.run(
-            [
-                "python", "etl_main.py",
-                "--entity", request.entity,
-                "--start", request.start_month,
-                "--end", request.end_month,
-                "--load_id", request.load_id  # <-- добавлено
-            ],
-            check=True,
-            capture_output=True,
-            text=True
+        run_etl_job(
+            request.entity, request.start_month, request.end_month, request.load_id,
+            stream=request.stream, workers=request.workers, job=job, force=request.force
         )
-        # 👇 Явный вывод stdout и stderr в консоль контейнера
-        print("✅ STDOUT:\n", result.stdout)
-        print("⚠️ STDERR:\n", result.stderr)
+        job.finish()
+        print(f"✅ ETL {job.job_id} завершён: {job.to_dict()}")
+    except Exception as e:
+        job.finish(error=str(e))
+        print(f"❌ Ошибка при выполнении ETL {job.job_id}: {e}")
+
+
+class RevenueRequest(BaseModel):
+    load_id: str
+    shards: int = 1  # contract_id % shards — число независимых транзакций
+    workers: int = 1  # процессов, считающих шарды одновременно
+    chunk_size: int = None  # контрактов в одном куске расчёта
+
+
+def execute_revenue_job(job: ETLJob, request: RevenueRequest):
+    job.start()
+    try:
+        run_revenue(request.shards, request.workers, request.chunk_size, job=job)
+        job.finish()
+        print(f"✅ Расчёт выручки {job.job_id} завершён: {job.to_dict()}")
+    except Exception as e:
+        job.finish(error=str(e))
+        print(f"❌ Ошибка при расчёте выручки {job.job_id}: {e}")
+
+
+@app.post("/run", status_code=202)
+def run_etl(request: ETLRequest):
+    job = jobs.add(ETLJob(request.entity, request.start_month, request.end_month, request.load_id))
+    executor.submit(execute_job, job, request)
+    return {"status": "accepted", "job_id": job.job_id}
+
+
+@app.post("/revenue", status_code=202)
+def run_revenue_job(request: RevenueRequest):
+    # Пересчёт dwh.contract_price_enriched через etl.revenue вместо sql/load_contracts_enriched.sql
+    job = jobs.add(ETLJob("contract_price_enriched", "", "", request.load_id))
+    executor.submit(execute_revenue_job, job, request)
+    return {"status": "accepted", "job_id": job.job_id}
+
+
+@app.get("/runs/{job_id}")
+def get_run(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"ETL job {job_id} не найден")
+    return job.to_dict()
+
 
-        return {"status": "success", "output": result.stdout}
-    except subprocess.CalledProcessError as e:
-        print("❌ Ошибка при запуске ETL:")
-        print("STDOUT:\n", e.stdout)
-        print("STDERR:\n", e.stderr)
-        raise HTTPException(status_code=500, detail=e.stderr)
+@app.get("/runs")
+def list_runs():
+    return [job.to_dict() for job in jobs.list()]
 
 
+@app.get("/metrics")
+def metrics():
+    # Счётчики и гистограммы этапов (etl.metrics) и число запусков по статусам — для Prometheus
+    statuses = {}
+    for job in jobs.list():
+        statuses[job.status] = statuses.get(job.status, 0) + 1
+    content = render_metrics({
+        "etl_runner_jobs": ("Запуски в реестре etl-runner по статусам",
+                            {(("status", status),): count for status, count in sorted(statuses.items())})
+    })
+    return Response(content=content, media_type="text/plain; version=0.0.4; charset=utf-8")
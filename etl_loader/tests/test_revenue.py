@@ -0,0 +1,99 @@
+from datetime import date
+import numpy as np
+import pandas as pd
+import pytest
+from etl.revenue import compute_enriched, compare_reference
+
+# Запуск: cd etl_loader && python -m pytest tests
+# Небольшой набор с ожидаемыми значениями, посчитанными вручную по шагам sql/load_contracts_enriched.sql
+
+
+def fixture_inputs():
+    contracts = pd.DataFrame({
+        "contract_id": [1, 2, 2],
+        "product_id": [10, 10, 10],
+        "status": ["active", "indelivery", "active"],
+        "usage": [3650, 1000, 1000],
+        "usagenet": [None, None, None],
+        "createdat": [date(2020, 1, 1), date(2020, 3, 1), date(2020, 3, 1)],
+        "valid_from": [date(2020, 1, 1), date(2020, 3, 1), date(2020, 4, 1)],
+        "valid_until": [date(9999, 12, 31), date(2020, 3, 31), date(9999, 12, 31)],
+        "snapshot_date": [date(2020, 12, 1)] * 3
+    })
+    price_periods = pd.DataFrame({
+        "snapshot_date": [date(2020, 12, 1)] * 2,
+        "product_id": [10, 10],
+        "valid_from": [date(2020, 1, 1), date(2020, 7, 1)],
+        "valid_until": [date(2020, 6, 30), date(2020, 12, 31)],
+        "baseprice": [120.0, 180.0],
+        "workingprice": [20.0, 30.0]
+    })
+    return contracts, price_periods
+
+
+def computed_fixture(chunk_size: int = None) -> pd.DataFrame:
+    contracts, price_periods = fixture_inputs()
+    return pd.concat(list(compute_enriched(contracts, price_periods, today=date(2021, 1, 1), chunk_size=chunk_size)),
+                     ignore_index=True)
+
+
+def test_open_contract_ends_at_last_snapshot():
+    # Контракт 1: открытая версия заканчивается последним слепком (2020-12-01), периоды режутся
+    # границами цен; базовая цена года — максимальная (180) пропорционально дням, рабочая — по периоду
+    result = computed_fixture()
+    first = result[result["contract_id"] == 1].reset_index(drop=True)
+    assert list(first["period_start"].dt.strftime("%Y-%m-%d")) == ["2020-01-01", "2020-06-30", "2020-07-01"]
+    assert list(first["days_in_period"]) == [181, 1, 153]
+    assert list(first["total_days_in_year"]) == [335, 335, 335]
+    assert first["base_cost"].tolist() == pytest.approx([97.253731, 0.537313, 82.208955])
+    assert first["variable_cost"].tolist() == pytest.approx([362.0, 2.0, 459.0])
+    assert first["revenue"].tolist() == pytest.approx([459.253731, 2.537313, 541.208955])
+
+
+def test_indelivery_versions_are_skipped():
+    # Контракт 2: версия indelivery в расчёт не попадает, периоды начинаются с действующей версии
+    result = computed_fixture()
+    second = result[result["contract_id"] == 2]
+    assert second["period_start"].min() == pd.Timestamp("2020-04-01")
+    assert (second["status"] == "active").all()
+    assert second["variable_cost"].tolist() == pytest.approx([49.315068, 0.547945, 125.753425])
+
+
+def test_chunking_does_not_change_result():
+    pd.testing.assert_frame_equal(computed_fixture(chunk_size=1), computed_fixture())
+
+
+def write_reference(directory, computed: pd.DataFrame, revenue_shift: float = 0.0):
+    by_product = computed.groupby(["createdat", "productid"], as_index=False)[["revenue", "consumption"]].sum()
+    pd.DataFrame({
+        "createdat": by_product["createdat"].dt.strftime("%Y-%m-%d"),
+        "productid": by_product["productid"],
+        "sum_revenue": by_product["revenue"] + revenue_shift,
+        "sum_consumption": by_product["consumption"]
+    }).to_csv(directory / "cons_rev_attached_creatdat_prodid.csv", index=False)
+    by_date = computed.groupby("createdat", as_index=False)["revenue"].sum()
+    # Формат выгрузки: дата дд.мм.гггг, десятичная запятая, разделитель ";"
+    lines = ["createdat;sum_revenue;;"] + [
+        f"{day:%d.%m.%Y};" + f"{revenue:.6f}".replace(".", ",")
+        for day, revenue in zip(by_date["createdat"], by_date["revenue"])
+    ]
+    (directory / "change_of_revenue_between_01102020_and_01012021.csv").write_text("\n".join(lines) + "\n")
+
+
+def test_compare_reference_passes_on_matching_exports(tmp_path):
+    computed = computed_fixture()
+    write_reference(tmp_path, computed)
+    assert compare_reference(computed, str(tmp_path))
+
+
+def test_compare_reference_fails_on_revenue_mismatch(tmp_path):
+    computed = computed_fixture()
+    write_reference(tmp_path, computed, revenue_shift=0.02)
+    assert not compare_reference(computed, str(tmp_path))
+
+
+def test_compare_reference_fails_on_unmatched_rows(tmp_path):
+    computed = computed_fixture()
+    write_reference(tmp_path, computed)
+    extra = computed[computed["contract_id"] == 1].assign(productid=np.int64(99))
+    assert not compare_reference(pd.concat([computed, extra], ignore_index=True), str(tmp_path))
@@ -22,6 +22,8 @@ WITH staging AS (
     TO_DATE(LEFT(source_table, 8), 'YYYYMMDD') AS snapshot_date,
     source_table
   FROM staging.contracts_staging_view
+  -- etl-runner уже отклоняет такие строки и при обычной, и при потоковой загрузке (VALIDATION_RULES
+  -- в etl/schemas.py), фильтр остаётся для staging-таблиц, загруженных до появления проверки
   WHERE COALESCE(usage, 0) <= 15000
     AND COALESCE(usagenet, 0) <= 15000
 ),
@@ -37,7 +39,34 @@ deduped AS (
 )
 SELECT * FROM deduped;
 
--- 2. Вставка новых версий (если modificationdate ещё не существует)
+-- 2. Версия, которая снова пришла в более позднем слепке, получает этот слепок: по последнему snapshot_date
+-- считается конец открытого контракта (load_contracts_enriched.sql), и помесячная загрузка должна давать
+-- то же, что одна загрузка всего диапазона, где DISTINCT ON выше берёт последний source_table.
+-- inserted_at обновляется, чтобы инкрементальный расчёт выручки и витрины пересчитали контракт
+UPDATE dwh.contracts AS tgt
+SET product_id = src.product_id,
+    type = src.type,
+    energy = src.energy,
+    usage = src.usage,
+    usagenet = src.usagenet,
+    createdat = src.createdat,
+    startdate = src.startdate,
+    enddate = src.enddate,
+    filingdatecancellation = src.filingdatecancellation,
+    cancellationreason = src.cancellationreason,
+    city = src.city,
+    status = src.status,
+    snapshot_date = src.snapshot_date,
+    source_table = src.source_table,
+    is_valid = CASE WHEN src.status IN ('cancelled', 'terminated') THEN FALSE ELSE TRUE END,
+    inserted_at = NOW(),
+    hash_value = src.hash_value
+FROM tmp_contracts_stage AS src
+WHERE tgt.contract_id = src.contract_id
+  AND tgt.modificationdate = src.modificationdate
+  AND tgt.snapshot_date < src.snapshot_date;
+
+-- 2a. Вставка новых версий (если modificationdate ещё не существует)
 INSERT INTO dwh.contracts (
   contract_id,
   product_id,
@@ -93,16 +122,21 @@ WHERE NOT EXISTS (
     AND tgt.modificationdate = src.modificationdate
 );
 
--- 3. Закрытие предыдущих версий (всех кроме последней на contract_id)
-WITH ranked_versions AS (
+-- 3. Закрытие предыдущих версий (всех кроме последней на contract_id) только у контрактов из staging:
+-- у остальных открыта ровно одна версия, и ранжировать всю историю таблицы не нужно
+WITH batch_keys AS (
+  SELECT DISTINCT contract_id FROM tmp_contracts_stage
+),
+ranked_versions AS (
   SELECT
-    contract_sk,
-    contract_id,
-    modificationdate,
-    LEAD(modificationdate) OVER (PARTITION BY contract_id ORDER BY modificationdate) AS next_modificationdate,
-    ROW_NUMBER() OVER (PARTITION BY contract_id ORDER BY modificationdate DESC) AS rn
-  FROM dwh.contracts
-  WHERE is_current = TRUE
+    c.contract_sk,
+    c.contract_id,
+    c.modificationdate,
+    LEAD(c.modificationdate) OVER (PARTITION BY c.contract_id ORDER BY c.modificationdate) AS next_modificationdate,
+    ROW_NUMBER() OVER (PARTITION BY c.contract_id ORDER BY c.modificationdate DESC) AS rn
+  FROM dwh.contracts c
+  JOIN batch_keys k ON k.contract_id = c.contract_id
+  WHERE c.is_current = TRUE
 )
 UPDATE dwh.contracts AS tgt
 SET is_current = FALSE,
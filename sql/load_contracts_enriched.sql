@@ -1,7 +1,11 @@
+-- Режим расчёта задаётся настройкой сессии etl.enriched_mode (см. run_sql_file в DAG):
+--   full        — полный пересчёт всех контрактов (по умолчанию, если настройка не задана);
+--   incremental — пересчёт только контрактов, у которых появились новые версии в dwh.contracts,
+--                 изменились периоды цен продукта в последнем слепке dwh.price_periods,
+--                 или которые могли получить новые периоды с прошлого расчёта (сдвиг CURRENT_DATE);
+--   check       — полный расчёт во временную таблицу и сверка с dwh.contract_price_enriched без записи.
 
-DROP TABLE IF EXISTS dwh.contract_price_enriched;
-
-CREATE TABLE dwh.contract_price_enriched (
+CREATE TABLE IF NOT EXISTS dwh.contract_price_enriched (
   contract_id BIGINT NOT NULL,                    -- ID контракта
   productid INT NOT NULL,                         -- ID продукта
   period_start DATE NOT NULL,                     -- начало периода
@@ -33,13 +37,72 @@ CREATE TABLE dwh.contract_price_enriched (
   CONSTRAINT uq_contract_price_enriched UNIQUE (contract_id, productid, period_start)
 );
 
+-- Для инкрементального обновления витрин (sql/load_marts.sql)
+CREATE INDEX IF NOT EXISTS ix_contract_price_enriched_inserted_at ON dwh.contract_price_enriched (inserted_at);
+CREATE INDEX IF NOT EXISTS ix_contract_price_enriched_createdat_productid
+  ON dwh.contract_price_enriched (createdat, productid);
+
+-- Состояние инкрементального расчёта: high-water mark по dwh.contracts.inserted_at и дата прошлого расчёта
+CREATE TABLE IF NOT EXISTS dwh.etl_watermarks (
+  name TEXT PRIMARY KEY,                          -- имя расчёта
+  high_water_mark TIMESTAMP,                      -- макс. inserted_at обработанных версий контрактов
+  run_date DATE,                                  -- CURRENT_DATE прошлого расчёта
+  updated_at TIMESTAMP DEFAULT now()
+);
+
+-- Отпечатки периодов цен продуктов (последний слепок dwh.price_periods), с которыми считался прошлый расчёт
+CREATE TABLE IF NOT EXISTS dwh.contract_price_enriched_price_hashes (
+  product_id INT PRIMARY KEY,
+  price_hash TEXT NOT NULL
+);
+
 -- Удаление временных таблиц
+DROP TABLE IF EXISTS enriched_run;
+DROP TABLE IF EXISTS latest_price_periods;
+DROP TABLE IF EXISTS enriched_price_hashes;
+DROP TABLE IF EXISTS enriched_changed;
+DROP TABLE IF EXISTS contract_price_enriched_new;
 DROP TABLE IF EXISTS contract_input;
 DROP TABLE IF EXISTS contract_breakpoints;
 DROP TABLE IF EXISTS contract_periods;
 DROP TABLE IF EXISTS joined_periods_dedup;
 DROP TABLE IF EXISTS contract_price_periods;
 
+-- 0. Параметры запуска: без сохранённого high-water mark инкрементальный режим становится полным
+CREATE TEMP TABLE enriched_run AS
+SELECT
+  CASE
+    WHEN m.mode = 'incremental' AND w.high_water_mark IS NULL THEN 'full'
+    ELSE m.mode
+  END AS mode,
+  w.high_water_mark,
+  w.run_date,
+  (SELECT MAX(inserted_at) FROM dwh.contracts) AS new_high_water_mark
+FROM (SELECT COALESCE(NULLIF(current_setting('etl.enriched_mode', true), ''), 'full') AS mode) m
+LEFT JOIN dwh.etl_watermarks w ON w.name = 'contract_price_enriched';
+
+-- Последний слепок периодов цен читается из dwh.price_periods один раз
+CREATE TEMP TABLE latest_price_periods AS
+SELECT
+  product_id,
+  valid_from,
+  valid_until,
+  baseprice,
+  workingprice
+FROM dwh.price_periods
+WHERE snapshot_date = (SELECT MAX(snapshot_date) FROM dwh.price_periods);
+
+CREATE INDEX ON latest_price_periods (product_id);
+ANALYZE latest_price_periods;
+
+CREATE TEMP TABLE enriched_price_hashes AS
+SELECT
+  product_id,
+  md5(string_agg(CONCAT_WS('::', valid_from, valid_until, baseprice, workingprice), '|'
+                 ORDER BY valid_from, valid_until, baseprice, workingprice)) AS price_hash
+FROM latest_price_periods
+GROUP BY product_id;
+
 -- 1. Контракты с createdat
 CREATE TEMP TABLE contract_input AS
 SELECT DISTINCT
@@ -57,31 +120,71 @@ SELECT DISTINCT
 FROM dwh.contracts
 WHERE status <> 'indelivery';
 
--- 2. Контрольные даты
+-- 1a. Контракты к пересчёту
+CREATE TEMP TABLE enriched_changed AS
+-- полный пересчёт и сверка: все контракты, а также уже рассчитанные (их строки будут удалены)
+SELECT contract_id FROM contract_input
+WHERE (SELECT mode FROM enriched_run) <> 'incremental'
+UNION
+SELECT contract_id FROM dwh.contract_price_enriched
+WHERE (SELECT mode FROM enriched_run) = 'full'
+UNION
+-- новые версии контракта с прошлого расчёта
+SELECT c.contract_id FROM dwh.contracts c, enriched_run r
+WHERE r.mode = 'incremental' AND c.inserted_at > r.high_water_mark
+UNION
+-- изменились периоды цен продукта контракта
+SELECT ci.contract_id
+FROM contract_input ci
+JOIN (
+  SELECT COALESCE(n.product_id, o.product_id) AS product_id
+  FROM enriched_price_hashes n
+  FULL JOIN dwh.contract_price_enriched_price_hashes o ON o.product_id = n.product_id
+  WHERE n.price_hash IS DISTINCT FROM o.price_hash
+) p ON p.product_id = ci.productid
+WHERE (SELECT mode FROM enriched_run) = 'incremental'
+UNION
+-- периоды, которые с прошлого расчёта стали прошедшими (фильтр period_start < CURRENT_DATE)
+SELECT ci.contract_id FROM contract_input ci, enriched_run r
+WHERE r.mode = 'incremental'
+  AND r.run_date < CURRENT_DATE
+  AND (ci.enddate IS NULL OR ci.enddate > r.run_date)
+UNION
+-- контракты, которых больше нет среди рассчитываемых
+SELECT e.contract_id FROM dwh.contract_price_enriched e
+WHERE (SELECT mode FROM enriched_run) = 'incremental'
+  AND NOT EXISTS (SELECT 1 FROM contract_input ci WHERE ci.contract_id = e.contract_id);
+
+CREATE UNIQUE INDEX ON enriched_changed (contract_id);
+
+DELETE FROM contract_input ci
+WHERE NOT EXISTS (SELECT 1 FROM enriched_changed c WHERE c.contract_id = ci.contract_id);
+
+-- после удаления статистика временной таблицы устарела: без неё планировщик выбирает вложенные циклы
+ANALYZE contract_input;
+
+-- 2. Контрольные даты: даты самого контракта и границы периодов цен его продукта,
+-- одним соединением со слепком вместо подзапроса на каждую строку контракта
 CREATE TEMP TABLE contract_breakpoints AS
+WITH price_dates AS (
+  SELECT product_id, valid_from AS date_value FROM latest_price_periods
+  UNION
+  SELECT product_id, valid_until FROM latest_price_periods
+)
 SELECT DISTINCT
-  c.contract_id,
-  c.productid,
+  contract_id,
+  productid,
   date_value
-FROM contract_input c,
-LATERAL (
-  SELECT date_value FROM (
-    SELECT c.startdate AS date_value
-    UNION
-    SELECT c.createdat AS date_value
-    UNION
-    SELECT c.enddate AS date_value
-    UNION
-    SELECT valid_from FROM dwh.price_periods
-      WHERE snapshot_date = (SELECT MAX(snapshot_date) FROM dwh.price_periods)
-        AND product_id = c.productid
-    UNION
-    SELECT valid_until FROM dwh.price_periods
-      WHERE snapshot_date = (SELECT MAX(snapshot_date) FROM dwh.price_periods)
-        AND product_id = c.productid
-  ) d
-  WHERE date_value IS NOT NULL
-) AS bp;
+FROM (
+  SELECT c.contract_id, c.productid, d.date_value
+  FROM contract_input c
+  CROSS JOIN LATERAL (VALUES (c.startdate), (c.createdat), (c.enddate)) AS d(date_value)
+  UNION ALL
+  SELECT c.contract_id, c.productid, pd.date_value
+  FROM (SELECT DISTINCT contract_id, productid FROM contract_input) c
+  JOIN price_dates pd ON pd.product_id = c.productid
+) bp
+WHERE date_value IS NOT NULL;
 
 -- 3. Разбиение на периоды
 CREATE TEMP TABLE contract_periods AS
@@ -105,8 +208,7 @@ SELECT
   valid_until,
   MAX(baseprice) AS baseprice,
   MAX(workingprice) AS workingprice
-FROM dwh.price_periods
-WHERE snapshot_date = (SELECT MAX(snapshot_date) FROM dwh.price_periods)
+FROM latest_price_periods
 GROUP BY product_id, valid_from, valid_until;
 
 -- 6. Присоединяем параметры и цены
@@ -134,7 +236,9 @@ JOIN (
     enddate,
     createdat
   FROM contract_input
-  ORDER BY contract_id, createdat DESC
+  -- версии контракта обычно имеют одинаковый createdat: без startdate выбор версии зависел бы от плана,
+  -- и инкрементальный расчёт не совпадал бы с полным
+  ORDER BY contract_id, createdat DESC, startdate DESC
 ) ci ON p.contract_id = ci.contract_id
 LEFT JOIN joined_periods_dedup jp
   ON p.productid = jp.product_id
@@ -144,8 +248,14 @@ WHERE
   AND (ci.enddate IS NULL OR p.period_start < ci.enddate)
   AND p.period_start < CURRENT_DATE;
 
--- 7. Финальный расчёт и вставка
-INSERT INTO dwh.contract_price_enriched (
+-- временные таблицы не анализируются autovacuum: на частичном наборе контрактов без статистики
+-- соединения финального расчёта уходят во вложенные циклы
+ANALYZE contract_price_periods;
+
+-- 7. Финальный расчёт во временную таблицу
+CREATE TEMP TABLE contract_price_enriched_new (LIKE dwh.contract_price_enriched INCLUDING DEFAULTS);
+
+INSERT INTO contract_price_enriched_new (
   contract_id,
   productid,
   period_start,
@@ -180,54 +290,36 @@ WITH base_data AS (
     FLOOR((period_start - startdate)::numeric / 365.0) AS contract_year
   FROM contract_price_periods
 ),
-years_per_contract AS (
-  SELECT
-    contract_id,
-    startdate,
-    enddate,
-    CEIL((COALESCE(enddate, CURRENT_DATE) - startdate)::numeric / 365.0) AS total_contract_years,
-    COALESCE(enddate, CURRENT_DATE) AS final_end
-  FROM contract_price_periods
-  GROUP BY contract_id, startdate, enddate
-),
+-- годы контракта зависят только от startdate/enddate самой строки, а итоги года — оконные:
+-- без самосоединений, на которых планировщик недооценивает число строк и уходит во вложенные циклы
 joined AS (
   SELECT
     b.*,
-    y.total_contract_years,
-    y.final_end,
-    CASE 
-      WHEN y.final_end < (b.startdate + (y.total_contract_years || ' years')::interval) 
-        THEN true ELSE false
-    END AS terminated_mid_year
+    CEIL((COALESCE(b.enddate, CURRENT_DATE) - b.startdate)::numeric / 365.0) AS total_contract_years,
+    COALESCE(b.enddate, CURRENT_DATE) AS final_end
   FROM base_data b
-  JOIN years_per_contract y
-    ON b.contract_id = y.contract_id AND b.startdate = y.startdate
-    AND (
-         b.enddate = y.enddate
-      OR (b.enddate IS NULL AND y.enddate IS NULL)
-    )
 ),
 year_base_totals AS (
   SELECT
-    contract_id,
-    contract_year,
-    SUM(days_in_period)::numeric AS total_days_in_year,
-    MAX(baseprice) AS baseprice
-  FROM joined
-  GROUP BY contract_id, contract_year
+    j.*,
+    CASE 
+      WHEN j.final_end < (j.startdate + (j.total_contract_years || ' years')::interval) 
+        THEN true ELSE false
+    END AS terminated_mid_year,
+    (SUM(j.days_in_period) OVER year_window)::numeric AS total_days_in_year,
+    MAX(j.baseprice) OVER year_window AS year_baseprice
+  FROM joined j
+  WINDOW year_window AS (PARTITION BY j.contract_id, j.contract_year)
 ),
 enriched AS (
   SELECT
-    j.*,
-    y.total_days_in_year,
-    ROUND((j.days_in_period / NULLIF(y.total_days_in_year, 0))::numeric, 6) AS period_share,
-    ROUND((y.baseprice * (j.days_in_period / NULLIF(y.total_days_in_year, 0)))::numeric, 6) AS base_cost,
-    ROUND(((COALESCE(workingprice, 0) / 100.0) * (consumption * j.days_in_period / 365.0))::numeric, 6) AS variable_cost,
-    ROUND((consumption * j.days_in_period / 365.0)::numeric, 6) AS weighted_consumption,
-    ROUND(((consumption * j.days_in_period / 365.0) / NULLIF(consumption, 0))::numeric, 6) AS consumption_share
-  FROM joined j
-  JOIN year_base_totals y
-    ON j.contract_id = y.contract_id AND j.contract_year = y.contract_year
+    y.*,
+    ROUND((y.days_in_period / NULLIF(y.total_days_in_year, 0))::numeric, 6) AS period_share,
+    ROUND((y.year_baseprice * (y.days_in_period / NULLIF(y.total_days_in_year, 0)))::numeric, 6) AS base_cost,
+    ROUND(((COALESCE(workingprice, 0) / 100.0) * (consumption * y.days_in_period / 365.0))::numeric, 6) AS variable_cost,
+    ROUND((consumption * y.days_in_period / 365.0)::numeric, 6) AS weighted_consumption,
+    ROUND(((consumption * y.days_in_period / 365.0) / NULLIF(consumption, 0))::numeric, 6) AS consumption_share
+  FROM year_base_totals y
 )
 SELECT
   contract_id,
@@ -256,3 +348,62 @@ SELECT
   ROUND((base_cost + variable_cost)::numeric, 6) AS revenue,
   ROUND(total_contract_years::numeric * baseprice::numeric, 2) AS baseprice_total_due
 FROM enriched;
+
+-- 8. Замена строк пересчитанных контрактов
+DELETE FROM dwh.contract_price_enriched t
+USING enriched_changed c
+WHERE t.contract_id = c.contract_id
+  AND (SELECT mode FROM enriched_run) <> 'check';
+
+INSERT INTO dwh.contract_price_enriched
+SELECT * FROM contract_price_enriched_new
+WHERE (SELECT mode FROM enriched_run) <> 'check';
+
+-- 9. Сверка: результат полного расчёта должен совпасть с содержимым таблицы
+DO $$
+DECLARE
+  diff_count BIGINT;
+BEGIN
+  IF (SELECT mode FROM enriched_run) = 'check' THEN
+    WITH expected AS (
+      SELECT contract_id, productid, period_start, period_end, status, consumption, startdate, enddate, createdat,
+             baseprice, workingprice, days_in_period, days_since_start, contract_year, total_contract_years,
+             final_end, terminated_mid_year, total_days_in_year, period_share, base_cost, variable_cost,
+             weighted_consumption, consumption_share, revenue, baseprice_total_due
+      FROM contract_price_enriched_new
+    ),
+    actual AS (
+      SELECT contract_id, productid, period_start, period_end, status, consumption, startdate, enddate, createdat,
+             baseprice, workingprice, days_in_period, days_since_start, contract_year, total_contract_years,
+             final_end, terminated_mid_year, total_days_in_year, period_share, base_cost, variable_cost,
+             weighted_consumption, consumption_share, revenue, baseprice_total_due
+      FROM dwh.contract_price_enriched
+    )
+    SELECT COUNT(*) INTO diff_count
+    FROM ((SELECT * FROM expected EXCEPT ALL SELECT * FROM actual)
+          UNION ALL
+          (SELECT * FROM actual EXCEPT ALL SELECT * FROM expected)) d;
+
+    IF diff_count > 0 THEN
+      RAISE EXCEPTION 'dwh.contract_price_enriched расходится с полным расчётом: % строк', diff_count;
+    END IF;
+    RAISE NOTICE 'dwh.contract_price_enriched совпадает с полным расчётом';
+  END IF;
+END $$;
+
+-- 10. Фиксация high-water mark и отпечатков цен
+INSERT INTO dwh.etl_watermarks (name, high_water_mark, run_date, updated_at)
+SELECT 'contract_price_enriched', COALESCE(new_high_water_mark, high_water_mark, TIMESTAMP '1970-01-01'), CURRENT_DATE, now()
+FROM enriched_run
+WHERE mode <> 'check'
+ON CONFLICT (name) DO UPDATE
+SET high_water_mark = EXCLUDED.high_water_mark,
+    run_date = EXCLUDED.run_date,
+    updated_at = EXCLUDED.updated_at;
+
+DELETE FROM dwh.contract_price_enriched_price_hashes
+WHERE (SELECT mode FROM enriched_run) <> 'check';
+
+INSERT INTO dwh.contract_price_enriched_price_hashes (product_id, price_hash)
+SELECT product_id, price_hash FROM enriched_price_hashes
+WHERE (SELECT mode FROM enriched_run) <> 'check';
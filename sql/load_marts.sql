@@ -0,0 +1,234 @@
+-- Витрины для вопросов из README: выручка и потребление по дате создания и продукту (по дням и месяцам),
+-- число контрактов "indelivery" и новых контрактов на каждую дату слепка.
+-- Пересчитываются только затронутые ключи: изменения находятся по inserted_at в dwh.contract_price_enriched
+-- и dwh.contracts относительно high-water marks в dwh.etl_watermarks.
+
+CREATE SCHEMA IF NOT EXISTS mart;
+
+CREATE TABLE IF NOT EXISTS dwh.etl_watermarks (
+  name TEXT PRIMARY KEY,                          -- имя расчёта
+  high_water_mark TIMESTAMP,                      -- макс. inserted_at обработанных версий контрактов
+  run_date DATE,                                  -- CURRENT_DATE прошлого расчёта
+  updated_at TIMESTAMP DEFAULT now()
+);
+
+-- Выручка и потребление по дате создания и продукту (cons_rev_attached_creatdat_prodid.csv)
+CREATE TABLE IF NOT EXISTS mart.revenue_daily (
+  createdat DATE NOT NULL,                        -- дата создания контракта
+  productid INT NOT NULL,                         -- ID продукта
+  sum_revenue NUMERIC,                            -- сумма выручки по периодам
+  sum_consumption NUMERIC,                        -- сумма потребления по периодам
+  contracts_count INT,                            -- число контрактов
+  periods_count INT,                              -- число периодов
+  PRIMARY KEY (createdat, productid)
+);
+
+-- То же по месяцу даты создания
+CREATE TABLE IF NOT EXISTS mart.revenue_monthly (
+  month DATE NOT NULL,                            -- первый день месяца createdat
+  productid INT NOT NULL,
+  sum_revenue NUMERIC,
+  sum_consumption NUMERIC,
+  contracts_count INT,
+  periods_count INT,
+  PRIMARY KEY (month, productid)
+);
+
+-- Ключи витрины, в которые попал каждый контракт на прошлом расчёте: при смене createdat/продукта
+-- или удалении контракта старые ключи тоже пересчитываются
+CREATE TABLE IF NOT EXISTS mart.revenue_contract_keys (
+  contract_id BIGINT NOT NULL,
+  createdat DATE NOT NULL,
+  productid INT NOT NULL,
+  PRIMARY KEY (contract_id, createdat, productid)
+);
+
+-- Контракты "indelivery" на дату слепка (по версиям, изменённым не позже этой даты)
+CREATE TABLE IF NOT EXISTS mart.contracts_in_delivery (
+  snapshot_date DATE PRIMARY KEY,
+  contracts_count INT NOT NULL
+);
+
+-- Новые контракты слепка: созданные в месяце, предшествующем дате слепка
+CREATE TABLE IF NOT EXISTS mart.new_contracts (
+  snapshot_date DATE PRIMARY KEY,
+  contracts_count INT NOT NULL
+);
+
+-- Удаление временных таблиц
+DROP TABLE IF EXISTS marts_run;
+DROP TABLE IF EXISTS mart_changed_contracts;
+DROP TABLE IF EXISTS mart_changed_keys;
+DROP TABLE IF EXISTS mart_changed_snapshots;
+DROP TABLE IF EXISTS mart_changed_versions;
+DROP TABLE IF EXISTS mart_new_contracts_dates;
+DROP TABLE IF EXISTS mart_in_delivery_dates;
+
+-- 0. Параметры запуска. Если в dwh.contracts не осталось версий, загруженных до high-water mark
+-- (таблица создана заново), витрины по контрактам строятся заново
+CREATE TEMP TABLE marts_run AS
+SELECT
+  COALESCE(r.high_water_mark, TIMESTAMP '-infinity') AS revenue_hwm,
+  (SELECT MAX(inserted_at) FROM dwh.contract_price_enriched) AS new_revenue_hwm,
+  COALESCE(c.high_water_mark, TIMESTAMP '-infinity') AS contracts_hwm,
+  (SELECT MAX(inserted_at) FROM dwh.contracts) AS new_contracts_hwm,
+  c.high_water_mark IS NULL
+    OR NOT EXISTS (SELECT 1 FROM dwh.contracts WHERE inserted_at <= c.high_water_mark) AS contracts_reloaded
+FROM (SELECT 1) one
+LEFT JOIN dwh.etl_watermarks r ON r.name = 'mart_revenue'
+LEFT JOIN dwh.etl_watermarks c ON c.name = 'mart_contracts';
+
+-- 1. Контракты, строки которых переписаны с прошлого расчёта (load_contracts_enriched удаляет и вставляет
+-- все строки изменившегося контракта) или исчезли из dwh.contract_price_enriched
+CREATE TEMP TABLE mart_changed_contracts AS
+SELECT DISTINCT contract_id
+FROM dwh.contract_price_enriched
+WHERE inserted_at > (SELECT revenue_hwm FROM marts_run)
+UNION
+SELECT k.contract_id
+FROM mart.revenue_contract_keys k
+WHERE NOT EXISTS (SELECT 1 FROM dwh.contract_price_enriched e WHERE e.contract_id = k.contract_id);
+
+CREATE UNIQUE INDEX ON mart_changed_contracts (contract_id);
+ANALYZE mart_changed_contracts;
+
+-- 2. Затронутые ключи (createdat, productid): старые и новые ключи изменившихся контрактов
+CREATE TEMP TABLE mart_changed_keys AS
+SELECT k.createdat, k.productid
+FROM mart.revenue_contract_keys k
+JOIN mart_changed_contracts c ON c.contract_id = k.contract_id
+UNION
+SELECT e.createdat, e.productid
+FROM dwh.contract_price_enriched e
+JOIN mart_changed_contracts c ON c.contract_id = e.contract_id;
+
+ANALYZE mart_changed_keys;
+
+DELETE FROM mart.revenue_contract_keys k
+USING mart_changed_contracts c
+WHERE k.contract_id = c.contract_id;
+
+INSERT INTO mart.revenue_contract_keys (contract_id, createdat, productid)
+SELECT DISTINCT e.contract_id, e.createdat, e.productid
+FROM dwh.contract_price_enriched e
+JOIN mart_changed_contracts c ON c.contract_id = e.contract_id;
+
+-- 3. Дневная витрина: затронутые ключи пересчитываются целиком
+DELETE FROM mart.revenue_daily d
+USING mart_changed_keys k
+WHERE d.createdat = k.createdat
+  AND d.productid = k.productid;
+
+INSERT INTO mart.revenue_daily (createdat, productid, sum_revenue, sum_consumption, contracts_count, periods_count)
+SELECT
+  e.createdat,
+  e.productid,
+  SUM(e.revenue),
+  SUM(e.consumption),
+  COUNT(DISTINCT e.contract_id),
+  COUNT(*)
+FROM dwh.contract_price_enriched e
+JOIN mart_changed_keys k ON k.createdat = e.createdat AND k.productid = e.productid
+GROUP BY e.createdat, e.productid;
+
+-- 4. Месячная витрина из дневной: у контракта одна дата создания, поэтому число контрактов складывается
+DELETE FROM mart.revenue_monthly m
+USING (SELECT DISTINCT date_trunc('month', createdat)::date AS month FROM mart_changed_keys) k
+WHERE m.month = k.month;
+
+INSERT INTO mart.revenue_monthly (month, productid, sum_revenue, sum_consumption, contracts_count, periods_count)
+SELECT
+  date_trunc('month', d.createdat)::date AS month,
+  d.productid,
+  SUM(d.sum_revenue),
+  SUM(d.sum_consumption),
+  SUM(d.contracts_count),
+  SUM(d.periods_count)
+FROM mart.revenue_daily d
+WHERE date_trunc('month', d.createdat)::date IN (
+  SELECT DISTINCT date_trunc('month', createdat)::date FROM mart_changed_keys
+)
+GROUP BY date_trunc('month', d.createdat)::date, d.productid;
+
+-- 5. Витрины по контрактам. snapshot_date версии — последний слепок, в котором она пришла
+-- (load_contracts.sql переносит его вперёд), поэтому прошлые слепки считаются не по нему,
+-- а по датам самой версии: modificationdate и createdat
+DELETE FROM mart.contracts_in_delivery WHERE (SELECT contracts_reloaded FROM marts_run);
+DELETE FROM mart.new_contracts WHERE (SELECT contracts_reloaded FROM marts_run);
+
+CREATE TEMP TABLE mart_changed_versions AS
+SELECT
+  MIN(modificationdate) AS min_modificationdate,
+  ARRAY_AGG(DISTINCT date_trunc('month', createdat)::date) AS createdat_months
+FROM dwh.contracts
+WHERE inserted_at > (SELECT contracts_hwm FROM marts_run)
+   OR (SELECT contracts_reloaded FROM marts_run);
+
+CREATE TEMP TABLE mart_changed_snapshots AS
+SELECT DISTINCT snapshot_date
+FROM dwh.contracts
+WHERE inserted_at > (SELECT contracts_hwm FROM marts_run)
+   OR (SELECT contracts_reloaded FROM marts_run);
+
+-- Новые контракты слепка — созданные в предыдущем месяце: пересчитываются новые слепки
+-- и слепки, на месяц которых приходится createdat изменившихся версий. Даты слепков берутся
+-- и из самой витрины: все версии старого слепка могли уже перейти в более поздний
+CREATE TEMP TABLE mart_new_contracts_dates AS
+SELECT snapshot_date FROM mart_changed_snapshots
+UNION
+SELECT snapshot_date
+FROM mart.new_contracts
+WHERE date_trunc('month', snapshot_date - INTERVAL '1 month')::date
+      = ANY ((SELECT createdat_months FROM mart_changed_versions)::date[]);
+
+DELETE FROM mart.new_contracts n
+USING mart_new_contracts_dates s
+WHERE n.snapshot_date = s.snapshot_date;
+
+INSERT INTO mart.new_contracts (snapshot_date, contracts_count)
+SELECT
+  s.snapshot_date,
+  COUNT(DISTINCT c.contract_id)
+FROM mart_new_contracts_dates s
+LEFT JOIN dwh.contracts c
+  ON date_trunc('month', c.createdat) = date_trunc('month', s.snapshot_date - INTERVAL '1 month')
+GROUP BY s.snapshot_date;
+
+-- Контракты "indelivery" на дату слепка зависят от всех версий, изменённых до неё: пересчитываются
+-- новые слепки и все слепки начиная с самой ранней modificationdate изменившихся версий
+CREATE TEMP TABLE mart_in_delivery_dates AS
+SELECT snapshot_date FROM mart_changed_snapshots
+UNION
+SELECT snapshot_date
+FROM mart.contracts_in_delivery
+WHERE snapshot_date >= (SELECT min_modificationdate FROM mart_changed_versions);
+
+DELETE FROM mart.contracts_in_delivery d
+USING mart_in_delivery_dates s
+WHERE d.snapshot_date = s.snapshot_date;
+
+INSERT INTO mart.contracts_in_delivery (snapshot_date, contracts_count)
+SELECT
+  s.snapshot_date,
+  COUNT(DISTINCT c.contract_id)
+FROM mart_in_delivery_dates s
+LEFT JOIN dwh.contracts c
+  ON c.status = 'indelivery'
+ AND c.modificationdate <= s.snapshot_date
+ AND c.startdate <= s.snapshot_date
+ AND COALESCE(c.enddate, DATE '9999-12-31') >= s.snapshot_date
+GROUP BY s.snapshot_date;
+
+-- 6. Фиксация high-water marks
+INSERT INTO dwh.etl_watermarks (name, high_water_mark, run_date, updated_at)
+SELECT 'mart_revenue', new_revenue_hwm, CURRENT_DATE, now()
+FROM marts_run
+WHERE new_revenue_hwm IS NOT NULL
+UNION ALL
+SELECT 'mart_contracts', new_contracts_hwm, CURRENT_DATE, now()
+FROM marts_run
+WHERE new_contracts_hwm IS NOT NULL
+ON CONFLICT (name) DO UPDATE
+SET high_water_mark = EXCLUDED.high_water_mark,
+    run_date = EXCLUDED.run_date,
+    updated_at = EXCLUDED.updated_at;
@@ -1,7 +1,7 @@
--- Подготовка расчета периодов цен
-DROP TABLE IF EXISTS dwh.price_periods;
-
-CREATE TABLE dwh.price_periods (
+-- Периоды цен хранятся слепками (append-only): на каждую дату слепка (макс. extracted_at в dwh.prices)
+-- заново разворачиваются только продукты, у которых изменились цены или слепок вышел за горизонт прошлой
+-- развёртки (dwh.price_period_components), периоды остальных получаются из уже развёрнутых.
+CREATE TABLE IF NOT EXISTS dwh.price_periods (
   snapshot_date DATE NOT NULL,               -- дата слепка (макс. extracted_at на момент расчёта)
   product_id INT NOT NULL,
   base_pricecomponentid INT,
@@ -18,79 +18,176 @@ CREATE TABLE dwh.price_periods (
   CONSTRAINT uq_price_period UNIQUE (snapshot_date, product_id, valid_from, valid_until)
 );
 
+-- Продукты слепка: отпечаток цен, по которым считались периоды, и слепок, в котором они были рассчитаны
+CREATE TABLE IF NOT EXISTS dwh.price_periods_products (
+  snapshot_date DATE NOT NULL,
+  product_id INT NOT NULL,
+  price_hash TEXT NOT NULL,
+  computed_snapshot_date DATE NOT NULL,
+  PRIMARY KEY (snapshot_date, product_id)
+);
 
--- 0. Максимальная дата extracted_at
-WITH max_extract AS (
-  SELECT MAX(extracted_at::date) AS max_date FROM dwh.prices
-),
+-- Годовые периоды каждой компоненты цены продукта, развёрнутые не до даты слепка, а до горизонта —
+-- конца года слепка, в котором они рассчитаны. Периоды любого слепка не позже горизонта получаются
+-- из них обрезкой по дате слепка, поэтому продукт с неизменившимися ценами не разворачивается заново,
+-- даже если его цена действует бессрочно (valid_until = 9999-12-31)
+CREATE TABLE IF NOT EXISTS dwh.price_period_components (
+  product_id INT NOT NULL,
+  pricecomponentid INT NOT NULL,
+  price_id BIGINT NOT NULL,
+  price NUMERIC,
+  period_start DATE NOT NULL,
+  period_end DATE NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_price_period_components_product_id ON dwh.price_period_components (product_id);
+
+-- Отпечаток цен и горизонт, с которыми развёрнуты периоды продукта в dwh.price_period_components
+CREATE TABLE IF NOT EXISTS dwh.price_period_expansions (
+  product_id INT PRIMARY KEY,
+  price_hash TEXT NOT NULL,
+  horizon DATE NOT NULL,
+  computed_snapshot_date DATE NOT NULL
+);
+
+-- Удаление временных таблиц
+DROP TABLE IF EXISTS price_periods_run;
+DROP TABLE IF EXISTS price_periods_input;
+DROP TABLE IF EXISTS price_periods_hashes;
+DROP TABLE IF EXISTS price_periods_changed;
+
+-- 0. Дата слепка и горизонт развёртки. Повторный расчёт той же даты пересобирает её заново
+CREATE TEMP TABLE price_periods_run AS
+SELECT
+  s.snapshot_date,
+  (date_trunc('year', s.snapshot_date) + INTERVAL '1 year' - INTERVAL '1 day')::date AS horizon
+FROM (SELECT MAX(extracted_at::date) AS snapshot_date FROM dwh.prices) s;
 
 -- 1. Отбор актуальных цен
-prices_filtered AS (
-  SELECT DISTINCT ON (price_id)
-    price_id,
-    product_id,
-    pricecomponentid,
-    pricecomponent,
-    price,
-    unit,
-    valid_from,
-    valid_until
-  FROM dwh.prices
-  WHERE pricecomponentid IN (1, 2)
-  ORDER BY price_id, valid_until DESC
-),
+CREATE TEMP TABLE price_periods_input AS
+SELECT DISTINCT ON (price_id)
+  price_id,
+  product_id,
+  pricecomponentid,
+  pricecomponent,
+  price,
+  unit,
+  valid_from,
+  valid_until
+FROM dwh.prices
+WHERE pricecomponentid IN (1, 2)
+ORDER BY price_id, valid_until DESC;
 
--- 2. Подготовка base_input
-base_input AS (
-  SELECT
-    f.product_id,
-    f.pricecomponentid,
-    f.price_id,
-    f.price,
-    GREATEST(f.valid_from, date_trunc('year', f.valid_from)) AS valid_from,
-    LEAST(f.valid_until, m.max_date) AS valid_until
-  FROM prices_filtered f
-  CROSS JOIN max_extract m
-  WHERE f.pricecomponentid = 1
-),
+-- Отпечаток цен продукта
+CREATE TEMP TABLE price_periods_hashes AS
+SELECT
+  product_id,
+  md5(string_agg(CONCAT_WS('::', price_id, pricecomponentid, price, valid_from, valid_until), '|' ORDER BY price_id))
+    AS price_hash
+FROM price_periods_input
+GROUP BY product_id;
+
+-- 2. Заново разворачиваются продукты без развёртки, с изменившимися ценами и с горизонтом раньше даты слепка
+CREATE TEMP TABLE price_periods_changed AS
+SELECT h.product_id
+FROM price_periods_hashes h
+CROSS JOIN price_periods_run r
+LEFT JOIN dwh.price_period_expansions e ON e.product_id = h.product_id
+WHERE r.snapshot_date IS NOT NULL
+  AND (e.product_id IS NULL
+       OR e.price_hash <> h.price_hash
+       OR e.horizon < r.snapshot_date);
+
+DELETE FROM dwh.price_period_components c
+USING price_periods_changed ch
+WHERE c.product_id = ch.product_id;
 
--- 3. Подготовка working_input
-working_input AS (
+-- 3. Разворачивание периодов по годам до горизонта
+INSERT INTO dwh.price_period_components (product_id, pricecomponentid, price_id, price, period_start, period_end)
+SELECT
+  f.product_id,
+  f.pricecomponentid,
+  f.price_id,
+  f.price,
+  gs::date AS period_start,
+  LEAST(f.valid_until, date_trunc('year', gs) + INTERVAL '1 year' - INTERVAL '1 day')::date AS period_end
+FROM (
   SELECT
-    f.product_id,
-    f.pricecomponentid,
-    f.price_id,
-    f.price,
-    GREATEST(f.valid_from, date_trunc('year', f.valid_from)) AS valid_from,
-    LEAST(f.valid_until, m.max_date) AS valid_until
-  FROM prices_filtered f
-  CROSS JOIN max_extract m
-  WHERE f.pricecomponentid = 2
+    i.product_id,
+    i.pricecomponentid,
+    i.price_id,
+    i.price,
+    GREATEST(i.valid_from, date_trunc('year', i.valid_from)) AS valid_from,
+    LEAST(i.valid_until, r.horizon) AS valid_until
+  FROM price_periods_input i
+  JOIN price_periods_changed c ON c.product_id = i.product_id
+  CROSS JOIN price_periods_run r
+) f,
+generate_series(f.valid_from, f.valid_until, interval '1 year') AS gs;
+
+INSERT INTO dwh.price_period_expansions (product_id, price_hash, horizon, computed_snapshot_date)
+SELECT h.product_id, h.price_hash, r.horizon, r.snapshot_date
+FROM price_periods_hashes h
+JOIN price_periods_changed c ON c.product_id = h.product_id
+CROSS JOIN price_periods_run r
+ON CONFLICT (product_id) DO UPDATE
+SET price_hash = EXCLUDED.price_hash,
+    horizon = EXCLUDED.horizon,
+    computed_snapshot_date = EXCLUDED.computed_snapshot_date;
+
+DELETE FROM dwh.price_periods
+WHERE snapshot_date = (SELECT snapshot_date FROM price_periods_run);
+
+DELETE FROM dwh.price_periods_products
+WHERE snapshot_date = (SELECT snapshot_date FROM price_periods_run);
+
+INSERT INTO dwh.price_periods_products (snapshot_date, product_id, price_hash, computed_snapshot_date)
+SELECT
+  r.snapshot_date,
+  h.product_id,
+  h.price_hash,
+  e.computed_snapshot_date
+FROM price_periods_hashes h
+CROSS JOIN price_periods_run r
+JOIN dwh.price_period_expansions e ON e.product_id = h.product_id
+WHERE r.snapshot_date IS NOT NULL;
+
+
+-- Периоды слепка: развёрнутые периоды, начавшиеся не позже даты слепка, с концом, обрезанным датой слепка,
+-- — то же, что разворачивание цен сразу до даты слепка
+WITH max_extract AS (
+  SELECT snapshot_date AS max_date FROM price_periods_run
 ),
 
--- 4. Разворачивание периодов
+-- 4. Периоды базовой и переменной цены
 base_periods AS (
   SELECT
-    product_id,
-    pricecomponentid,
-    price_id,
-    price,
-    gs::date AS period_start,
-    LEAST(valid_until, date_trunc('year', gs) + INTERVAL '1 year' - INTERVAL '1 day') AS period_end
-  FROM base_input,
-  generate_series(valid_from, valid_until, interval '1 year') AS gs
+    c.product_id,
+    c.pricecomponentid,
+    c.price_id,
+    c.price,
+    c.period_start,
+    LEAST(c.period_end, m.max_date) AS period_end
+  FROM dwh.price_period_components c
+  JOIN price_periods_hashes h ON h.product_id = c.product_id
+  CROSS JOIN max_extract m
+  WHERE c.pricecomponentid = 1
+    AND c.period_start <= m.max_date
 ),
 
 working_periods AS (
   SELECT
-    product_id,
-    pricecomponentid,
-    price_id,
-    price,
-    gs::date AS period_start,
-    LEAST(valid_until, date_trunc('year', gs) + INTERVAL '1 year' - INTERVAL '1 day') AS period_end
-  FROM working_input,
-  generate_series(valid_from, valid_until, interval '1 year') AS gs
+    c.product_id,
+    c.pricecomponentid,
+    c.price_id,
+    c.price,
+    c.period_start,
+    LEAST(c.period_end, m.max_date) AS period_end
+  FROM dwh.price_period_components c
+  JOIN price_periods_hashes h ON h.product_id = c.product_id
+  CROSS JOIN max_extract m
+  WHERE c.pricecomponentid = 2
+    AND c.period_start <= m.max_date
 ),
 
 -- 5. Объединение уникальных периодов
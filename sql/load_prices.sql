@@ -80,22 +80,21 @@ SELECT
   source_table
 FROM tmp_price_staging;
   
--- 3. Сброс всех флагов is_current (для тех, у кого появилась более свежая версия)
-UPDATE dwh.prices p
-SET is_current = FALSE
-WHERE EXISTS (
-  SELECT 1
-  FROM dwh.prices newer
-  WHERE newer.price_id = p.price_id
-    AND newer.modificationdate > p.modificationdate
-);
-
--- 4. Помечаем самую свежую запись по каждому price_id как текущую
+-- 3. Пересчёт is_current только для price_id с новыми версиями: самая свежая версия — текущая,
+-- остальные нет. Строки, у которых флаг уже верный, не обновляются
+WITH batch_keys AS (
+  SELECT DISTINCT price_id FROM tmp_price_staging
+),
+ranked AS (
+  SELECT
+    p.price_sk,
+    p.is_current,
+    ROW_NUMBER() OVER (PARTITION BY p.price_id ORDER BY p.modificationdate DESC) = 1 AS should_be_current
+  FROM dwh.prices p
+  JOIN batch_keys k ON k.price_id = p.price_id
+)
 UPDATE dwh.prices p
-SET is_current = TRUE
-WHERE NOT EXISTS (
-  SELECT 1
-  FROM dwh.prices newer
-  WHERE newer.price_id = p.price_id
-    AND newer.modificationdate > p.modificationdate
-);
+SET is_current = r.should_be_current
+FROM ranked r
+WHERE p.price_sk = r.price_sk
+  AND p.is_current IS DISTINCT FROM r.should_be_current;
@@ -1,11 +1,8 @@
+-- Целевые таблицы. IF NOT EXISTS: в базах, созданных до появления миграций, таблицы уже есть
 CREATE SCHEMA IF NOT EXISTS dwh;
 
-DROP TABLE IF EXISTS dwh.products;
-DROP TABLE IF EXISTS dwh.prices;
-DROP TABLE IF EXISTS dwh.contracts;
-
 -- Таблица продуктов
-CREATE TABLE dwh.products (
+CREATE TABLE IF NOT EXISTS dwh.products (
   product_sk SERIAL PRIMARY KEY,
   product_id BIGINT NOT NULL,
   productcode TEXT,
@@ -26,7 +23,7 @@ CREATE TABLE dwh.products (
 );
 
 -- Таблица цен
-CREATE TABLE dwh.prices (
+CREATE TABLE IF NOT EXISTS dwh.prices (
   price_sk SERIAL PRIMARY KEY,
   price_id BIGINT NOT NULL,
   product_id BIGINT NOT NULL,
@@ -44,8 +41,11 @@ CREATE TABLE dwh.prices (
   UNIQUE (price_id, modificationdate)
 );
 
+-- Открытые версии: закрытие версий в load_prices.sql ищет их по price_id
+CREATE INDEX IF NOT EXISTS ix_prices_current ON dwh.prices (price_id) WHERE is_current;
+
 -- Таблица контрактов
-CREATE TABLE dwh.contracts (
+CREATE TABLE IF NOT EXISTS dwh.contracts (
   contract_sk SERIAL PRIMARY KEY,
   contract_id BIGINT NOT NULL,
   product_id INT NOT NULL,
@@ -71,3 +71,6 @@ CREATE TABLE dwh.contracts (
   hash_value TEXT,
   UNIQUE (contract_id, modificationdate)
 );
+
+-- Открытые версии: закрытие версий в load_contracts.sql ищет их по contract_id
+CREATE INDEX IF NOT EXISTS ix_contracts_current ON dwh.contracts (contract_id) WHERE is_current;
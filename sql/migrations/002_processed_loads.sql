@@ -0,0 +1,7 @@
+-- Загрузки, staging-таблицы которых полностью обработаны в dwh (задача mark_load_processed).
+-- Неизменившиеся файлы etl-runner пропускает; их таблицы попадают в staging-представления,
+-- только если загрузка, в которой они были записаны, ещё не дошла до dwh
+CREATE TABLE IF NOT EXISTS dwh.processed_loads (
+  load_id TEXT PRIMARY KEY,
+  processed_at TIMESTAMP DEFAULT now()
+);
@@ -0,0 +1,18 @@
+-- Журнал шагов SQL-скриптов DAG (run_sql_script в airflow/dags/etl_postgres.py):
+-- время и число строк каждого оператора, чтобы видеть, какой шаг load_*.sql занимает время
+CREATE TABLE IF NOT EXISTS dwh.etl_sql_steps (
+  id BIGSERIAL PRIMARY KEY,
+  load_id TEXT,
+  dag_run_id TEXT,
+  task_id TEXT,
+  script TEXT NOT NULL,                           -- имя файла
+  step INT NOT NULL,                              -- номер оператора в файле
+  statement TEXT,                                 -- начало оператора
+  rows_affected BIGINT,
+  duration_ms NUMERIC(12,1),
+  status TEXT NOT NULL,                           -- SUCCESS / FAILED
+  error TEXT,
+  logged_at TIMESTAMP DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS ix_etl_sql_steps_script ON dwh.etl_sql_steps (script, logged_at);
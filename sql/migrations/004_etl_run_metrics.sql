@@ -0,0 +1,71 @@
+-- Метрики запусков в Postgres вместо SQLite: задачи DAG пишет колбэк log_dag_event
+-- (write_task_run в airflow/dags/etl_postgres.py), файлы — etl-runner в load_log
+CREATE TABLE IF NOT EXISTS dwh.etl_task_runs (
+  id BIGSERIAL PRIMARY KEY,
+  load_id TEXT,
+  dag_run_id TEXT,
+  task_id TEXT NOT NULL,
+  map_index INT,                                  -- индекс развёрнутой задачи (-1 для обычной)
+  try_number INT,
+  status TEXT NOT NULL,                           -- SUCCESS / FAILED
+  started_at TIMESTAMPTZ,
+  ended_at TIMESTAMPTZ,
+  duration_ms NUMERIC(12,1),
+  rows_processed BIGINT,                          -- строки SQL-операторов задачи или загруженные etl-runner
+  bytes_processed BIGINT,                         -- размер загруженных файлов
+  error TEXT,
+  logged_at TIMESTAMP DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS ix_etl_task_runs_load_id ON dwh.etl_task_runs (load_id, started_at);
+
+-- load_log создаёт etl-runner (etl/load.py, ensure_load_log); здесь — на случай, если он ещё не запускался,
+-- чтобы представление ниже можно было создать
+CREATE TABLE IF NOT EXISTS public.load_log (
+  load_id TEXT,
+  entity TEXT,
+  file TEXT,
+  status TEXT,
+  rows_loaded INTEGER,
+  error TEXT
+);
+
+ALTER TABLE public.load_log
+  ADD COLUMN IF NOT EXISTS etag TEXT,
+  ADD COLUMN IF NOT EXISTS size BIGINT,
+  ADD COLUMN IF NOT EXISTS content_hash TEXT,
+  ADD COLUMN IF NOT EXISTS staging_table TEXT,
+  ADD COLUMN IF NOT EXISTS loaded_at TIMESTAMP DEFAULT now(),
+  ADD COLUMN IF NOT EXISTS started_at TIMESTAMPTZ,
+  ADD COLUMN IF NOT EXISTS duration_ms NUMERIC(12,1);
+
+CREATE INDEX IF NOT EXISTS load_log_load_id_idx ON public.load_log (load_id);
+
+-- Хронология запуска: задачи DAG и файлы etl-runner одного load_id. Обычное представление —
+-- фильтр по load_id доходит до индексов обеих таблиц, а данные не устаревают, как у материализованного
+CREATE OR REPLACE VIEW dwh.etl_run_timeline AS
+SELECT
+  load_id,
+  'task' AS kind,
+  task_id || CASE WHEN map_index >= 0 THEN '[' || map_index || ']' ELSE '' END AS name,
+  status,
+  started_at,
+  ended_at,
+  duration_ms,
+  rows_processed,
+  bytes_processed,
+  error
+FROM dwh.etl_task_runs
+UNION ALL
+SELECT
+  load_id,
+  'file' AS kind,
+  file AS name,
+  status,
+  COALESCE(started_at, loaded_at::timestamptz) AS started_at,
+  COALESCE(started_at, loaded_at::timestamptz) + COALESCE(duration_ms, 0) * INTERVAL '1 millisecond' AS ended_at,
+  duration_ms,
+  rows_loaded AS rows_processed,
+  CASE WHEN status = 'SUCCESS' THEN size END AS bytes_processed,
+  error
+FROM public.load_log;
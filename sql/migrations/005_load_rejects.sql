@@ -0,0 +1,17 @@
+-- Схема проверки строк etl-runner (etl/validation.py): число отклонённых строк файла в load_log
+-- и сами отклонённые строки в load_rejects. etl-runner создаёт то же самое при старте (etl/load.py,
+-- ensure_load_log и ensure_load_rejects), здесь — чтобы схема не зависела от того, что запустилось первым
+ALTER TABLE public.load_log
+  ADD COLUMN IF NOT EXISTS rows_rejected INTEGER;
+
+CREATE TABLE IF NOT EXISTS public.load_rejects (
+  load_id TEXT,
+  entity TEXT,
+  file TEXT,
+  row_number INTEGER,                             -- номер строки в файле (с заголовком)
+  reasons TEXT,                                   -- причины через "; "
+  data JSONB,                                     -- исходные значения строки
+  rejected_at TIMESTAMP DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS load_rejects_load_id_idx ON public.load_rejects (load_id, file);